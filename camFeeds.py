@@ -13,11 +13,12 @@ def runWeb(ENVIRON):
     #==========================================================================================
     @app.route('/', methods=['GET'])
     def home():
-        image_names = os.listdir(imagepath)
+        # only the latest image from each client. Skips the history folders and any file still being written
+        image_names = sorted(name for name in os.listdir(imagepath) if name.endswith('.jpg'))
         images = ''
         for name in image_names:
             images += '<div style="text-align: center;"><img src="static/motionImages/' + name + '" > <br><br></div>'
-            html = '<HTML><HEAD></HEAD><BODY><meta http-equiv="refresh" content="3" />' + images + '</BODY></HTML>'
+        html = '<HTML><HEAD></HEAD><BODY><meta http-equiv="refresh" content="3" />' + images + '</BODY></HTML>'
         return html
 
     @app.after_request
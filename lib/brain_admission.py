@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Admission control for motion frames, used by brain_motion.detectorAPI before running the models
+Clients send a motion frame for every frame with motion, so consecutive frames are often near
+identical. Each frame gets a difference hash (dHash) of a tiny grayscale thumbnail. A frame whose
+hash is within dedupDistance bits of the last frame analysed for the same client is not analysed
+again, and the client is sent the result of that frame instead. A new frame that arrives sooner
+than 1 / maxInferenceRate seconds after the last analysed one is not analysed either, and the
+client is sent the last result, so every frame still gets a reply.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import logging
+import threading
+import time
+import numpy as np
+import cv2
+
+resultAge = 10                  # seconds a result may be reused before a repeat frame is analysed again
+statsEvery = 100                # how often (frames) to log the number of frames analysed and skipped
+
+
+# 64 bit difference hash of a JPEG. Decoded at 1/8 size in grayscale, shrunk to 9x8, then each
+# bit says whether a pixel is brighter than the one to its left
+#---------------------------------------------------------------------------
+def dHash(imgbin):
+    small = cv2.imdecode(np.frombuffer(imgbin, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    small = cv2.resize(small, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+# Number of bits that differ between two hashes
+#---------------------------------------------------------------------------
+def hashDistance(a, b):
+    return bin(a ^ b).count('1')
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Admission control. Keeps the last analysed frame and its result for each client
+#-------------------------------------------------------------------------------------------------------------------------
+class admissionControl(object):
+
+    def __init__(self, dedupDistance=5, maxRate=2):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("brain_admission")
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        self.dedupDistance = dedupDistance
+        self.minInterval = 1.0 / maxRate if maxRate > 0 else 0
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.counts = {"analyse": 0, "repeat": 0, "limited": 0}
+
+
+    # Decide what to do with a frame from a client. Returns 'analyse', 'repeat' or 'limited', and
+    # for a repeat or limited frame the reply sent for the last analysed frame (None if it is still
+    # being analysed, when its reply is still to come)
+    # ----------------------------------------------------------------------------------
+    def check(self, client, imgbin):
+        frameHash = dHash(imgbin) if self.dedupDistance > 0 else None
+        now = time.time()
+        with self.lock:
+            last = self.clients.get(client)
+            if last is None:
+                decision = 'analyse'
+            elif (frameHash is not None and last["hash"] is not None and now - last["time"] < resultAge
+                    and hashDistance(frameHash, last["hash"]) <= self.dedupDistance):
+                decision = 'repeat'
+            elif now - last["time"] < self.minInterval:
+                decision = 'limited'
+            else:
+                decision = 'analyse'
+            cached = None
+            if decision == 'analyse':
+                self.clients[client] = {"hash": frameHash, "time": now, "result": None}
+            else:
+                cached = last["result"]
+            self.counts[decision] += 1
+            if sum(self.counts.values()) % statsEvery == 0:
+                self.logger.debug(self.statsText())
+        return decision, cached
+
+
+    # Keep the reply sent for the last analysed frame, to reuse for repeats of it
+    # ----------------------------------------------------------------------------------
+    def remember(self, client, result):
+        with self.lock:
+            if client in self.clients:
+                self.clients[client]["result"] = result
+
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+    def statsText(self):
+        counts = self.counts
+        total = max(sum(counts.values()), 1)
+        return ('Motion frames: %d analysed, %d repeats reused, %d over the rate limit (%.0f%% skipped)' %
+                (counts["analyse"], counts["repeat"], counts["limited"],
+                 (counts["repeat"] + counts["limited"]) * 100.0 / total))
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Micro-batching scheduler used in front of brain_motion.detectorAPI
+Motion frames from all clients are collected for up to batchWindow milliseconds (or until
+batchSize frames are waiting) and then run through the object detector in one forward pass.
+Face recognition and the reply to each client then carry on per frame as before.
+At most maxInbox frames wait for a batch. If detection falls behind, the oldest are dropped.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import logging
+import threading
+import queue
+import time
+import collections
+import numpy as np
+import lib.common_detect as common_detect
+
+statsEvery = 100                # how often (frames) to log throughput and latency
+maxInbox = 50                   # frames waiting for a batch before the oldest are dropped
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Batch scheduler. Owns the detector while running, so only its thread uses the models
+#-------------------------------------------------------------------------------------------------------------------------
+class batchScheduler(object):
+
+    def __init__(self, detectorAPI, window=30, maxBatch=8):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("brain_batch")
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        self.detectorAPI = detectorAPI
+        self.window = window / 1000.0
+        self.maxBatch = max(maxBatch, 1)
+        self.inbox = queue.Queue(maxsize=maxInbox)
+        self.dropped = 0
+        self.thread = None
+        self.resetStats()
+
+
+    # Clear the throughput and latency figures
+    # ----------------------------------------------------------------------------------
+    def resetStats(self):
+        self.frames = 0
+        self.batches = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.startTime = time.perf_counter()
+
+
+    # Called from the queue consumer. Decodes and saves the image, then queues it for the next batch.
+    # done (optional) is called once the frame has been handled, eg. to ack the message
+    # ----------------------------------------------------------------------------------
+    def submit(self, content, reply_to, body, headers=None, done=None):
+        frame = self.detectorAPI.prepareFrame(content, reply_to, body, headers)
+        if frame is None:
+            if done:
+                done()
+            return
+        self.submitFrame(frame, reply_to, done)
+
+
+    # Queue an already prepared frame for the next batch, dropping the oldest waiting frame if the inbox is full
+    # ----------------------------------------------------------------------------------
+    def submitFrame(self, frame, reply_to, done=None):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="batchScheduler", daemon=True)
+            self.thread.start()
+        item = (time.perf_counter(), frame, reply_to, done)
+        while True:
+            try:
+                self.inbox.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    queued, oldFrame, oldReply, oldDone = self.inbox.get_nowait()
+                    self.dropped += 1
+                    self.logger.warning('Object detection is falling behind. Dropped a frame from ' + str(oldReply))
+                    if oldDone:
+                        oldDone()
+                except queue.Empty:
+                    pass
+
+
+    # Collect frames until the window closes or the batch is full
+    # ----------------------------------------------------------------------------------
+    def collect(self):
+        batch = [self.inbox.get()]
+        closeAt = time.perf_counter() + self.window
+        while len(batch) < self.maxBatch:
+            remaining = closeAt - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self.inbox.get(timeout=remaining))
+                else:
+                    batch.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+
+    # Main loop. Runs one forward pass per batch then finishes each frame
+    # ----------------------------------------------------------------------------------
+    def run(self):
+        while True:
+            batch = self.collect()
+            frames = [item[1] for item in batch]
+            try:
+                startTime = time.perf_counter()
+                results = self.detectorAPI.objectCountBatch(frames)
+                elapsed = (time.perf_counter() - startTime) * 1000
+            except Exception as e:
+                self.logger.error('Error running object detection on batch. ' + str(e))
+                # nothing found, so each client still gets a reply
+                results = [({}, np.zeros(0, dtype=common_detect.detectionType)) for item in batch]
+                elapsed = 0
+            for (queued, frame, reply_to, done), (detected, objects) in zip(batch, results):
+                frame.timings.append(('objects(batch %d)' % len(batch), elapsed))
+                try:
+                    self.detectorAPI.finishFrame(frame, reply_to, detected, objects)
+                except Exception as e:
+                    self.logger.error('Error finishing frame from ' + str(reply_to) + '. ' + str(e))
+                if done:
+                    done()
+                self.latencies.append(time.perf_counter() - queued)
+                self.frames += 1
+                if self.frames % statsEvery == 0:
+                    self.logger.debug(self.statsText())
+            self.batches += 1
+
+
+    # Throughput and latency since the stats were last reset
+    # ----------------------------------------------------------------------------------
+    def stats(self):
+        elapsed = time.perf_counter() - self.startTime
+        ordered = sorted(self.latencies)
+        def percentile(p):
+            if not ordered:
+                return 0.0
+            return ordered[min(int(len(ordered) * p), len(ordered) - 1)] * 1000
+        return {"fps": self.frames / elapsed if elapsed > 0 else 0.0,
+                "p50": percentile(.5),
+                "p95": percentile(.95),
+                "avgBatch": self.frames / float(self.batches) if self.batches else 0.0}
+
+
+    def statsText(self):
+        s = self.stats()
+        return ("Batch window %dms: %.1f frames/sec, latency p50 %.1fms p95 %.1fms, avg batch %.1f, dropped %d" %
+                (self.window * 1000, s["fps"], s["p50"], s["p95"], s["avgBatch"], self.dropped))
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own for tuning.
+# Simulates several clients posting motion frames and reports throughput
+# and latency for a range of batch windows. Replies are not sent.
+# **************************************************************************
+if __name__ == "__main__":
+    import os
+    import sys
+    import glob
+    topdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    sys.path.insert(0, topdir)
+    import lib.brain_motion as motion
+    from lib.brain_frame import framePipeline
+
+    clients = 4
+    framesEach = 50
+    interval = .1               # seconds between frames from each client
+
+    ENVIRON = {"topdir": topdir, "keepImages": "False", "recordEvents": "False", "brainQueue": "Central"}
+    detector = motion.detectorAPI(ENVIRON)
+    detector.sendMessage = lambda reply_to, body: True
+    detector.logger.level = logging.INFO
+
+    images = []
+    for path in sorted(glob.glob(os.path.join(topdir, 'static/MLModels/faceid/dataset/*.jp*g'))):
+        with open(path, 'rb') as f:
+            images.append(f.read())
+
+    for window in [0, 10, 30, 60]:
+        scheduler = batchScheduler(detector, window=window, maxBatch=8)
+        scheduler.logger.level = logging.INFO
+        def client(n):
+            for i in range(framesEach):
+                scheduler.submitFrame(framePipeline(images[(n + i) % len(images)]), 'Client' + str(n))
+                time.sleep(interval)
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        while scheduler.frames < clients * framesEach:
+            time.sleep(.05)
+        print(scheduler.statsText())
@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+In memory chat graph used by brain_voice.getChatPath
+The ChatText table is compiled into linear segments. A segment is a row plus every row that
+always follows it, up to a branch point (a yes/no choice, a random choice or the end of the
+chat). Each segment is held both as rows and as ready made JSON, so a chat reply is built by
+joining a few byte strings. The compile step also checks every 'next' reference and looks for
+loops, and the result is saved to chatgraph.pickle so the brain can load it in milliseconds.
+The graph reloads itself when robotAI.db or ChatText.csv changes (a newer CSV rebuilds the DB).
+Run this module with --check to validate the chat text without starting the brain.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import logging
+import sqlite3
+import pickle
+import random
+import json
+import time
+import csv
+import os
+
+checkEvery = 2                  # seconds between checks of the source files for changes
+maxPath = 100                   # most rows returned for one request, in case of a loop in the chat text
+graphVersion = 2                # change this when the layout of chatgraph.pickle changes
+errorRow = {'text': 'Something went wrong. I could not find the requested chat entry ', 'funct': '', 'next': ''}
+
+
+# build new chat database from the CSV file, replacing any existing table
+# ----------------------------------------------------------------------------------
+def buildDB(dbpath, csvpath, logger):
+    logger.warning("Building ChatText DB from CSV... ")
+    conn = sqlite3.connect(dbpath)
+    # now create tables and populate from CSV
+    cur = conn.cursor()
+    cur.execute("""DROP TABLE IF EXISTS ChatText""")
+    cur.execute("""CREATE TABLE ChatText (category VARCHAR(32) NOT NULL, item INTEGER NOT NULL, text VARCHAR(255), funct VARCHAR(255), next VARCHAR(255))""")
+    cur.execute("""CREATE INDEX ChatText_cat ON ChatText(category)""")
+    cur.execute("""CREATE INDEX ChatText_catitem ON ChatText(category, item)""")
+    with open(csvpath, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            data = (row['category'], row['item'], row['text'], row['funct'], row['next'])
+            cur.execute("INSERT INTO ChatText VALUES (?,?,?,?,?);", data)
+    conn.commit()
+    logger.warning("ChatText DB was successfully created from CSV. ")
+    conn.close()
+
+
+# Split a chat id such as 0-JOKE2-11 into its category and item, or None if badly formed
+# ----------------------------------------------------------------------------------
+def splitId(chatid):
+    row = chatid.strip().split("-")
+    if len(row) != 3 or not row[1]:
+        return None
+    return row[1], row[2]
+
+
+# Make 2 part chat IDs such as GREETA-0 match the way the 'next' column is formatted
+# ----------------------------------------------------------------------------------
+def fullId(chatid):
+    if len(chatid.split('-')) == 2:
+        return '0-' + chatid
+    return chatid
+
+
+# The JSON for one row, exactly as json.dumps writes it inside a list
+# ----------------------------------------------------------------------------------
+def rowJSON(row):
+    return json.dumps(row).encode("utf-8")
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Compile the chat rows into segments and check them. rows is a list of (category, item, text, funct, next)
+# Returns the compiled graph as a dictionary and a list of problems found
+#-------------------------------------------------------------------------------------------------------------------------
+def compileGraph(rows, contexts=()):
+    problems = []
+    categories = {}             # category -> list of rows, in table order
+    items = {}                  # category -> {item: index of the first row with that item}
+    duplicates = {}             # (category, item) -> number of rows with that item, if more than one
+    for (category, item, text, funct, nxt) in rows:
+        if not category:
+            continue
+        item = str(item)
+        rowlist = categories.setdefault(category, [])
+        index = items.setdefault(category, {})
+        if item in index:
+            duplicates[(category, item)] = duplicates.get((category, item), 1) + 1
+        else:
+            index[item] = len(rowlist)
+        rowlist.append({'text': text or '', 'funct': funct or '', 'next': (nxt or '').strip()})
+    for (category, item), count in duplicates.items():
+        problems.append('Duplicate item %s-%s (%d rows). Only the first is used when asked for by number' % (category, item, count))
+
+    # Where a chat id leads to: a list of (category, index), 'random' for a whole category or None if broken
+    def resolve(chatid):
+        parts = splitId(chatid)
+        if parts is None or parts[0] not in categories:
+            return None
+        if parts[1] == '0':
+            return 'random'
+        if parts[1] not in items[parts[0]]:
+            return None
+        return [(parts[0], items[parts[0]][parts[1]])]
+
+    def targets(chatid):
+        found = resolve(chatid)
+        if found == 'random':
+            category = splitId(chatid)[0]
+            return [(category, i) for i in range(len(categories[category]))]
+        return found or []
+
+    # check every reference, including each option of a branch and the contexts of the ML chat bot
+    for category, rowlist in categories.items():
+        for i, row in enumerate(rowlist):
+            for option in row['next'].split('|') if row['next'] else []:
+                if resolve(option) is None:
+                    problems.append('Broken reference %s from %s row %d' % (option, category, i + 1))
+    for context in contexts:
+        if resolve(fullId(context)) is None:
+            problems.append('Broken reference %s from chatschema.json' % context)
+
+    # look for loops in the rows that follow on without a branch, as these never end
+    # (iterative depth first search, state 1 = on the current path, 2 = finished)
+    state = {}
+    for start in [(c, i) for c in categories for i in range(len(categories[c]))]:
+        if start in state:
+            continue
+        stack = [(start, iter(linearTargets(categories, start, targets)))]
+        path = [start]
+        state[start] = 1
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                state[node] = 2
+                stack.pop()
+                path.pop()
+            elif state.get(child) == 1:
+                loop = path[path.index(child):] + [child]
+                problems.append('Loop in chat text: ' + ' > '.join('%s row %d' % (c, i + 1) for c, i in loop))
+            elif child not in state:
+                state[child] = 1
+                path.append(child)
+                stack.append((child, iter(linearTargets(categories, child, targets))))
+
+    # build the linear segment that starts at each row
+    segments = {}
+    for category, rowlist in categories.items():
+        segments[category] = []
+        for i in range(len(rowlist)):
+            segment = []
+            node = (category, i)
+            seen = set()
+            cont = None
+            while node is not None and node not in seen and len(segment) < maxPath:
+                seen.add(node)
+                row = categories[node[0]][node[1]]
+                segment.append(row)
+                nxt = row['next']
+                node = None
+                if nxt and '|' not in nxt:
+                    found = resolve(nxt)
+                    if found == 'random':
+                        cont = splitId(nxt)[0]
+                    elif found is None:
+                        segment.append(errorRow)
+                    else:
+                        node = found[0]
+            segments[category].append((segment, b', '.join(rowJSON(row) for row in segment), cont))
+
+    graph = {'version': graphVersion, 'items': items, 'segments': segments}
+    return graph, problems
+
+
+# The rows that always follow a row, ie. its 'next' when that is not a branch
+# ----------------------------------------------------------------------------------
+def linearTargets(categories, node, targets):
+    nxt = categories[node[0]][node[1]]['next']
+    if not nxt or '|' in nxt:
+        return []
+    return targets(nxt)
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Chat graph class
+#-------------------------------------------------------------------------------------------------------------------------
+class chatGraph(object):
+
+    def __init__(self, ENVIRON, logger=None):
+        if logger is None:
+            logging.basicConfig()
+            logger = logging.getLogger("brain_chat")
+        self.logger = logger
+        self.dbpath = os.path.join(ENVIRON["topdir"], 'static/db/robotAI.db')
+        self.csvpath = os.path.join(ENVIRON["topdir"], 'static/db/ChatText.csv')
+        self.graphpath = os.path.join(ENVIRON["topdir"], 'static/db/chatgraph.pickle')
+        self.schemapath = os.path.join(ENVIRON["topdir"], 'static/MLModels/chatbot/chatschema.json')
+        self.items = {}                 # category -> {item: index of row}
+        self.segments = {}              # category -> list of (rows, json bytes, category to continue at)
+        self.problems = []
+        self.stamp = None
+        self.lastCheck = 0
+        self.reload()
+
+
+    # modified times of the DB, CSV and chat bot schema files, or None if missing
+    # ----------------------------------------------------------------------------------
+    def fileStamp(self):
+        stamp = []
+        for path in [self.dbpath, self.csvpath, self.schemapath]:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+
+    # Reload the graph if any source file has changed since it was loaded
+    # ----------------------------------------------------------------------------------
+    def checkReload(self):
+        now = time.time()
+        if now - self.lastCheck < checkEvery:
+            return
+        self.lastCheck = now
+        if self.fileStamp() != self.stamp:
+            self.logger.debug('Chat text has changed. Reloading chat graph')
+            self.reload()
+
+
+    # Load the compiled graph, compiling it again if it is missing or older than its sources
+    # ----------------------------------------------------------------------------------
+    def reload(self):
+        dbTime, csvTime, schemaTime = self.fileStamp()
+        if dbTime is None or (csvTime is not None and csvTime > dbTime):
+            buildDB(self.dbpath, self.csvpath, self.logger)
+        stamp = self.fileStamp()
+        graph = None
+        try:
+            with open(self.graphpath, 'rb') as f:
+                graph = pickle.load(f)
+            if graph.get('version') != graphVersion or graph.get('stamp') != stamp:
+                graph = None
+        except Exception:
+            graph = None
+        if graph is None:
+            graph = self.compile(stamp)
+
+        self.items = graph['items']
+        self.segments = graph['segments']
+        self.problems = graph['problems']
+        self.stamp = stamp
+        self.lastCheck = time.time()
+
+
+    # Read the rows from the DB, compile them and save the result
+    # ----------------------------------------------------------------------------------
+    def compile(self, stamp=None):
+        startTime = time.perf_counter()
+        conn = sqlite3.connect(self.dbpath)
+        try:
+            rows = conn.execute("SELECT category, item, text, funct, next FROM ChatText ORDER BY rowid").fetchall()
+        finally:
+            conn.close()
+        contexts = []
+        try:
+            with open(self.schemapath) as f:
+                contexts = [i['context_set'] for i in json.load(f)['intents'] if i.get('context_set')]
+        except Exception:
+            pass
+
+        graph, problems = compileGraph(rows, contexts)
+        for problem in problems:
+            self.logger.warning(problem)
+        graph['problems'] = problems
+        graph['stamp'] = stamp or self.fileStamp()
+        try:
+            with open(self.graphpath + '.tmp', 'wb') as f:
+                pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.graphpath + '.tmp', self.graphpath)
+        except OSError as e:
+            self.logger.error('Could not save the compiled chat graph. ' + str(e))
+        self.logger.debug('Compiled %d chat rows in %d categories in %.1fms with %d problems' %
+                          (len(rows), len(graph['segments']), (time.perf_counter() - startTime) * 1000, len(problems)))
+        return graph
+
+
+    # The segments to send for a chat id such as 0-GREETA-0 (random item) or 0-JOKE2-11
+    # ----------------------------------------------------------------------------------
+    def walk(self, chatid):
+        self.checkReload()
+        if not chatid or '|' in chatid:
+            return []
+        parts = splitId(chatid)
+        if parts is None or parts[0] not in self.segments:
+            return [([errorRow], rowJSON(errorRow), None)]
+        category, item = parts
+        if item == '0':
+            segment = random.choice(self.segments[category])
+        elif item in self.items[category]:
+            segment = self.segments[category][self.items[category][item]]
+        else:
+            return [([errorRow], rowJSON(errorRow), None)]
+
+        path = [segment]
+        length = len(segment[0])
+        while segment[2] is not None:
+            if length >= maxPath:
+                self.logger.error('Chat path from %s is longer than %d rows. Stopping here' % (chatid, maxPath))
+                break
+            segment = random.choice(self.segments[segment[2]])
+            path.append(segment)
+            length += len(segment[0])
+        return path
+
+
+    # Build the list of chat rows from chatid until the chat branches or ends
+    # ----------------------------------------------------------------------------------
+    def getChatPath(self, chatid):
+        chatlst = []
+        for segment in self.walk(chatid):
+            chatlst.extend(segment[0])
+        return chatlst
+
+
+    # The complete chat message for the client as JSON bytes, joined from the compiled segments
+    # ----------------------------------------------------------------------------------
+    def getChatBody(self, chatid):
+        return b'{"action": "chat", "list": [' + b', '.join(segment[1] for segment in self.walk(chatid)) + b']}'
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own.
+# With --check it compiles the chat text and lists any problems found.
+# Otherwise it benchmarks the old per hop SQL lookup against the chat graph
+# **************************************************************************
+if __name__ == "__main__":
+    import argparse
+    import sys
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-c", "--check", action="store_true", help="compile and validate the chat text only")
+    args = vars(ap.parse_args())
+
+    topdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    ENVIRON = {"topdir": topdir}
+    if args["check"]:
+        logger = logging.getLogger("brain_chat")
+        logger.level = logging.ERROR
+        # loading the graph compiles it if the chat text has changed, and keeps the problems found
+        graph = chatGraph(ENVIRON, logger)
+        for problem in graph.problems:
+            print(problem)
+        print("%d problems found" % len(graph.problems))
+        sys.exit(1 if graph.problems else 0)
+
+    graph = chatGraph(ENVIRON)
+
+    startTime = time.perf_counter()
+    graph.reload()
+    print("Load compiled graph  %.2fms" % ((time.perf_counter() - startTime) * 1000))
+    startTime = time.perf_counter()
+    graph.compile()
+    print("Compile from the DB  %.2fms" % ((time.perf_counter() - startTime) * 1000))
+
+    chatids = ['0-GREETA-0', '0-GREET1-0', '0-JOKE1-0', '0-RECOG-0', '0-SECURE1-0']
+    requests = 2000
+
+    # the lookup as it was done before, with a new connection and one query per hop
+    def sqlChatPath(chatid):
+        conn = sqlite3.connect(graph.dbpath)
+        cur = conn.cursor()
+        chatlst = []
+        while '|' not in chatid and len(chatid) > 0:
+            row = chatid.split("-")
+            SQL = "SELECT text, funct, next FROM ChatText WHERE Category = '" + row[1] + "'"
+            if str(row[2]) != '0':
+                SQL += " AND Item = " + str(row[2])
+            else:
+                SQL += " ORDER BY RANDOM() LIMIT 1 ;"
+            cur.execute(SQL)
+            found = cur.fetchall()
+            if len(found) > 0:
+                d = {'text': found[0][0], 'funct': found[0][1], 'next': found[0][2]}
+            else:
+                d = errorRow
+            chatlst.append(d)
+            chatid = d['next']
+        conn.close()
+        return chatlst
+
+    tests = [('SQL per hop + JSON', lambda chatid: json.dumps({'action': 'chat', 'list': sqlChatPath(chatid)})),
+             ('Graph rows + JSON', lambda chatid: json.dumps({'action': 'chat', 'list': graph.getChatPath(chatid)})),
+             ('Graph JSON bytes', graph.getChatBody)]
+    for name, fn in tests:
+        startTime = time.perf_counter()
+        for i in range(requests):
+            fn(chatids[i % len(chatids)])
+        elapsed = time.perf_counter() - startTime
+        print("%-20s %.1f microseconds per request" % (name, elapsed / requests * 1000000))
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Inference engines for the ML chat bot used by brain_voice
+The model built by static/build_chatbot.py is tiny: Embedding > GlobalAveragePooling1D >
+Dense(16, relu) > Dense(16, relu) > Dense(softmax). numpyEngine runs it with plain NumPy from
+the weights and tokenizer exported by static/export_chatbot.py, so the brain does not need to
+import TensorFlow at all. kerasEngine is the original TensorFlow path. Both give the
+probability of each intent tag for a list of sentences. intentModel sits in front of the
+engine and answers repeated sentences and exact matches with chatschema.json patterns directly.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import collections
+import json
+import time
+import os
+import numpy as np
+
+# settings used when the model was trained (see static/build_chatbot.py)
+vocabSize = 20000
+maxLen = 20
+oovToken = "<OOV>"
+# characters removed by the Keras Tokenizer before splitting text into words
+filters = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+# words ignored when looking for a near exact match with a pattern in chatschema.json
+fillerWords = ['please', 'hey', 'meebo', 'ok', 'okay', 'so', 'um', 'uh', 'well']
+cacheSize = 256                 # number of recent sentences whose intent is remembered
+checkEvery = 2                  # seconds between checks of the model and schema for changes
+statsEvery = 50                 # how often (sentences) to log the cache hit rate
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# NumPy engine
+#-------------------------------------------------------------------------------------------------------------------------
+class numpyEngine(object):
+
+    def __init__(self, path):
+        data = np.load(path)
+        self.embedding = data["embedding"]
+        self.layers = [(data["w1"], data["b1"]), (data["w2"], data["b2"]), (data["w3"], data["b3"])]
+        self.classes = [str(c) for c in data["classes"]]
+        self.wordIndex = {str(w): int(i) for w, i in zip(data["words"], data["ids"])}
+        self.numWords = int(data["numWords"])
+        self.maxLen = int(data["maxLen"])
+        self.table = str.maketrans(filters, ' ' * len(filters))
+
+
+    # Same as Tokenizer.texts_to_sequences for one sentence
+    # ----------------------------------------------------------------------------------
+    def toSequence(self, text):
+        oov = self.wordIndex.get(oovToken)
+        seq = []
+        for word in text.lower().translate(self.table).split(' '):
+            if not word:
+                continue
+            i = self.wordIndex.get(word)
+            if i is None or i >= self.numWords:
+                i = oov
+            if i is not None:
+                seq.append(i)
+        return seq
+
+
+    # Same as pad_sequences(seqs, truncating='post', maxlen=maxLen). Pads at the front with 0
+    # ----------------------------------------------------------------------------------
+    def pad(self, seqs):
+        padded = np.zeros((len(seqs), self.maxLen), dtype=np.int32)
+        for row, seq in enumerate(seqs):
+            seq = seq[:self.maxLen]
+            if seq:
+                padded[row, -len(seq):] = seq
+        return padded
+
+
+    # Probability of each class for a list of sentences, shape (N, classes)
+    # ----------------------------------------------------------------------------------
+    def predict(self, texts):
+        padded = self.pad([self.toSequence(text) for text in texts])
+        # the padding is part of the average, as the Keras model does not mask it
+        x = self.embedding[padded].mean(axis=1)
+        for (w, b) in self.layers[:-1]:
+            x = np.maximum(x @ w + b, 0)
+        w, b = self.layers[-1]
+        x = x @ w + b
+        x = np.exp(x - x.max(axis=1, keepdims=True))
+        return x / x.sum(axis=1, keepdims=True)
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Keras engine. The saved TensorFlow model with the tokenizer and label encoder fitted on chatschema.json
+#-------------------------------------------------------------------------------------------------------------------------
+class kerasEngine(object):
+
+    def __init__(self, modelpath, chatpath):
+        from sklearn.preprocessing import LabelEncoder
+        from tensorflow.keras.preprocessing.text import Tokenizer
+        from tensorflow.keras.models import load_model
+        self.model = load_model(modelpath)
+        with open(chatpath) as file:
+            chatdata = json.load(file)
+
+        training_sentences = []
+        training_labels = []
+        for intent in chatdata['intents']:
+            for pattern in intent['patterns']:
+                training_sentences.append(pattern)
+                training_labels.append(intent['tag'])
+
+        # encode our list of tags
+        self.encoder = LabelEncoder()
+        self.encoder.fit(training_labels)
+        self.classes = [str(c) for c in self.encoder.classes_]
+
+        self.tokenizer = Tokenizer(num_words=vocabSize, oov_token=oovToken)
+        self.tokenizer.fit_on_texts(training_sentences)
+
+
+    # Probability of each class for a list of sentences, shape (N, classes)
+    # ----------------------------------------------------------------------------------
+    def predict(self, texts):
+        from tensorflow.keras.preprocessing.sequence import pad_sequences
+        padded = pad_sequences(self.tokenizer.texts_to_sequences(texts), truncating='post', maxlen=maxLen)
+        return self.model.predict(padded)
+
+
+
+# Load the engine chosen by the chatEngine setting
+#---------------------------------------------------------------------------
+def loadEngine(ENVIRON):
+    chatdir = os.path.join(ENVIRON["topdir"], 'static/MLModels/chatbot')
+    if ENVIRON.get("chatEngine", "keras") == "numpy":
+        return numpyEngine(os.path.join(chatdir, 'chatbot.npz'))
+    return kerasEngine(chatdir, os.path.join(chatdir, 'chatschema.json'))
+
+
+
+# Text with case, punctuation and extra spaces removed, as used for the cache and pattern table.
+# With near=True filler words and apostrophes are dropped too (eg. "Hey, what's your job?")
+#---------------------------------------------------------------------------
+def normalise(text, near=False):
+    text = text.lower().translate(str.maketrans(filters, ' ' * len(filters)))
+    words = text.split()
+    if near:
+        words = [w.replace("'", "") for w in words if w not in fillerWords]
+    return ' '.join(words)
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Intent lookup used by brain_voice. Answers from the chatschema.json patterns or a cache of
+# recent sentences where it can, and only runs the model for sentences it has not seen
+#-------------------------------------------------------------------------------------------------------------------------
+class intentModel(object):
+
+    def __init__(self, ENVIRON, logger):
+        self.ENVIRON = ENVIRON
+        self.logger = logger
+        chatdir = os.path.join(ENVIRON["topdir"], 'static/MLModels/chatbot')
+        self.chatpath = os.path.join(chatdir, 'chatschema.json')
+        self.modelpaths = [os.path.join(chatdir, 'chatbot.npz'), os.path.join(chatdir, 'saved_model.pb'),
+                           os.path.join(chatdir, 'variables/variables.index')]
+        self.cache = collections.OrderedDict()
+        self.stats = {"pattern": 0, "hit": 0, "miss": 0}
+        self.stamp = None
+        self.lastCheck = 0
+        self.reload()
+
+
+    # modified times of the schema and model files, or None if missing
+    # ----------------------------------------------------------------------------------
+    def fileStamp(self):
+        stamp = []
+        for path in [self.chatpath] + self.modelpaths:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+
+    # Load the schema and model, build the pattern table and empty the cache
+    # ----------------------------------------------------------------------------------
+    def reload(self):
+        self.stamp = self.fileStamp()
+        self.lastCheck = time.time()
+        with open(self.chatpath) as file:
+            self.chatdata = json.load(file)
+        self.engine = loadEngine(self.ENVIRON)
+
+        # patterns that belong to more than one intent are left for the model to decide
+        patterns = {}
+        for intent in self.chatdata['intents']:
+            for pattern in intent['patterns']:
+                for key in [normalise(pattern), normalise(pattern, near=True)]:
+                    if patterns.get(key, intent['tag']) != intent['tag']:
+                        patterns[key] = None
+                    else:
+                        patterns[key] = intent['tag']
+        self.patterns = {key: tag for key, tag in patterns.items() if key and tag is not None}
+        self.cache.clear()
+
+
+    # Reload if the model or schema has changed since they were loaded
+    # ----------------------------------------------------------------------------------
+    def checkReload(self):
+        now = time.time()
+        if now - self.lastCheck < checkEvery:
+            return
+        self.lastCheck = now
+        if self.fileStamp() != self.stamp:
+            self.logger.debug('Chat bot model or schema has changed. Reloading')
+            self.reload()
+
+
+    # The intent tag for a sentence and the probability given to it. A pattern match counts as 1.0
+    # ----------------------------------------------------------------------------------
+    def predict(self, text):
+        self.checkReload()
+        key = normalise(text)
+        tag = self.patterns.get(key) or self.patterns.get(normalise(text, near=True))
+        if tag is not None:
+            self.stats["pattern"] += 1
+            result = (tag, 1.0)
+        elif key in self.cache:
+            self.stats["hit"] += 1
+            self.cache.move_to_end(key)
+            result = self.cache[key]
+        else:
+            self.stats["miss"] += 1
+            predictions = self.engine.predict([text])[0]
+            best = int(np.argmax(predictions))
+            result = (self.engine.classes[best], float(predictions[best]))
+            self.cache[key] = result
+            if len(self.cache) > cacheSize:
+                self.cache.popitem(last=False)
+        if sum(self.stats.values()) % statsEvery == 0:
+            self.logger.debug(self.statsText())
+        return result
+
+
+    def statsText(self):
+        total = max(sum(self.stats.values()), 1)
+        return ('Intent lookups: %d pattern matches, %d cache hits, %d model runs (%.0f%% answered without the model)' %
+                (self.stats["pattern"], self.stats["hit"], self.stats["miss"],
+                 (self.stats["pattern"] + self.stats["hit"]) * 100.0 / total))
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Event store for the results of motion frames analysed by brain_motion
+Each analysed frame is an event (client, time, object counts and the history image if one was
+kept), with one detection row per object or face found (label, confidence and box). They are
+appended to static/db/events.db, a SQLite database in WAL mode, by a background thread that
+inserts them in batches. Detections are indexed on (label, time) and (client, time), so questions
+such as "all person detections at FrontGate yesterday" or "when was Alice last seen" are
+answered from the index without looking at the image folders.
+Run this module to benchmark it with a million synthetic events.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import threading
+import logging
+import sqlite3
+import queue
+import json
+import time
+import os
+from datetime import datetime
+
+maxQueue = 10000                # events waiting to be written before the oldest are dropped
+batchSize = 1000                # most events written in one transaction
+flushEvery = 1                  # seconds to collect events for a batch
+
+_stores = {}
+_lock = threading.Lock()
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    client TEXT NOT NULL,
+    ts REAL NOT NULL,
+    counts TEXT,
+    image TEXT);
+CREATE INDEX IF NOT EXISTS events_client_ts ON events (client, ts);
+CREATE TABLE IF NOT EXISTS detections (
+    eventId INTEGER NOT NULL,
+    client TEXT NOT NULL,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    label TEXT NOT NULL,
+    confidence REAL,
+    x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER);
+CREATE INDEX IF NOT EXISTS detections_label_ts ON detections (label, ts);
+CREATE INDEX IF NOT EXISTS detections_client_ts ON detections (client, ts);
+"""
+
+
+# Seconds since the epoch from a datetime or a number (None is left as None)
+#---------------------------------------------------------------------------
+def toTime(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return value
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Event store
+#-------------------------------------------------------------------------------------------------------------------------
+class eventStore(object):
+
+    def __init__(self, path):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("brain_events")
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        self.path = path
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.dropped = 0
+        self.written = 0
+        self.local = threading.local()
+        self.thread = None
+        self.threadLock = threading.Lock()
+
+        conn = self.connection()
+        conn.executescript(schema)
+        conn.commit()
+
+
+    # A connection for the calling thread. SQLite connections can not be shared between threads
+    # ----------------------------------------------------------------------------------
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+
+    # Queue the result of an analysed frame. detected is the result sent to the client by
+    # brain_motion, and image the history image kept for it (if any). With wait=False a full
+    # queue drops the oldest event rather than holding up the caller
+    # ----------------------------------------------------------------------------------
+    def record(self, client, ts, detected, image=None, wait=False):
+        with self.threadLock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="eventStore", daemon=True)
+                self.thread.start()
+        item = (client, ts, detected, image)
+        if wait:
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    self.logger.warning('Event store is falling behind. Dropped an event')
+                except queue.Empty:
+                    pass
+
+
+    # Block until every queued event has been written
+    # ----------------------------------------------------------------------------------
+    def flush(self):
+        self.queue.join()
+
+
+    # Writer thread main loop. Collects events for up to flushEvery seconds and writes them together
+    # ----------------------------------------------------------------------------------
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            closeAt = time.perf_counter() + flushEvery
+            while len(batch) < batchSize:
+                remaining = closeAt - time.perf_counter()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.logger.error('Error writing %d events. %s' % (len(batch), str(e)))
+            for item in batch:
+                self.queue.task_done()
+
+
+    # Insert a batch of events and their detections in one transaction
+    # ----------------------------------------------------------------------------------
+    def write(self, batch):
+        conn = self.connection()
+        rows = []
+        with conn:
+            for client, ts, detected, image in batch:
+                counts = {k: v for k, v in detected.items() if isinstance(v, int)}
+                cur = conn.execute("INSERT INTO events (client, ts, counts, image) VALUES (?, ?, ?, ?)",
+                                   (client, ts, json.dumps(counts), image))
+                eventId = cur.lastrowid
+                for obj in detected.get("objects", []):
+                    rows.append((eventId, client, ts, 'object', obj["label"], obj["confidence"]) + tuple(obj["box"]))
+                for face in detected.get("faceDetail", []):
+                    rows.append((eventId, client, ts, 'face', face.get("name", "unknown"), face.get("probability")) + tuple(face["box"]))
+            conn.executemany("INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.written += len(batch)
+
+
+    # Detections matching all the given filters, newest first. start and end are datetimes or
+    # seconds since the epoch. Each is a dict with the event's client, time and image
+    # ----------------------------------------------------------------------------------
+    def query(self, label=None, client=None, start=None, end=None, kind=None, limit=100):
+        where = []
+        args = []
+        for column, op, value in [("d.label", "=", label), ("d.client", "=", client), ("d.kind", "=", kind),
+                                  ("d.ts", ">=", toTime(start)), ("d.ts", "<", toTime(end))]:
+            if value is not None:
+                where.append("%s %s ?" % (column, op))
+                args.append(value)
+        sql = ("SELECT d.client, d.ts, d.kind, d.label, d.confidence, d.x1, d.y1, d.x2, d.y2, e.image "
+               "FROM detections d JOIN events e ON e.id = d.eventId")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY d.ts DESC LIMIT ?"
+        args.append(limit)
+        return [{"client": r["client"], "time": r["ts"], "kind": r["kind"], "label": r["label"],
+                 "confidence": r["confidence"], "box": [r["x1"], r["y1"], r["x2"], r["y2"]], "image": r["image"]}
+                for r in self.connection().execute(sql, args)]
+
+
+    # The latest detection of a label (eg. "person" or a person's name), or None if never seen
+    # ----------------------------------------------------------------------------------
+    def lastSeen(self, label, client=None):
+        found = self.query(label=label, client=client, limit=1)
+        return found[0] if found else None
+
+
+
+#---------------------------------------------------------------------------
+# Return the event store for this process, creating it on first use.
+# Processes started with multiprocessing each get their own store.
+#---------------------------------------------------------------------------
+def getEvents(ENVIRON):
+    pid = os.getpid()
+    with _lock:
+        if pid not in _stores:
+            _stores[pid] = eventStore(os.path.join(ENVIRON["topdir"], 'static/db/events.db'))
+        return _stores[pid]
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own.
+# Writes a million synthetic events to a temporary database, then times some queries
+# **************************************************************************
+if __name__ == "__main__":
+    import tempfile
+    import random
+    from datetime import timedelta
+
+    events = 1000000
+    clients = ['FrontGate', 'FrontDoor', 'BackYard', 'Garage']
+    objects = ['person', 'person', 'person', 'car', 'dog', 'cat', 'bicycle']
+    names = ['Alice', 'Bob', 'Carol', 'unknown']
+    now = time.time()
+    days = 30
+
+    path = os.path.join(tempfile.mkdtemp(), 'events.db')
+    store = eventStore(path)
+    store.logger.level = logging.INFO
+    random.seed(1)
+    startTime = time.perf_counter()
+    # events arrive in time order, spread over the last 30 days
+    for i in range(events):
+        ts = now - days * 86400 * (1 - i / float(events))
+        detected = {"faces": [], "faceDetail": [], "objects": []}
+        for n in range(random.randint(0, 3)):
+            label = random.choice(objects)
+            detected[label] = detected.get(label, 0) + 1
+            detected["objects"].append({"label": label, "confidence": round(random.uniform(.5, 1), 3), "box": [10, 20, 110, 220]})
+            if label == 'person' and random.random() < .3:
+                name = random.choice(names)
+                detected["faces"].append(name)
+                detected["faceDetail"].append({"box": [30, 30, 60, 70], "name": name, "probability": round(random.uniform(.5, 1), 3)})
+        store.record(random.choice(clients), ts, detected, wait=True)
+    store.flush()
+    elapsed = time.perf_counter() - startTime
+    rows = store.connection().execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+    print("%d events (%d detections) written in %.1fs, %.0f events/sec, database %.0fMB" %
+          (store.written, rows, elapsed, store.written / elapsed, os.path.getsize(path) / 1048576.0))
+
+    def timeIt(name, fn, repeats=20):
+        fn()
+        startTime = time.perf_counter()
+        for i in range(repeats):
+            result = fn()
+        print("%-45s %7.2fms  (%d results)" % (name, (time.perf_counter() - startTime) / repeats * 1000,
+                                               len(result) if isinstance(result, list) else int(result is not None)))
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    yesterday = today - timedelta(days=1)
+    timeIt("person at FrontGate yesterday (first 1000)",
+           lambda: store.query(label='person', client='FrontGate', start=yesterday, end=today, limit=1000))
+    timeIt("when was Alice last seen", lambda: store.lastSeen('Alice'))
+    timeIt("when was Bob last seen at Garage", lambda: store.lastSeen('Bob', client='Garage'))
+    timeIt("latest 100 detections at BackYard", lambda: store.query(client='BackYard'))
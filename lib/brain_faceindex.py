@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Nearest neighbour face index. An alternative to the pickled SVC recognizer in brain_motion.
+Keeps the 128-d OpenFace embeddings of known faces in one contiguous float32 array and
+matches new faces by cosine similarity. Faces below the similarity threshold are 'unknown'.
+Adding a person is an append to the array, so no retraining is needed.
+The source image of each face is kept so a saved index can still be updated by enrol_faces.py.
+Faces added while the brain is running have no source image (path null in names.json).
+The index reloads itself when the files it was loaded from change, eg. after enrol_faces.py has
+run. Faces added at runtime without saving them are lost when that happens.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import pickle
+import json
+import time
+import os
+import numpy as np
+
+vectorSize = 128
+checkEvery = 2                  # seconds between checks of the embeddings files for changes
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Face index class
+#-------------------------------------------------------------------------------------------------------------------------
+class faceIndex(object):
+
+    def __init__(self, threshold=0.7, capacity=64):
+        self.threshold = threshold
+        self.vectors = np.empty((capacity, vectorSize), dtype=np.float32)
+        self.count = 0
+        self.names = []
+        self.paths = []                 # source image of each face, None if added at runtime
+        self.path = None
+        self.stamp = None
+        self.lastCheck = 0
+
+
+    # Load the embeddings written by extract_embeddings.py (pickle), or by enrol_faces.py
+    # (.npy with a names.json file alongside it)
+    # ----------------------------------------------------------------------------------
+    def load(self, path):
+        self.path = path
+        self.stamp = self.fileStamp()
+        self.lastCheck = time.time()
+        if path.endswith(".npy"):
+            vecs = np.load(path, mmap_mode="r")
+            rows = json.load(open(os.path.join(os.path.dirname(path), "names.json")))
+            self.addMany([row["name"] for row in rows], vecs, [row.get("path") for row in rows])
+        else:
+            data = pickle.loads(open(path, "rb").read())
+            self.addMany(data["names"], data["embeddings"])
+        return self
+
+
+    # modified times of the files the index was loaded from, or None if missing
+    # ----------------------------------------------------------------------------------
+    def fileStamp(self):
+        stamp = []
+        paths = [self.path]
+        if self.path.endswith(".npy"):
+            paths.append(os.path.join(os.path.dirname(self.path), "names.json"))
+        for path in paths:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+
+    # Load the index again if its files have changed since they were loaded
+    # ----------------------------------------------------------------------------------
+    def checkReload(self):
+        now = time.time()
+        if self.path is None or now - self.lastCheck < checkEvery:
+            return
+        self.lastCheck = now
+        if self.fileStamp() != self.stamp:
+            fresh = faceIndex(self.threshold, max(len(self.vectors), 1)).load(self.path)
+            self.vectors, self.count, self.names, self.paths = fresh.vectors, fresh.count, fresh.names, fresh.paths
+            self.stamp = fresh.stamp
+
+
+    # Add a single face. The array doubles in size when full, so this is O(1) on average
+    # ----------------------------------------------------------------------------------
+    def add(self, name, vec, path=None):
+        self.addMany([name], [vec], [path])
+
+
+    # Add a list of faces in one go, with the source image of each if known
+    # ----------------------------------------------------------------------------------
+    def addMany(self, names, vecs, paths=None):
+        vecs = normalise(np.asarray(vecs, dtype=np.float32).reshape(-1, vectorSize))
+        needed = self.count + len(vecs)
+        if needed > len(self.vectors):
+            grown = np.empty((max(needed, len(self.vectors) * 2), vectorSize), dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+        self.vectors[self.count:needed] = vecs
+        self.count = needed
+        self.names.extend([str(name) for name in names])
+        self.paths.extend(paths if paths is not None else [None] * len(vecs))
+
+
+    # Match an (N, 128) array of embeddings. Returns the names and similarity scores.
+    # Faces with no known face above the threshold are named 'unknown'
+    # ----------------------------------------------------------------------------------
+    def match(self, vecs):
+        self.checkReload()
+        vecs = normalise(np.asarray(vecs, dtype=np.float32).reshape(-1, vectorSize))
+        if self.count == 0:
+            return ['unknown'] * len(vecs), np.zeros(len(vecs), dtype=np.float32)
+        sims = vecs @ self.vectors[:self.count].T
+        best = np.argmax(sims, axis=1)
+        scores = sims[np.arange(len(best)), best]
+        names = [self.names[j] if score >= self.threshold else 'unknown' for j, score in zip(best, scores)]
+        return names, scores
+
+
+    # Write the index back out in the same format it was loaded from
+    # ----------------------------------------------------------------------------------
+    def save(self, path):
+        if path.endswith(".npy"):
+            np.save(path, self.vectors[:self.count])
+            with open(os.path.join(os.path.dirname(path), "names.json"), "w") as f:
+                json.dump([{"name": name, "path": path} for name, path in zip(self.names, self.paths)], f)
+        else:
+            data = {"embeddings": list(self.vectors[:self.count]), "names": self.names}
+            with open(path, "wb") as f:
+                f.write(pickle.dumps(data))
+        if path == self.path:
+            self.stamp = self.fileStamp()
+
+
+
+# Scale each row to unit length so a dot product gives cosine similarity
+#---------------------------------------------------------------------------
+def normalise(vecs):
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.maximum(norms, 1e-12)
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own.
+# Compares match latency and accuracy of the index against the SVC used by
+# train_model.py, holding back every 5th embedding as the test set
+# **************************************************************************
+if __name__ == "__main__":
+    from sklearn.preprocessing import LabelEncoder
+    from sklearn.svm import SVC
+
+    topdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    path = os.path.join(topdir, 'static/MLModels/faceid/output/embeddings.pickle')
+    data = pickle.loads(open(path, "rb").read())
+    vecs = np.asarray(data["embeddings"], dtype=np.float32)
+    names = np.asarray(data["names"])
+    test = np.arange(len(vecs)) % 5 == 0
+    print("%d embeddings, %d people, %d held back for testing" % (len(vecs), len(set(names)), test.sum()))
+
+    le = LabelEncoder()
+    labels = le.fit_transform(names[~test])
+    startTime = time.perf_counter()
+    svc = SVC(C=1.0, kernel="linear", probability=True).fit(vecs[~test], labels)
+    print("SVC   train %.1fms" % ((time.perf_counter() - startTime) * 1000))
+
+    index = faceIndex()
+    startTime = time.perf_counter()
+    index.addMany(names[~test], vecs[~test])
+    print("Index build %.1fms" % ((time.perf_counter() - startTime) * 1000))
+
+    def timeIt(fn, repeats=200):
+        startTime = time.perf_counter()
+        for i in range(repeats):
+            fn()
+        return (time.perf_counter() - startTime) / repeats * 1000
+
+    svcNames = le.classes_[np.argmax(svc.predict_proba(vecs[test]), axis=1)]
+    indexNames = np.asarray(index.match(vecs[test])[0])
+    print("SVC   accuracy %.1f%%, one face %.3fms, whole test set %.3fms" % (
+        np.mean(svcNames == names[test]) * 100,
+        timeIt(lambda: svc.predict_proba(vecs[test][:1])), timeIt(lambda: svc.predict_proba(vecs[test]))))
+    print("Index accuracy %.1f%% (%d unknown), one face %.3fms, whole test set %.3fms" % (
+        np.mean(indexNames == names[test]) * 100, np.sum(indexNames == 'unknown'),
+        timeIt(lambda: index.match(vecs[test][:1])), timeIt(lambda: index.match(vecs[test]))))
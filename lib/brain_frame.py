@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Frame pipeline used by brain_motion. Decodes an image once and lazily caches the resized
+copies and DNN blobs derived from it, so every analysis stage can share them.
+Each stage can be timed, and the timings written to the debug log per frame.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import time
+import cv2
+import numpy as np
+import imutils
+from contextlib import contextmanager
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Frame pipeline. One object per received image
+#-------------------------------------------------------------------------------------------------------------------------
+class framePipeline(object):
+
+    def __init__(self, imgbin, meta=None):
+        self.imgbin = imgbin
+        self.meta = meta or {}
+        self.image = None
+        self.cache = {}
+        self.timings = []
+
+
+    # The decoded image. Only decoded the first time it is asked for
+    # ----------------------------------------------------------------------------------
+    @property
+    def frame(self):
+        if self.image is None:
+            with self.stage('decode'):
+                self.image = cv2.imdecode(np.frombuffer(self.imgbin, np.uint8), -1)
+        return self.image
+
+
+    # Copy of the frame resized to a given width (maintaining aspect ratio)
+    # ----------------------------------------------------------------------------------
+    def resized(self, width):
+        key = ('width', width)
+        if key not in self.cache:
+            self.cache[key] = imutils.resize(self.frame, width=width)
+        return self.cache[key]
+
+
+    # Copy of the frame squashed to size x size, as used by the SSD models
+    # ----------------------------------------------------------------------------------
+    def square(self, size):
+        key = ('square', size)
+        if key not in self.cache:
+            self.cache[key] = cv2.resize(self.frame, (size, size))
+        return self.cache[key]
+
+
+    # DNN blob built by the supplied function the first time a stage asks for it
+    # ----------------------------------------------------------------------------------
+    def blob(self, name, build):
+        key = ('blob', name)
+        if key not in self.cache:
+            self.cache[key] = build(self)
+        return self.cache[key]
+
+
+    # Time a block of work and record it against the stage name
+    # ----------------------------------------------------------------------------------
+    @contextmanager
+    def stage(self, name):
+        startTime = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.timings.append((name, (time.perf_counter() - startTime) * 1000))
+
+
+    # Summary of the stage timings, eg. "decode 3.1ms, objects 41.0ms, total 44.1ms"
+    # ----------------------------------------------------------------------------------
+    def timingText(self):
+        text = ', '.join(['%s %.1fms' % (name, ms) for name, ms in self.timings])
+        total = sum([ms for name, ms in self.timings])
+        return text + ', total %.1fms' % total
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Image store for static/motionImages, used by robotAI_brain, brain_workers and brain_motion
+Images are written by a background thread from a bounded queue, so handling a message never
+waits on the disk. Each file is written to a temporary name and renamed into place, so the web
+view (camFeeds) never reads a half written JPEG.
+  static/motionImages/<client>.jpg      - the latest image from each client
+  static/motionImages/<client>/*.jpg    - history of motion images, if keepMotionImages is set
+The history is kept within imageMaxDays and imageMaxMB per client, oldest images first. The
+files in each client folder are tracked in memory as they are added and removed. Brain worker
+processes each have their own store writing to the same folders, so a folder is listed again
+whenever its modified time shows another process has changed it, and on every periodic prune.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import collections
+import threading
+import logging
+import queue
+import time
+import os
+from datetime import datetime
+
+maxQueue = 50                   # images waiting to be written before the oldest are dropped
+pruneEvery = 60                 # how often (seconds) to remove history images that are too old
+
+_stores = {}
+_lock = threading.Lock()
+
+
+# Write a file to a temporary name, then rename it into place
+#---------------------------------------------------------------------------
+def writeAtomic(path, data):
+    tmppath = path + '.%d.tmp' % os.getpid()
+    with open(tmppath, 'wb') as f:
+        f.write(data)
+    os.replace(tmppath, path)
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Image store
+#-------------------------------------------------------------------------------------------------------------------------
+class imageStore(object):
+
+    def __init__(self, ENVIRON):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("brain_imagestore")
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        self.imagedir = os.path.join(ENVIRON["topdir"], 'static/motionImages')
+        self.keep = ENVIRON.get("keepImages", "False")
+        self.maxAge = float(ENVIRON.get("imageMaxDays", "7")) * 86400
+        self.maxBytes = float(ENVIRON.get("imageMaxMB", "500")) * 1048576
+        self.queue = queue.Queue(maxsize=maxQueue)
+        self.dropped = 0
+        self.index = {}                 # client -> OrderedDict of file name -> (time, size), oldest first
+        self.bytes = {}                 # client -> bytes of history kept
+        self.folderTimes = {}           # client -> modified time of the folder after our last change to it
+        self.lastPrune = time.time()
+        self.thread = None
+        self.threadLock = threading.Lock()
+
+
+    # Save the latest image from a client
+    # ----------------------------------------------------------------------------------
+    def latest(self, client, imgbin):
+        self.put((client, None, imgbin))
+
+
+    # Add an image to a client's history, if keepMotionImages says it should be kept.
+    # Returns the path of the image relative to static/motionImages, or None if not kept
+    # ----------------------------------------------------------------------------------
+    def keepFrame(self, client, imgbin, detected=True):
+        if self.keep == "True" or (self.keep == "detections" and detected):
+            name = datetime.now().strftime("%Y%m%d%H%M%S_%f") + '.jpg'
+            self.put((client, name, imgbin))
+            return client + '/' + name
+        return None
+
+
+    # Queue a write, dropping the oldest waiting write if the queue is full
+    # ----------------------------------------------------------------------------------
+    def put(self, item):
+        with self.threadLock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="imageStore", daemon=True)
+                self.thread.start()
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    self.logger.warning('Image store is falling behind. Dropped an image')
+                except queue.Empty:
+                    pass
+
+
+    # Writer thread main loop
+    # ----------------------------------------------------------------------------------
+    def run(self):
+        # list the history folders that already exist, so old images are removed from them too
+        try:
+            for entry in os.scandir(self.imagedir):
+                if entry.is_dir():
+                    self.pruneFolder(entry.name)
+        except Exception as e:
+            self.logger.error('Error listing the motion image folders. ' + str(e))
+        while True:
+            try:
+                client, name, imgbin = self.queue.get(timeout=pruneEvery)
+                if name is None:
+                    writeAtomic(os.path.join(self.imagedir, client + '.jpg'), imgbin)
+                else:
+                    self.addHistory(client, name, imgbin)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                self.logger.error('Error writing image. ' + str(e))
+            if time.time() - self.lastPrune >= pruneEvery:
+                self.lastPrune = time.time()
+                for client in list(self.index.keys()):
+                    try:
+                        self.pruneFolder(client)
+                    except Exception as e:
+                        self.logger.error('Error removing old images for ' + client + '. ' + str(e))
+
+
+    # List a client's history folder the first time it is needed, or again if rescan is set
+    # ----------------------------------------------------------------------------------
+    def clientIndex(self, client, rescan=False):
+        if rescan or client not in self.index:
+            folder = os.path.join(self.imagedir, client)
+            os.makedirs(folder, exist_ok=True)
+            files = []
+            for entry in os.scandir(folder):
+                if entry.is_file():
+                    if entry.name.endswith('.tmp'):
+                        # left behind by a write that was interrupted (newer ones may still be in progress)
+                        if entry.stat().st_mtime < time.time() - pruneEvery:
+                            os.remove(entry.path)
+                    elif entry.name.endswith('.jpg'):
+                        st = entry.stat()
+                        files.append((st.st_mtime, entry.name, st.st_size))
+            self.index[client] = collections.OrderedDict((name, (mtime, size)) for mtime, name, size in sorted(files))
+            self.bytes[client] = sum(size for mtime, name, size in files)
+        return self.index[client]
+
+
+    # Modified time of a client's history folder, which changes whenever a file is added or removed
+    # ----------------------------------------------------------------------------------
+    def folderTime(self, client):
+        return os.stat(os.path.join(self.imagedir, client)).st_mtime_ns
+
+
+    # Write a history image and remove old ones if the client is over its limits. The folder is
+    # listed again first if another process has changed it since we last did
+    # ----------------------------------------------------------------------------------
+    def addHistory(self, client, name, imgbin):
+        files = self.clientIndex(client)
+        if self.folderTimes.get(client) != self.folderTime(client):
+            files = self.clientIndex(client, rescan=True)
+        writeAtomic(os.path.join(self.imagedir, client, name), imgbin)
+        files[name] = (time.time(), len(imgbin))
+        self.bytes[client] += len(imgbin)
+        self.prune(client)
+        self.folderTimes[client] = self.folderTime(client)
+
+
+    # List a client's folder again, so images written by other processes are counted, then prune it
+    # ----------------------------------------------------------------------------------
+    def pruneFolder(self, client):
+        self.clientIndex(client, rescan=True)
+        self.prune(client)
+        self.folderTimes[client] = self.folderTime(client)
+
+
+    # Remove a client's oldest history images while they are too old or over the size limit
+    # ----------------------------------------------------------------------------------
+    def prune(self, client):
+        files = self.index[client]
+        oldest = time.time() - self.maxAge
+        while files:
+            name, (mtime, size) = next(iter(files.items()))
+            if mtime >= oldest and self.bytes[client] <= self.maxBytes:
+                break
+            files.popitem(last=False)
+            self.bytes[client] -= size
+            try:
+                os.remove(os.path.join(self.imagedir, client, name))
+            except OSError:
+                pass
+
+
+
+#---------------------------------------------------------------------------
+# Return the image store for this process, creating it on first use.
+# Processes started with multiprocessing each get their own store.
+#---------------------------------------------------------------------------
+def getStore(ENVIRON):
+    pid = os.getpid()
+    with _lock:
+        if pid not in _stores:
+            _stores[pid] = imageStore(ENVIRON)
+        return _stores[pid]
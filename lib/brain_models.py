@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Staged loading of the ML models used by robotAI_brain
+Each model (eg. 'motion', 'voice') gets a handler thread that loads it in the background, then
+works through the messages for that model in the order they arrived. Messages that arrive
+while a model is loading are held until it is ready, so the queue consumer and the cheap
+handlers (camera, connect, button) can start straight away. Models are loaded one at a time,
+in the order they were registered, unless they are listed in lazyModels, in which case they
+load when the first message for them arrives.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import logging
+import threading
+import queue
+import time
+
+maxPending = 50                 # messages held for each model before the oldest are dropped
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Handler for a single model
+#-------------------------------------------------------------------------------------------------------------------------
+class modelHandler(object):
+
+    def __init__(self, name, loader, loadLock, logger, lazy=False):
+        self.name = name
+        self.loader = loader
+        self.loadLock = loadLock
+        self.logger = logger
+        self.lazy = lazy
+        self.state = 'waiting'
+        self.loadTime = None
+        self.model = None
+        self.inbox = queue.Queue(maxsize=maxPending)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="model_" + name, daemon=True)
+
+
+    # Queue some work for this model. fn is called with the loaded model
+    # ----------------------------------------------------------------------------------
+    def submit(self, fn):
+        while True:
+            try:
+                self.inbox.put_nowait(fn)
+                return
+            except queue.Full:
+                try:
+                    self.inbox.get_nowait()
+                    self.dropped += 1
+                    self.logger.warning('Too many messages waiting for the ' + self.name + ' model. Dropped oldest message')
+                except queue.Empty:
+                    pass
+
+
+    # Load the model, holding the shared lock so only one model loads at a time
+    # ----------------------------------------------------------------------------------
+    def load(self):
+        with self.loadLock:
+            self.state = 'loading'
+            self.logger.debug('Loading the ' + self.name + ' model')
+            startTime = time.perf_counter()
+            try:
+                self.model = self.loader()
+                self.state = 'ready'
+            except Exception as e:
+                self.state = 'failed'
+                self.logger.error('Failed to load the ' + self.name + ' model. ' + str(e))
+            self.loadTime = time.perf_counter() - startTime
+        if self.state == 'ready':
+            self.logger.info('The %s model is ready. Loaded in %.1f seconds with %d message(s) waiting' %
+                             (self.name, self.loadTime, self.inbox.qsize()))
+
+
+    # Thread main loop. Load the model (straight away, or when the first message arrives if lazy)
+    # then handle each message in turn
+    # ----------------------------------------------------------------------------------
+    def run(self):
+        first = None
+        if self.lazy:
+            first = self.inbox.get()
+        self.load()
+        while True:
+            fn = first if first is not None else self.inbox.get()
+            first = None
+            if self.state != 'ready':
+                self.logger.error('Discarding message as the ' + self.name + ' model failed to load')
+                continue
+            try:
+                fn(self.model)
+            except Exception as e:
+                self.logger.error('Error handling message for the ' + self.name + ' model. ' + str(e))
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Registry of all models in the brain process
+#-------------------------------------------------------------------------------------------------------------------------
+class modelRegistry(object):
+
+    def __init__(self, lazyModels=()):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("brain_models")
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        self.lazyModels = [name.strip() for name in lazyModels if name.strip()]
+        self.loadLock = threading.Lock()
+        self.handlers = {}
+
+
+    # Add a model. loader is a function that returns the loaded model
+    # ----------------------------------------------------------------------------------
+    def register(self, name, loader):
+        self.handlers[name] = modelHandler(name, loader, self.loadLock, self.logger, lazy=name in self.lazyModels)
+
+
+    # Start every handler thread. Eager models queue for the load lock in registration order
+    # ----------------------------------------------------------------------------------
+    def start(self):
+        for handler in self.handlers.values():
+            handler.thread.start()
+            # give each thread the chance to take the lock before the next one starts
+            time.sleep(.01)
+
+
+    # Queue some work for a model, called with the model once it is ready
+    # ----------------------------------------------------------------------------------
+    def submit(self, name, fn):
+        self.handlers[name].submit(fn)
+
+
+    # The loaded model, or None if it is not ready yet
+    # ----------------------------------------------------------------------------------
+    def get(self, name):
+        handler = self.handlers[name]
+        if handler.state == 'ready':
+            return handler.model
+        return None
+
+
+    # State, load time and number of waiting messages for each model
+    # ----------------------------------------------------------------------------------
+    def status(self):
+        return {name: {"state": h.state, "loadTime": h.loadTime, "pending": h.inbox.qsize(), "dropped": h.dropped}
+                for name, h in self.handlers.items()}
+
+
+    def statusText(self):
+        text = []
+        for name, s in self.status().items():
+            loadTime = '' if s["loadTime"] is None else ' in %.1fs' % s["loadTime"]
+            text.append('%s %s%s (%d waiting)' % (name, s["state"], loadTime, s["pending"]))
+        return 'Models: ' + ', '.join(text)
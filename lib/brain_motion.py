@@ -10,11 +10,18 @@ import cv2
 import os
 import numpy as np
 import json
-import base64
-import pika
-from datetime import datetime
+import time
 import pickle
-import imutils
+
+# import the shared message queue publisher
+import lib.common_queue as common_queue
+import lib.common_image as common_image
+from lib.brain_frame import framePipeline
+import lib.common_detect as common_detect
+from lib.brain_faceindex import faceIndex
+from lib.brain_admission import admissionControl
+import lib.brain_imagestore as brain_imagestore
+import lib.brain_events as brain_events
 
 #-------------------------------------------------------------------------------------------------------------------------
 # Object Detection detector
@@ -42,151 +49,270 @@ class detectorAPI:
                 "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
         self.obj_net = cv2.dnn.readNetFromCaffe(obj_proto_path, obj_model_path)
         self.obj_conf_cutoff = 0.5
+        self.personId = self.CLASSES.index("person")
+
+        # optional list of class names to keep, and overlap threshold for class-wise NMS (0 turns it off)
+        allowed = [c.strip() for c in ENVIRON.get("objectClasses", "").split(",") if c.strip() in self.CLASSES]
+        self.obj_allowed = [self.CLASSES.index(c) for c in allowed] or None
+        self.obj_nms = float(ENVIRON.get("objectNMS", "0")) or None
 
         # parameters for face identification model
         modelPath = os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/res10_300x300_ssd_iter_140000.caffemodel")
         protoPath = os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/deploy.prototxt")
         self.face_detector = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
         self.face_embedder = cv2.dnn.readNetFromTorch(os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/openface_nn4.small2.v1.t7"))
-        self.face_recognizer = pickle.loads(open(os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/output/recognizer.pickle"), "rb").read())
-        self.face_labels = pickle.loads(open(os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/output/le.pickle"), "rb").read())
         self.face_conf_cutoff = 0.5
+        self.face_match_cutoff = float(ENVIRON.get("faceMatchCutoff", "0.5"))
+
+        # recognise faces with either the trained SVC, or the nearest neighbour index of known embeddings
+        self.face_backend = ENVIRON.get("faceBackend", "svc")
+        if self.face_backend == "index":
+            self.face_index = faceIndex(float(ENVIRON.get("faceIndexCutoff", "0.7")))
+            self.face_index_path = os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/output/embeddings.npy")
+            if not os.path.exists(self.face_index_path):
+                self.face_index_path = os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/output/embeddings.pickle")
+            self.face_index.load(self.face_index_path)
+        else:
+            self.face_recognizer = pickle.loads(open(os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/output/recognizer.pickle"), "rb").read())
+            self.face_labels = pickle.loads(open(os.path.join(ENVIRON["topdir"], "static/MLModels/faceid/output/le.pickle"), "rb").read())
+
+        # only look for faces inside 'person' boxes, falling back to the full frame if none found there
+        self.faceCascade = ENVIRON.get("faceCascade", "True") == "True"
+        self.faceFallback = ENVIRON.get("faceFallback", "True") == "True"
+        self.roiPadding = 0.1
+
+        # skip frames that repeat the last one analysed for a client, or arrive faster than the rate limit
+        self.admission = admissionControl(int(ENVIRON.get("dedupDistance", "5")), float(ENVIRON.get("maxInferenceRate", "2")))
 
 
     # Send details to the message queue
     # ----------------------------------------------------------------------------------
     def sendMessage(self, reply_to, body):
         try:
-            credentials = pika.PlainCredentials(self.ENVIRON["queueUser"], self.ENVIRON["queuePass"])
-            parameters = pika.ConnectionParameters(self.ENVIRON["queueSrvr"], self.ENVIRON["queuePort"], '/',  credentials)
-            connection = pika.BlockingConnection(parameters)
-            channel1 = connection.channel()
-            channel1.queue_declare(reply_to)
-            properties = pika.BasicProperties(app_id='motion', content_type='application/json', reply_to=self.ENVIRON["brainQueue"])
-            channel1.basic_publish(exchange='', routing_key=reply_to, body=body, properties=properties)
-            connection.close()
+            common_queue.publish(self.ENVIRON, reply_to, body, 'motion', 'application/json', self.ENVIRON["brainQueue"])
         except:
             self.logger.error('There was an error sending the message to the queue')
             return False
         return True
 
 
-    # function to detect objects. Returns a dictionary of objects by count
+    # function to detect objects. Returns a dictionary of objects by count, plus the
+    # detections (class id, confidence and box in frame pixels) as a structured array
     #-----------------------------------------------------------------------
-    def objectCount(self, imgbin):
-        frame = cv2.imdecode(np.frombuffer(imgbin, np.uint8), -1)
-        blob = cv2.dnn.blobFromImage(cv2.resize(frame, (300, 300)), 0.007843, (300, 300), 127.5)
+    def objectCount(self, frame):
+        blob = frame.blob('object', lambda f: cv2.dnn.blobFromImage(f.square(300), 0.007843, (300, 300), 127.5))
         # pass the blob through the network and obtain the detections and predictions
         self.obj_net.setInput(blob)
         self.logger.debug('Running the model for object detections')
         detections = self.obj_net.forward()
+        return self.parseObjects(detections, frame)
+
 
-        # loop over the detections
-        dictObjects = {}
-        for i in np.arange(0, detections.shape[2]):
-            # filter out weak detections by ensuring the `confidence` is greater than the minimum confidence
-            confidence = detections[0, 0, i, 2]
-            if confidence > self.obj_conf_cutoff:
-                # extract the index of the class label from the `detections`
-                idx = int(detections[0, 0, i, 1])
-                className = self.CLASSES[idx]
-                self.logger.debug(className + " detected")
-                #check if there is already an entry in dictionary
-                if className in dictObjects:
-                    dictObjects[className] = dictObjects[className] + 1
-                else:
-                    dictObjects[className] = 1
-        return dictObjects
-
-
-    # function to recognize faces. Returns a list of faces
+    # function to detect objects in several frames with one pass through the network.
+    # Returns a list of (dictObjects, objects), one per frame
     #-----------------------------------------------------------------------
-    def recognizer(self, imgbin):
-        faces = False
-        listFaces = []
-        image = cv2.imdecode(np.frombuffer(imgbin, np.uint8), -1)
-        image = imutils.resize(image, width=600)
-        (h, w) = image.shape[:2]
-        blob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0), swapRB=False, crop=False)
+    def objectCountBatch(self, frames):
+        blob = cv2.dnn.blobFromImages([f.square(300) for f in frames], 0.007843, (300, 300), 127.5)
+        self.obj_net.setInput(blob)
+        self.logger.debug('Running the model for object detections on a batch of %d' % len(frames))
+        detections = self.obj_net.forward()
+        return [self.parseObjects(detections, frame, i) for i, frame in enumerate(frames)]
+
+
+    # Turn the raw SSD detections for one image of a batch into counts by class name, plus a
+    # structured array of class id, confidence and box (see lib/common_detect.py)
+    #-----------------------------------------------------------------------
+    def parseObjects(self, detections, frame, imageId=0):
+        (h, w) = frame.frame.shape[:2]
+        objects = common_detect.parseDetections(detections, self.obj_conf_cutoff, w, h, imageId, self.obj_allowed, self.obj_nms)
+        dictObjects = common_detect.countsDict(objects, self.CLASSES)
+        if dictObjects:
+            self.logger.debug("Detected " + str(dictObjects))
+        return dictObjects, objects
+
+
+    # Run the face detector over a blob. Returns face boxes in image pixels, offset by (offX, offY)
+    #-----------------------------------------------------------------------
+    def faceBoxes(self, blob, offX, offY, w, h):
         self.face_detector.setInput(blob)
         detections = self.face_detector.forward()
-        # loop over the detections
-        for i in range(0, detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
-            if confidence > self.face_conf_cutoff:
-                faces = True
-                self.logger.debug('Found a face. Will try to recognise')
-                # compute the (x, y) coordinates of the face and extract that image as 'face'
-                box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-                (startX, startY, endX, endY) = box.astype("int")
-                face = image[startY:endY, startX:endX]
-                (fH, fW) = face.shape[:2]
-                # ensure the face width and height are sufficiently large
-                if fW < 20 or fH < 20:
-                    self.logger.debug('Face is not big enough to analyse')
-                    continue
-                # construct a blob for the face ROI, then pass the blob through our face model to quantify the face
-                faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True, crop=False)
-                self.face_embedder.setInput(faceBlob)
-                vec = self.face_embedder.forward()
-                # perform classification to recognize the face
-                preds = self.face_recognizer.predict_proba(vec)[0]
-                j = np.argmax(preds)
-                proba = preds[j]
-                name = self.face_labels.classes_[j]
-                # what was the result
-                listFaces.append(name)
-        if not faces:
+        faces = common_detect.parseDetections(detections, self.face_conf_cutoff, w, h)
+        return list(faces["box"] + np.array([offX, offY, offX, offY]))
+
+
+    # Look for faces only inside each person box (padded a little). The ROIs are passed to the
+    # detector at their own size (up to 300px) rather than being scaled up
+    #-----------------------------------------------------------------------
+    def personFaceBoxes(self, frame, image, persons):
+        (h, w) = image.shape[:2]
+        scale = w / float(frame.frame.shape[1])
+        boxes = []
+        for (startX, startY, endX, endY) in persons:
+            padX = int((endX - startX) * self.roiPadding)
+            padY = int((endY - startY) * self.roiPadding)
+            x1 = max(int(startX * scale) - padX, 0)
+            y1 = max(int(startY * scale) - padY, 0)
+            x2 = min(int(endX * scale) + padX, w)
+            y2 = min(int(endY * scale) + padY, h)
+            roi = image[y1:y2, x1:x2]
+            (rH, rW) = roi.shape[:2]
+            if rW < 20 or rH < 20:
+                continue
+            ratio = min(300.0 / max(rW, rH), 1.0)
+            size = (max(int(rW * ratio), 1), max(int(rH * ratio), 1))
+            blob = cv2.dnn.blobFromImage(roi, 1.0, size, (104.0, 177.0, 123.0), swapRB=False, crop=False)
+            boxes.extend(self.faceBoxes(blob, x1, y1, rW, rH))
+        return boxes
+
+
+    # function to recognize faces. Returns a list of {name, probability, box} for each face
+    # If a list of person boxes is given then only those areas are searched
+    #-----------------------------------------------------------------------
+    def recognizer(self, frame, persons=None):
+        listFaces = []
+        image = frame.resized(600)
+        (h, w) = image.shape[:2]
+        boxes = []
+        if persons is not None and len(persons) > 0:
+            boxes = self.personFaceBoxes(frame, image, persons)
+            if not boxes and self.faceFallback:
+                self.logger.debug('No faces found inside person boxes. Checking the full frame')
+                persons = None
+        if persons is None or len(persons) == 0:
+            blob = frame.blob('face', lambda f: cv2.dnn.blobFromImage(f.square(300), 1.0, (300, 300), (104.0, 177.0, 123.0), swapRB=False, crop=False))
+            boxes = self.faceBoxes(blob, 0, 0, w, h)
+
+        # collect the faces that are large enough to analyse
+        crops = []
+        scale = frame.frame.shape[1] / float(w)
+        for (startX, startY, endX, endY) in boxes:
+            face = image[max(startY, 0):endY, max(startX, 0):endX]
+            (fH, fW) = face.shape[:2]
+            # ensure the face width and height are sufficiently large
+            if fW < 20 or fH < 20:
+                self.logger.debug('Face is not big enough to analyse')
+                continue
+            crops.append(face)
+            listFaces.append({"box": [int(startX * scale), int(startY * scale), int(endX * scale), int(endY * scale)]})
+        if not boxes:
             self.logger.debug('No faces were detected in the image')
-            
+        if not crops:
+            return listFaces
+
+        # quantify all faces with one pass through the embedder, then classify them together
+        self.logger.debug('Found %d face(s). Will try to recognise' % len(crops))
+        faceBlob = cv2.dnn.blobFromImages(crops, 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True, crop=False)
+        self.face_embedder.setInput(faceBlob)
+        vecs = self.face_embedder.forward()
+        names, probas = self.classifyFaces(vecs)
+
+        # what was the result
+        for item, name, proba in zip(listFaces, names, probas):
+            item["name"] = name
+            item["probability"] = round(float(proba), 3)
         return listFaces
+
+
+    # Name each of an (N, 128) array of face embeddings. Returns the names and match scores
+    #-----------------------------------------------------------------------
+    def classifyFaces(self, vecs):
+        if self.face_backend == "index":
+            return self.face_index.match(vecs)
+        preds = self.face_recognizer.predict_proba(vecs)
+        best = np.argmax(preds, axis=1)
+        probas = preds[np.arange(len(best)), best]
+        # weak matches are reported as unknown
+        names = [str(name) if proba >= self.face_match_cutoff else 'unknown' for name, proba in zip(self.face_labels.classes_[best], probas)]
+        return names, probas
+
+
+    # Add a new face to the nearest neighbour index, without retraining. Saves the index if asked
+    #-----------------------------------------------------------------------
+    def addFace(self, name, vec, save=False):
+        if self.face_backend != "index":
+            self.logger.warning('Faces can only be added when faceBackend = index')
+            return False
+        self.face_index.add(name, vec)
+        if save:
+            self.face_index.save(self.face_index_path)
+        return True
         
 
     # Function called by robotAI_brain for this set of logic
     #-----------------------------------------------------------------------
-    def doLogic(self, msgQueue, content, reply_to, body):
-        # If we received an image then check it for objects
-        if content == "image/jpg":
-            self.logger.debug('Decode the content and save the file')
-            imgbin = base64.b64decode(body)
-	
-            # Overwrite current image stored for client
-            # -------------------------------------------
-            filePath = os.path.join(self.ENVIRON['topdir'], 'static/motionImages', reply_to + '.jpg') 
-            with open(filePath, 'wb') as f_output:
-                f_output.write(imgbin)
-		
-            # Store image in history folder for client
-            # ----------------------------------------     
-            if self.ENVIRON["keepImages"] == "True":
-                folder = os.path.join(self.ENVIRON['topdir'], 'static/motionImages/', reply_to) 
-                if not os.path.exists(folder):
-                    os.makedirs(folder)
-                filePath = os.path.join(folder, datetime.now().strftime("%Y%m%d%H%M%S") + '.jpg') 
-                with open(filePath, 'wb') as f_output:
-                    f_output.write(imgbin)
-                self.logger.debug("Saved image to " + filePath )
-
+    def doLogic(self, msgQueue, content, reply_to, body, headers=None):
+        frame = self.prepareFrame(content, reply_to, body, headers)
+        if frame is not None:
             # use ML to detect objects in the image
             # -----------------------------------------------------------------
             self.logger.debug('Analysing the image for recognized objects')
-            detected = self.objectCount(imgbin)
-            
-            # use ML to recognise faces in the image, add to previous results
-            # -----------------------------------------------------------------
+            with frame.stage('objects'):
+                detected, objects = self.objectCount(frame)
+            self.finishFrame(frame, reply_to, detected, objects)
+
+
+    # Save the received image and wrap it in a frame pipeline. Returns None if not an image
+    #-----------------------------------------------------------------------
+    def prepareFrame(self, content, reply_to, body, headers=None):
+        # If we received an image then check it for objects
+        if content != "image/jpg":
+            return None
+        self.logger.debug('Decode the content and save the file')
+        imgbin, meta = common_image.decodeFrame(headers, body)
+
+        # only analyse frames that differ from the last analysed frame, within the rate limit
+        # -------------------------------------------
+        decision, cached = self.admission.check(reply_to, imgbin)
+        if decision == 'repeat':
+            if cached is not None:
+                self.logger.debug('Frame from ' + reply_to + ' matches the last one analysed. Sending the same result')
+                self.sendMessage(reply_to, cached)
+            return None
+        elif decision == 'limited':
+            self.logger.debug('Skipping frame from ' + reply_to + ' as it is over the rate limit. Sending the last result')
+            if cached is not None:
+                self.sendMessage(reply_to, cached)
+            return None
+
+        # Overwrite current image stored for client. Written in the background by the image store
+        # -------------------------------------------
+        brain_imagestore.getStore(self.ENVIRON).latest(reply_to, imgbin)
+
+        # decode the image once and share it with each analysis stage
+        # -----------------------------------------------------------------
+        frame = framePipeline(imgbin, meta)
+        frame.frame                 # decode now, so it is timed as its own stage
+        return frame
+
+
+    # Run face recognition on a frame whose objects are known, then reply to the client
+    #-----------------------------------------------------------------------
+    def finishFrame(self, frame, reply_to, detected, objects):
+        # use ML to recognise faces in the image, add to previous results
+        # only search for faces when a person was found, unless the cascade is turned off
+        # -----------------------------------------------------------------
+        persons = objects[objects["classId"] == self.personId]["box"]
+        if self.faceCascade and len(persons) == 0:
+            self.logger.debug('No person in the image so skipping face recognition')
+            faces = []
+        else:
             self.logger.debug('Analysing the image for recognized faces')
-            faces = self.recognizer(imgbin)
-            detected["faces"] = faces
-
-            # respond to the client device that submitted the message
-            body = json.dumps(detected)
-            self.logger.debug('Sending data to: ' + reply_to + '. body = ' + body)
-            
-            result = self.sendMessage(reply_to, body)
-            """
-            channel1 = msgQueue.channel()
-            channel1.queue_declare(reply_to)
-            properties = pika.BasicProperties(app_id='motion', content_type='application/json', reply_to='Central')
-            channel1.basic_publish(exchange='', routing_key=reply_to, body=body, properties=properties)
-            """
+            with frame.stage('faces'):
+                faces = self.recognizer(frame, persons if self.faceCascade else None)
+        detected["faces"] = [face["name"] for face in faces]
+        detected["faceDetail"] = faces
+        detected["objects"] = common_detect.toList(objects, self.CLASSES)
+        self.logger.debug('Frame timings: ' + frame.timingText())
+
+        # Store image in history folder for client, once we know whether anything was detected,
+        # and record the result in the event store
+        # ----------------------------------------
+        image = brain_imagestore.getStore(self.ENVIRON).keepFrame(reply_to, frame.imgbin, len(objects) > 0 or len(faces) > 0)
+        if self.ENVIRON.get("recordEvents", "True") == "True":
+            brain_events.getEvents(self.ENVIRON).record(reply_to, frame.meta.get("captured", time.time()), detected, image)
 
+        # respond to the client device that submitted the message
+        body = json.dumps(detected)
+        self.admission.remember(reply_to, body)
+        self.logger.debug('Sending data to: ' + reply_to + '. body = ' + body)
+        return self.sendMessage(reply_to, body)
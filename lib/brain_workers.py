@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Worker pool used by robotai_brain when brainWorkers is greater than 0
+The main brain process becomes a router. It moves each message from the brain queue onto a
+lane queue, and a pool of worker processes consumes each lane with manual acks:
+  fast lane  - camera, connect and button messages. Never waits behind the ML models
+  voice lane - voice messages, so chat replies never wait behind image analysis
+  slow lane  - motion messages
+Each voice and slow lane worker loads its own copy of its lane's model, at startup or, if the
+model is listed in lazyModels, when the first message for it arrives.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import logging
+import os
+import time
+import json
+import functools
+import pika
+
+# import the shared message queue publisher
+import lib.common_queue as common_queue
+import lib.common_image as common_image
+import lib.brain_imagestore as brain_imagestore
+
+# app_ids handled by the fast and voice lanes. Everything else goes to the slow lane
+fastApps = ['camera', 'connect', 'button']
+voiceApps = ['voice']
+lanes = ['fast', 'voice', 'slow']
+retryWait = 5                   # seconds to wait before reconnecting a lost consumer
+
+
+# Name of the queue used for a lane, eg. Central_fast
+#---------------------------------------------------------------------------
+def laneQueue(brainQueue, lane):
+    return brainQueue + '_' + lane
+
+
+# Work out which lane a message belongs to
+#---------------------------------------------------------------------------
+def getLane(app_id):
+    if app_id in fastApps:
+        return 'fast'
+    if app_id in voiceApps:
+        return 'voice'
+    return 'slow'
+
+
+# Open a connection and channel to the message queue
+#---------------------------------------------------------------------------
+def connectQueue(ENVIRON):
+    credentials = pika.PlainCredentials(ENVIRON["queueUser"], ENVIRON["queuePass"])
+    parameters = pika.ConnectionParameters(ENVIRON["queueSrvr"], ENVIRON["queuePort"], '/',  credentials)
+    connection = pika.BlockingConnection(parameters)
+    return connection, connection.channel()
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Router. Runs in the main brain process and only moves messages onto the lane queues
+#-------------------------------------------------------------------------------------------------------------------------
+class router(object):
+
+    def __init__(self, ENVIRON, logger):
+        self.ENVIRON = ENVIRON
+        self.logger = logger
+        self.brainQueue = ENVIRON["brainQueue"]
+
+
+    # Move a message to its lane, keeping the original properties, then ack it. Motion frames
+    # where only ignored zones were active are dropped here, before reaching the models
+    # ----------------------------------------------------------------------------------
+    def callback(self, ch, method, properties, body):
+        if properties.app_id == 'motion' and not common_image.zonesRelevant(properties.headers, self.ENVIRON.get("ignoreZones", "")):
+            self.logger.debug("Skipping motion from " + str(properties.reply_to) + " as it was only in zones " + str(properties.headers.get("zones")))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        lane = getLane(properties.app_id)
+        try:
+            ch.basic_publish(exchange='', routing_key=laneQueue(self.brainQueue, lane), body=body, properties=properties)
+        except:
+            self.logger.error("Unable to route message from " + str(properties.reply_to) + " to the " + lane + " lane")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+    # Consume the brain queue until the connection drops
+    # ----------------------------------------------------------------------------------
+    def run(self, connection, channel):
+        channel.queue_declare(queue=self.brainQueue)
+        for lane in lanes:
+            channel.queue_declare(queue=laneQueue(self.brainQueue, lane))
+        channel.basic_qos(prefetch_count=100)
+        channel.basic_consume(queue=self.brainQueue, on_message_callback=self.callback, auto_ack=False)
+        self.logger.debug('Routing messages from ' + self.brainQueue + ' to the worker lanes')
+        channel.start_consuming()
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Worker. Consumes one lane with manual acks, holding its own copy of the lane's model
+#-------------------------------------------------------------------------------------------------------------------------
+class worker(object):
+
+    def __init__(self, ENVIRON, lane, prefetch):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("brain_worker_" + lane + "_" + str(os.getpid()))
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        self.ENVIRON = ENVIRON
+        self.lane = lane
+        self.prefetch = prefetch
+        self.queueName = laneQueue(ENVIRON["brainQueue"], lane)
+
+        # load the model for our lane now, unless it is in lazyModels
+        self.detectorAPI = None
+        self.voiceAPI = None
+        self.batcher = None
+        lazyModels = [name.strip() for name in ENVIRON.get("lazyModels", "").split(',') if name.strip()]
+        if lane == 'slow' and 'motion' not in lazyModels:
+            self.loadModel('motion')
+        elif lane == 'voice' and 'voice' not in lazyModels:
+            self.loadModel('voice')
+
+
+    # Load the model needed for a message if this worker has not loaded it yet
+    # ----------------------------------------------------------------------------------
+    def loadModel(self, app_id):
+        if app_id == 'motion' and self.detectorAPI is None:
+            self.logger.debug("Loading the motion model for this worker")
+            startTime = time.perf_counter()
+            import lib.brain_motion as motion
+            self.detectorAPI = motion.detectorAPI(self.ENVIRON)
+            # collect motion frames into batches. Needs workerPrefetch > 1 to see more than one frame
+            if int(self.ENVIRON.get("batchWindow", "0")) > 0:
+                from lib.brain_batch import batchScheduler
+                self.batcher = batchScheduler(self.detectorAPI, int(self.ENVIRON["batchWindow"]), int(self.ENVIRON["batchSize"]))
+            self.logger.info("The motion model is ready. Loaded in %.1f seconds" % (time.perf_counter() - startTime))
+        elif app_id == 'voice' and self.voiceAPI is None:
+            self.logger.debug("Loading the voice model for this worker")
+            startTime = time.perf_counter()
+            import lib.brain_voice as voice
+            self.voiceAPI = voice.voiceAPI(self.ENVIRON)
+            self.logger.info("The voice model is ready. Loaded in %.1f seconds" % (time.perf_counter() - startTime))
+
+
+    # Handle a single message, then ack it once the work is done
+    # ----------------------------------------------------------------------------------
+    def callback(self, ch, method, properties, body):
+        try:
+            self.loadModel(properties.app_id)
+        except Exception as e:
+            self.logger.error("Failed to load the model for " + str(properties.app_id) + " messages. " + str(e))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        # batched frames are acked from the scheduler thread once they have been handled
+        if self.batcher is not None and properties.app_id == 'motion':
+            ack = functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag)
+            try:
+                self.batcher.submit(properties.content_type, properties.reply_to, body, properties.headers,
+                                    done=lambda: ch.connection.add_callback_threadsafe(ack))
+                return
+            except Exception as e:
+                self.logger.error("Error queueing motion message from " + str(properties.reply_to) + ". " + str(e))
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+        try:
+            self.doLogic(properties, body)
+        except Exception as e:
+            self.logger.error("Error handling " + str(properties.app_id) + " message from " + str(properties.reply_to) + ". " + str(e))
+        # ack even on failure, so a bad message is not redelivered forever
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+    # Call the relevant logic to process message, based on sensor type that it relates to
+    # ----------------------------------------------------------------------------------
+    def doLogic(self, properties, body):
+        app_id = properties.app_id
+        content = properties.content_type
+        reply_to = properties.reply_to
+        self.logger.debug("Message received from " + str(reply_to) + " App: " + str(app_id) + " content: " + str(content))
+
+        if app_id == 'connect':
+            # For connection events send the current environment data to client
+            body = json.dumps(self.ENVIRON)
+            common_queue.publish(self.ENVIRON, reply_to, body, 'environ', 'application/json', self.ENVIRON["brainQueue"])
+        elif app_id == 'camera':
+            # For camera events just overwrite the latest image
+            imgbin, meta = common_image.decodeFrame(properties.headers, body)
+            brain_imagestore.getStore(self.ENVIRON).latest(reply_to, imgbin)
+        elif app_id == 'button':
+            import lib.brain_button as button
+            button.doLogic(content, body, self.logger, self.ENVIRON)
+        elif app_id == 'motion':
+            self.detectorAPI.doLogic(None, content, reply_to, body, properties.headers)
+        elif app_id == 'voice':
+            self.voiceAPI.doLogic(content, reply_to, body)
+        else:
+            self.logger.error("Message received from " + str(reply_to) + " but no logic exists for " + str(app_id))
+
+
+    # Consume our lane, reconnecting if the connection to the queue is lost
+    # ----------------------------------------------------------------------------------
+    def run(self):
+        while True:
+            try:
+                connection, channel = connectQueue(self.ENVIRON)
+                channel.queue_declare(queue=self.queueName)
+                channel.basic_qos(prefetch_count=self.prefetch)
+                channel.basic_consume(queue=self.queueName, on_message_callback=self.callback, auto_ack=False)
+                self.logger.debug('Worker listening on ' + self.queueName)
+                channel.start_consuming()
+            except Exception as e:
+                self.logger.error('Worker lost connection to ' + self.queueName + '. ' + str(e))
+                time.sleep(retryWait)
+
+
+
+#---------------------------------------------------------------------------
+# Function called by robotAI_brain to start a worker process
+#---------------------------------------------------------------------------
+def runWorker(ENVIRON, lane, prefetch):
+    w = worker(ENVIRON, lane, prefetch)
+    w.run()
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Audio output service. Replaces forking aplay for every sound.
+One PyAudio output stream is kept open while sounds are playing, and fed from a queue by the
+stream callback, so a sound starts within one buffer of being queued. All audio is converted
+once to the same format (44.1kHz mono 16 bit). Sounds such as the beeps can be preloaded, and
+processes started afterwards share them. play() returns straight away unless asked to block.
+stop() cuts off the current sound and empties the queue. The stream is closed after a few idle
+seconds to free the sound card for other processes.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import collections
+import threading
+import logging
+import audioop
+import wave
+import time
+import io
+import os
+import pyaudio
+
+rate = 44100
+framesPerBuffer = 512
+idleClose = 10                  # seconds without sound before the output stream is closed
+
+_players = {}
+_lock = threading.Lock()
+sounds = {}                     # preloaded PCM by file name
+
+
+# Convert a WAV file now, so playing it later needs no conversion
+#---------------------------------------------------------------------------
+def preload(path):
+    sounds[path] = toPCM(path)
+    return sounds[path]
+
+
+# Convert WAV data (bytes or a file name) to mono 16 bit PCM at our output rate
+#---------------------------------------------------------------------------
+def toPCM(wav):
+    if isinstance(wav, (bytes, bytearray)):
+        wav = io.BytesIO(wav)
+    w = wave.open(wav, 'rb')
+    width = w.getsampwidth()
+    data = w.readframes(w.getnframes())
+    if width != 2:
+        data = audioop.lin2lin(data, width, 2)
+    if w.getnchannels() == 2:
+        data = audioop.tomono(data, 2, .5, .5)
+    if w.getframerate() != rate:
+        data, state = audioop.ratecv(data, 2, 1, w.getframerate(), rate, None)
+    w.close()
+    return data
+
+
+#---------------------------------------------------------------------------
+# A sound waiting in, or taken from, the playback queue
+#---------------------------------------------------------------------------
+class sound(object):
+
+    def __init__(self, pcm):
+        self.pcm = memoryview(pcm)
+        self.queued = time.perf_counter()
+        self.started = None
+        self.stopped = False
+        self.done = threading.Event()
+
+    # Block until the sound has finished (or was stopped)
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Audio player
+#-------------------------------------------------------------------------------------------------------------------------
+class audioPlayer(object):
+
+    def __init__(self, logger=None):
+        if logger is None:
+            logging.basicConfig()
+            logger = logging.getLogger("client_audio")
+        self.logger = logger
+        self.queue = collections.deque()
+        self.current = None
+        self.pos = 0
+        self.lock = threading.Lock()
+        self.p = None
+        self.stream = None
+        self.lastSound = time.time()
+        self.latencies = collections.deque(maxlen=100)
+        self.watcher = None
+
+
+    # Queue a sound: a WAV file name or WAV bytes. Files are kept once converted, as the same few
+    # files are played over and over. With block=True wait until it has been heard.
+    # Returns the queued sound
+    # ----------------------------------------------------------------------------------
+    def play(self, wav, block=False):
+        if isinstance(wav, str):
+            pcm = sounds.get(wav) or preload(wav)
+        else:
+            pcm = toPCM(wav)
+        item = sound(pcm)
+        with self.lock:
+            self.openStream()
+            self.queue.append(item)
+        if block:
+            self.wait(item)
+        return item
+
+
+    # Wait until a sound has been heard. interrupt (optional) is checked while waiting, and
+    # everything is stopped if it returns True
+    # ----------------------------------------------------------------------------------
+    def wait(self, item, interrupt=None):
+        while not item.wait(.05):
+            if interrupt is not None and interrupt():
+                self.stop()
+        # the last buffer is still in the sound card when the callback has handed it over
+        stream = self.stream
+        if not item.stopped and stream is not None:
+            time.sleep(stream.get_output_latency())
+
+
+    # Cut off the current sound and drop anything waiting to be played
+    # ----------------------------------------------------------------------------------
+    def stop(self):
+        with self.lock:
+            items = list(self.queue)
+            if self.current is not None:
+                items.append(self.current)
+            self.queue.clear()
+            self.current = None
+        for item in items:
+            item.stopped = True
+            item.done.set()
+
+
+    def isPlaying(self):
+        return self.current is not None or len(self.queue) > 0
+
+
+    # Open the output stream if it is not open (called holding the lock)
+    # ----------------------------------------------------------------------------------
+    def openStream(self):
+        self.lastSound = time.time()
+        if self.stream is not None:
+            return
+        if self.p is None:
+            self.p = pyaudio.PyAudio()
+        self.stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=rate, output=True,
+                                  frames_per_buffer=framesPerBuffer, stream_callback=self.callback)
+        self.stream.start_stream()
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=self.watch, name="audioWatcher", daemon=True)
+            self.watcher.start()
+
+
+    # Close the stream once nothing has played for a while
+    # ----------------------------------------------------------------------------------
+    def watch(self):
+        while True:
+            time.sleep(1)
+            stream = None
+            with self.lock:
+                if self.stream is not None and not self.isPlaying() and time.time() - self.lastSound > idleClose:
+                    stream = self.stream
+                    self.stream = None
+            # stop the stream outside the lock, as stopping waits for the callback to finish
+            if stream is not None:
+                stream.stop_stream()
+                stream.close()
+
+
+    # PyAudio stream callback. Fills each buffer from the queue, with silence when idle
+    # ----------------------------------------------------------------------------------
+    def callback(self, in_data, frame_count, time_info, status):
+        need = frame_count * 2
+        out = bytearray()
+        with self.lock:
+            while len(out) < need:
+                if self.current is None:
+                    if not self.queue:
+                        break
+                    self.current = self.queue.popleft()
+                    self.pos = 0
+                    self.current.started = time.perf_counter()
+                    self.latencies.append(self.current.started - self.current.queued)
+                chunk = self.current.pcm[self.pos:self.pos + need - len(out)]
+                out += chunk
+                self.pos += len(chunk)
+                if self.pos >= len(self.current.pcm):
+                    self.current.done.set()
+                    self.current = None
+            if out:
+                self.lastSound = time.time()
+        out += bytes(need - len(out))
+        return (bytes(out), pyaudio.paContinue)
+
+
+    # Average time from play() to the first sample reaching the sound card
+    # ----------------------------------------------------------------------------------
+    def latency(self):
+        if not self.latencies:
+            return None
+        outputLatency = self.stream.get_output_latency() if self.stream is not None else 0
+        return sum(self.latencies) / len(self.latencies) + outputLatency
+
+
+
+#---------------------------------------------------------------------------
+# Return the audio player for this process, creating it on first use.
+# Processes started with multiprocessing each get their own player.
+#---------------------------------------------------------------------------
+def getPlayer():
+    pid = os.getpid()
+    with _lock:
+        if pid not in _players:
+            _players[pid] = audioPlayer()
+        return _players[pid]
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own.
+# Compares the time from asking for a beep to it starting, for aplay and the player.
+# For aplay this is the run time less the length of the sound
+# **************************************************************************
+if __name__ == "__main__":
+    import subprocess
+    topdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    beep = os.path.join(topdir, 'static/audio/beep_hi.wav')
+    w = wave.open(beep, 'rb')
+    duration = w.getnframes() / float(w.getframerate())
+    w.close()
+    repeats = 10
+
+    overheads = []
+    for i in range(repeats):
+        startTime = time.perf_counter()
+        subprocess.call(['aplay', beep], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        overheads.append(time.perf_counter() - startTime - duration)
+    print("aplay   trigger to first sample about %.1fms" % (sum(overheads) / repeats * 1000))
+
+    preload(beep)
+    player = getPlayer()
+    for i in range(repeats):
+        player.play(beep, block=True)
+    print("player  trigger to first sample %.1fms (including output latency)" % (player.latency() * 1000))
@@ -8,12 +8,12 @@ TODO - Nothing atm
 ===============================================================================================
 """
 import logging
-import pika
 import RPi.GPIO as GPIO
 import time
 
 # import shared utility finctions
 import lib.common_utils as utils
+import lib.common_queue as common_queue
 
 GPIO.setmode(GPIO.BCM)
 
@@ -36,10 +36,6 @@ class listenLoop(object):
         self.VOICE = VOICE
         self.TOPDIR = ENVIRON["topdir"]
 
-        # Setup details to access the message queue
-        credentials = pika.PlainCredentials(ENVIRON["queueUser"], ENVIRON["queuePass"])
-        self.parameters = pika.ConnectionParameters(ENVIRON["queueSrvr"], ENVIRON["queuePort"], '/',  credentials)
-
         
     def buttonListen(self):
         while True:
@@ -47,13 +43,9 @@ class listenLoop(object):
             if i==0:
                 #print("Pin is LOW")
                 #Send message to the brain to trigger bell ringing
-                properties = pika.BasicProperties(app_id='button', content_type='application/json', reply_to=self.ENVIRON["clientName"])
                 try:
                     body = '{"audio": "' + self.ENVIRON["buttonAudio"] + '", "voice": "' + self.ENVIRON["buttonVoice"] + '"}'
-                    connection = pika.BlockingConnection(self.parameters)
-                    channel = connection.channel()
-                    channel.basic_publish(exchange='', routing_key='Central', body=body, properties=properties)
-                    connection.close()
+                    common_queue.publish(self.ENVIRON, 'Central', body, 'button', 'application/json', self.ENVIRON["clientName"])
                 except:
                     self.logger.error('An error occurred trying to send doorbell alert to Message Queue ' + self.ENVIRON["queueSrvr"])
                 
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Motion analysis for client_motionSensorPi, kept apart from the camera so it can be run offline
+The camera records YUV from a downscaled splitter port into a frameRing. Only the Y plane is
+kept, which is already a grayscale image, so there is no resize or colour conversion per frame.
+The ring is a fixed set of preallocated frames, and motionAnalyser works on its own reused
+arrays, so checking a frame allocates no new images.
+Frames are analysed on a small grid. The frame is split into named zones (masks drawn from the
+motionZones setting), and each zone is scored by the share of its pixels that changed, so motion
+outside the zones (eg. trees or a road) is ignored and the brain is told which zones were active.
+Run this module with a video file or a folder of JPEG images to benchmark the analysis against
+the original per frame capture, resize, convert and blur without a camera.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import collections
+import threading
+import time
+import imutils
+import numpy as np
+import cv2
+
+motionSize = (160, 120)         # size of the grid analysed for motion (width, height)
+ringSize = 4                    # frames held in the ring
+zoneMin = .025                  # share of a zone's pixels that must change for motion in the zone
+deltaThresh = 5
+blurSize = 7                    # Gaussian blur kernel (21 at the old 500 pixel width)
+
+
+# Size of the buffers the camera writes for YUV at a given size. Width is padded to a
+# multiple of 32 and height to a multiple of 16
+#---------------------------------------------------------------------------
+def paddedSize(size):
+    return ((size[0] + 31) // 32 * 32, (size[1] + 15) // 16 * 16)
+
+
+# Zones from the motionZones setting, eg. "gate=0,0.4 0.5,0.4 0.5,1 0,1; path=0.5,0.6 1,0.6 1,1 0.5,1"
+# Each zone is a name and a polygon, with points given as fractions of the frame width and height.
+# Returns a list of (name, points). With no setting there is one zone covering the whole frame
+#---------------------------------------------------------------------------
+def parseZones(text):
+    zones = []
+    for part in (text or '').split(';'):
+        if not part.strip():
+            continue
+        name, points = part.split('=', 1)
+        points = [tuple(float(v) for v in point.split(',')) for point in points.split()]
+        if len(points) < 3:
+            raise ValueError("Motion zone " + name.strip() + " needs at least 3 points")
+        zones.append((name.strip(), points))
+    if not zones:
+        zones.append(('all', [(0, 0), (1, 0), (1, 1), (0, 1)]))
+    return zones
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Ring of preallocated grayscale frames. Used as a picamera output: write() is called by the
+# camera with each YUV frame and copies its Y plane into the next free slot
+#-------------------------------------------------------------------------------------------------------------------------
+class frameRing(object):
+
+    def __init__(self, size=motionSize, count=ringSize):
+        self.width, self.height = size
+        self.padWidth, self.padHeight = paddedSize(size)
+        self.frames = np.empty((count, self.height, self.width), dtype=np.uint8)
+        self.stamps = [0.0] * count
+        self.count = count
+        self.latest = None              # slot holding the newest frame
+        self.busy = None                # slot being analysed, which write() must not touch
+        self.seq = 0                    # frames written so far
+        self.taken = 0                  # seq of the last frame handed out by get()
+        self.ready = threading.Condition()
+
+
+    # Called by the camera for each frame
+    # ----------------------------------------------------------------------------------
+    def write(self, buf):
+        y = np.frombuffer(buf, dtype=np.uint8, count=self.padWidth * self.padHeight)
+        y = y.reshape(self.padHeight, self.padWidth)[:self.height, :self.width]
+        with self.ready:
+            i = 0 if self.latest is None else (self.latest + 1) % self.count
+            if i == self.busy:
+                i = (i + 1) % self.count
+        np.copyto(self.frames[i], y)
+        with self.ready:
+            self.stamps[i] = time.time()
+            self.latest = i
+            self.seq += 1
+            self.ready.notify_all()
+        return len(buf)
+
+
+    def flush(self):
+        pass
+
+
+    # Newest frame not handed out before, waiting up to timeout for one. Returns None if there
+    # is no new frame. The frame is not overwritten until release() is called
+    # ----------------------------------------------------------------------------------
+    def get(self, timeout=1):
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.seq > self.taken, timeout):
+                return None
+            self.taken = self.seq
+            self.busy = self.latest
+            return self.frames[self.busy]
+
+
+    def release(self):
+        with self.ready:
+            self.busy = None
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Compares each frame with a running average of the previous frames, and scores each zone by the
+# share of its pixels that differ from the average
+#-------------------------------------------------------------------------------------------------------------------------
+class motionAnalyser(object):
+
+    def __init__(self, size=motionSize, zones=None, zoneMin=zoneMin, deltaThresh=deltaThresh, blurSize=blurSize):
+        width, height = size
+        self.zoneMin = zoneMin
+        self.deltaThresh = deltaThresh
+        self.blurSize = blurSize
+        self.avg = None
+        self.blurred = np.empty((height, width), dtype=np.uint8)
+        self.avg8 = np.empty((height, width), dtype=np.uint8)
+        self.delta = np.empty((height, width), dtype=np.uint8)
+        self.thresh = np.empty((height, width), dtype=np.uint8)
+        self.masked = np.empty((height, width), dtype=np.uint8)
+        self.frames = 0
+        self.times = collections.deque(maxlen=100)
+
+        # a mask for each zone, drawn once at the grid size
+        self.zones = []
+        for name, points in (zones or parseZones('')):
+            mask = np.zeros((height, width), dtype=np.uint8)
+            poly = np.array([[round(x * (width - 1)), round(y * (height - 1))] for x, y in points], dtype=np.int32)
+            cv2.fillPoly(mask, [poly], 255)
+            self.zones.append((name, mask, max(cv2.countNonZero(mask), 1)))
+        self.scores = {name: 0.0 for name, mask, area in self.zones}
+
+
+    # Zones with motion in a grayscale frame, as a dict of zone name and score (the share of the
+    # zone that changed). Empty if there is no motion. The scores of all zones are kept in self.scores
+    # ----------------------------------------------------------------------------------
+    def analyse(self, gray):
+        startTime = time.perf_counter()
+        self.frames += 1
+        cv2.GaussianBlur(gray, (self.blurSize, self.blurSize), 0, dst=self.blurred)
+
+        # if the average frame is None, initialize it
+        if self.avg is None:
+            self.avg = self.blurred.astype(np.float32)
+            return {}
+
+        # accumulate weighted avg between the current frame and previous frames, then the difference b/w current frame and avg
+        cv2.accumulateWeighted(self.blurred, self.avg, 0.5)
+        cv2.convertScaleAbs(self.avg, dst=self.avg8)
+        cv2.absdiff(self.blurred, self.avg8, dst=self.delta)
+        cv2.threshold(self.delta, self.deltaThresh, 255, cv2.THRESH_BINARY, dst=self.thresh)
+
+        # count the changed pixels inside each zone
+        active = {}
+        for name, mask, area in self.zones:
+            cv2.bitwise_and(self.thresh, mask, dst=self.masked)
+            score = cv2.countNonZero(self.masked) / area
+            self.scores[name] = score
+            if score >= self.zoneMin:
+                active[name] = score
+
+        self.times.append(time.perf_counter() - startTime)
+        return active
+
+
+    # Average time to analyse a frame in seconds
+    # ----------------------------------------------------------------------------------
+    def frameTime(self):
+        if not self.times:
+            return 0
+        return sum(self.times) / len(self.times)
+
+
+
+# The buffer the camera would write for a BGR frame: downscaled, then YUV420 with padding.
+# Only the Y plane is filled in, as that is all frameRing reads
+#---------------------------------------------------------------------------
+def yuvBuffer(frame, size=motionSize):
+    padWidth, padHeight = paddedSize(size)
+    gray = cv2.cvtColor(cv2.resize(frame, tuple(size), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    buf = np.zeros(padWidth * padHeight * 3 // 2, dtype=np.uint8)
+    buf[:padWidth * padHeight].reshape(padHeight, padWidth)[:size[1], :size[0]] = gray
+    return buf.tobytes()
+
+
+# Frames from a video file or a folder of JPEG images
+#---------------------------------------------------------------------------
+def recordedFrames(path):
+    import os
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(('.jpg', '.jpeg')):
+                frame = cv2.imread(os.path.join(path, name))
+                if frame is not None:
+                    yield frame
+    else:
+        video = cv2.VideoCapture(path)
+        while True:
+            ok, frame = video.read()
+            if not ok:
+                break
+            yield frame
+        video.release()
+
+
+# The motion check as it was done before the frame ring, on a full camera frame
+#---------------------------------------------------------------------------
+def originalCheck(frame, state):
+    frame = imutils.resize(frame, width=500)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray = cv2.GaussianBlur(gray, (21, 21), 0)
+    if state.get("avg") is None:
+        state["avg"] = gray.copy().astype("float")
+        return False
+    cv2.accumulateWeighted(gray, state["avg"], 0.5)
+    frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(state["avg"]))
+    thresh = cv2.threshold(frameDelta, deltaThresh, 255, cv2.THRESH_BINARY)[1]
+    thresh = cv2.dilate(thresh, None, iterations=2)
+    cnts = imutils.grab_contours(cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE))
+    return any(cv2.contourArea(c) >= 5000 for c in cnts)
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own.
+# Benchmark on recorded frames: python3 client_motionAnalysis.py <video file or folder of jpgs> [zones]
+# zones is optional and written as for the motionZones setting. The camera's work (downscale and YUV conversion) is done up front so only our part is timed
+# **************************************************************************
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python3 client_motionAnalysis.py <video file or folder of JPEG images> [zones]")
+        sys.exit(1)
+    frames = [cv2.resize(f, (640, 480)) for f in recordedFrames(sys.argv[1])]
+    if not frames:
+        print("No frames found in " + sys.argv[1])
+        sys.exit(1)
+    buffers = [yuvBuffer(f) for f in frames]
+
+    state = {}
+    wall, cpu = time.perf_counter(), time.process_time()
+    motion = sum(originalCheck(f, state) for f in frames)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    print("original  %4d frames  %6.2fms per frame  %6.2fms CPU per frame  %3d with motion" %
+          (len(frames), wall / len(frames) * 1000, cpu / len(frames) * 1000, motion))
+
+    # the same path as the camera: write() into the ring, then get(), analyse() and release()
+    ring = frameRing()
+    analyser = motionAnalyser(zones=parseZones(sys.argv[2] if len(sys.argv) > 2 else ''))
+    motion = 0
+    zoneCounts = collections.Counter()
+    wall, cpu = time.perf_counter(), time.process_time()
+    for buf in buffers:
+        ring.write(buf)
+        gray = ring.get(timeout=0)
+        try:
+            active = analyser.analyse(gray)
+            motion += bool(active)
+            zoneCounts.update(active.keys())
+        finally:
+            ring.release()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    print("frame ring %4d frames  %6.2fms per frame  %6.2fms CPU per frame  %3d with motion" %
+          (len(frames), wall / len(frames) * 1000, cpu / len(frames) * 1000, motion))
+    print("frames with motion in each zone: " + ", ".join("%s %d" % (name, zoneCounts[name]) for name, mask, area in analyser.zones))
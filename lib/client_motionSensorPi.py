@@ -8,12 +8,10 @@ Open computer vision (Open CV) libraries required
 """
 from datetime import datetime
 from datetime import timedelta
-import imutils
 import time
 import cv2
-import pika
+import numpy as np
 import logging
-import base64
 import os
 import io
 
@@ -23,14 +21,17 @@ from picamera.array import PiRGBArray
 
 # import shared utility finctions
 import lib.common_utils as utils
+import lib.common_queue as common_queue
+import lib.common_image as common_image
+import lib.client_motionAnalysis as client_motionAnalysis
 
 #settings for image capture and motion detecton
 resolution = [640, 480]
-minArea = 5000
-deltaThresh = 5
+sendSize = (500, 375)           # size of the images sent to the brain
+motionFps = 8                   # motion checks per second
+statsEvery = 300                # how often (seconds) to log the motion check rate
 vidSeconds = 30
 
-avg_image = None                # to store ongoing comparison image
 uploadEvery = 3                 # how often (seconds) to send image
 videoFileSize = 4000000         # seems to equate to 60 second videos
 recordTime = 20                 # how long record after motion
@@ -59,9 +60,7 @@ class motionLoop(object):
         ENVIRON["recognizeClear"] = None
         ENVIRON["saveVideo"] = None
         ENVIRON["videoTime"] = recordTime
-        
-        credentials = pika.PlainCredentials(self.ENVIRON["queueUser"], self.ENVIRON["queuePass"])
-        self.parameters = pika.ConnectionParameters(self.ENVIRON["queueSrvr"], self.ENVIRON["queuePort"], '/',  credentials)
+        self.frameSeq = 0
 
 
     # Loop to keep checking every 5 seconds whether we should turn motion detection on
@@ -76,6 +75,8 @@ class motionLoop(object):
 
 
     # Loop to detect motion using Pi camera
+    # Grayscale frames for motion come from a downscaled YUV recording on splitter port 2 into a
+    # ring of preallocated frames. Colour images are only captured when they are to be sent
     #------------------------------------------------------------------------------------
     def detectPiCamera(self):   
         global lastUploaded
@@ -93,32 +94,65 @@ class motionLoop(object):
             #self.stream = picamera.PiCameraCircularIO(camera, seconds=30)          #seconds parameter not working
             self.stream = picamera.PiCameraCircularIO(camera, size=videoFileSize)
             camera.start_recording(self.stream, format='h264')
+            size = client_motionAnalysis.motionSize
+            ring = client_motionAnalysis.frameRing(size)
+            camera.start_recording(ring, format='yuv', splitter_port=2, resize=size)
+            try:
+                zones = client_motionAnalysis.parseZones(self.ENVIRON.get("motionZones", ""))
+            except Exception as e:
+                self.logger.error("Could not read motionZones, so using the whole frame. " + str(e))
+                zones = None
+            analyser = client_motionAnalysis.motionAnalyser(size, zones)
+            rawCapture = PiRGBArray(camera, size=sendSize)
+            stamped = np.empty((sendSize[1], sendSize[0], 3), dtype=np.uint8)
+            period = 1.0 / motionFps
+            nextCheck = time.perf_counter()
+            lastStats = time.perf_counter()
+            checks = 0
             try:
                 while True:
-                    # check for motion on a routine interval
+                    # check for motion at motionFps, or as often as we can if analysis falls behind
+                    nextCheck += period
+                    delay = nextCheck - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        nextCheck = time.perf_counter()
                     timestamp = datetime.now()
-                    time.sleep(.3)
-                    frame, isMotion = self.detect_motion(camera)
+                    gray = ring.get(timeout=1)
+                    if gray is None:
+                        self.logger.debug("No frame from the camera")
+                        continue
+                    try:
+                        active = analyser.analyse(gray)
+                    finally:
+                        ring.release()
+                    checks += 1
+                    frame = None
                     
                     # take action if motion detected
-                    if isMotion and datetime.now() > startDetecting:
-                        ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
-                        cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)            
-                        self.detectionEvent(camera, frame)
+                    if active and datetime.now() > startDetecting:
+                        frame = self.captureFrame(camera, rawCapture, stamped, timestamp)
+                        self.detectionEvent(camera, frame, active)
                         #if saveAt is None:
                         #    saveAt = datetime.now() + timedelta(seconds=recordTime)
                     
                     # check to see if we need to stop detecting or submit image to brain
                     if (timestamp - lastUploaded).seconds >= uploadEvery:
                         #self.logger.debug("Checking for stop indicator and uploading image")
-                        ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
-                        cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)            
+                        if frame is None:
+                            frame = self.captureFrame(camera, rawCapture, stamped, timestamp)
                         lastUploaded = timestamp
                         self.sendImage(frame, 'camera')
                         if self.ENVIRON["motion"] == False:
                             self.logger.debug("Time to stop detecting motion")
                             break            
                             
+                    if time.perf_counter() - lastStats >= statsEvery:
+                        self.logger.debug("Motion checks: %.1f per second, %.1fms each, %d camera frames" %
+                                          (checks / (time.perf_counter() - lastStats), analyser.frameTime() * 1000, ring.seq))
+                        lastStats = time.perf_counter()
+                        checks = 0
                             
                     # check to see if we need to save video due to motion
                     try:
@@ -130,49 +164,21 @@ class motionLoop(object):
                     except:
                         self.logger.debug("An error occurred saving video")
             finally:
+                camera.stop_recording(splitter_port=2)
                 camera.stop_recording()            
             
             
-    # Detect whether motion is indicated between avg_image and current image
+    # Capture a colour image to send to the brain, into the same buffer each time, and stamp the time on it.
+    # The capture's array is read only, so it is copied into stamped (reused for every capture) to draw on
     #------------------------------------------------------------------------------------
-    def detect_motion(self, camera):
-        isMotion = False
-        global avg_image
-        global deltaThresh
-
-        rawCapture = PiRGBArray(camera, size=tuple(resolution))
-        camera.capture(rawCapture, format="bgr", use_video_port=True)
-        frame = rawCapture.array
-
-        # resize the frame, convert it to grayscale, and blur it
-        frame = imutils.resize(frame, width=500)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-        # if the average frame is None, initialize it
-        if avg_image is None:
-            avg_image = gray.copy().astype("float")
-            rawCapture.truncate(0)
-            return frame, False
-
-        # accumulate weighted avg between the current frame and previous frames, then the difference b/w current frame and avg
-        cv2.accumulateWeighted(gray, avg_image, 0.5)
-        frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg_image))
-
-        # threshold the delta image, dilate the thresholded image to fill in holes, then find contours on thresholded image
-        thresh = cv2.threshold(frameDelta, deltaThresh, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.dilate(thresh, None, iterations=2)
-        cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cnts = imutils.grab_contours(cnts)
-
-        # loop over the contours, but ignore small differences
-        for c in cnts:
-            if cv2.contourArea(c) < minArea:  
-                continue
-            isMotion = True
-
-        rawCapture.truncate(0)    
-        return frame, isMotion
+    def captureFrame(self, camera, rawCapture, stamped, timestamp):
+        rawCapture.truncate(0)
+        camera.capture(rawCapture, format="bgr", use_video_port=True, resize=sendSize)
+        frame = stamped
+        np.copyto(frame, rawCapture.array)
+        ts = timestamp.strftime("%A %d %B %Y %I:%M:%S%p")
+        cv2.putText(frame, ts, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.35, (0, 0, 255), 1)            
+        return frame
             
 
             
@@ -202,8 +208,8 @@ class motionLoop(object):
                 
     # Work out what we need to do when motion detected
     #------------------------------------------------------------------------------------
-    def detectionEvent(self, camera, frame):
-        self.logger.debug('Motion detected. Determining course of action... ')
+    def detectionEvent(self, camera, frame, zones=None):
+        self.logger.debug('Motion detected in %s. Determining course of action... ' % ', '.join(zones or ['frame']))
 
         if isinstance(self.ENVIRON["recognizeClear"], datetime):
             if self.ENVIRON["recognizeClear"] < datetime.now():
@@ -213,31 +219,29 @@ class motionLoop(object):
         # If we are already talking then no need to start speech again
         if self.ENVIRON["talking"]:
             self.logger.debug('Motion but talking...sending image to recognize faces')
-            self.sendImage(frame, 'motion')
+            self.sendImage(frame, 'motion', zones)
             time.sleep(1)
         else:  
             # check for either security or friendly mode and delay has expired
             if (self.ENVIRON["secureMode"] or self.ENVIRON["friendMode"]) and (self.ENVIRON["motionTime"] < datetime.now()):
                 self.logger.debug('Motion detected and timer has expired so taking action. ')
                 # send image to brain to check if person detected
-                self.sendImage(frame, 'motion')
+                self.sendImage(frame, 'motion', zones)
             else:
                 diff = self.ENVIRON["motionTime"] - datetime.now()
                 self.logger.debug("Motion detected but taking no action. %s seconds delay remains" % str(diff.seconds))
                 
 
         
-    # Send image file to server
+    # Send image file to server. zones are the motion zones that were active, with their scores
     #------------------------------------------------------------------------------------
-    def sendImage(self, frame, requestType):
-        retval, buffer = cv2.imencode('.jpg', frame)
-        jpgb64 = base64.b64encode(buffer)
-        properties = pika.BasicProperties(app_id=requestType, content_type='image/jpg', reply_to=self.ENVIRON["clientName"])
+    def sendImage(self, frame, requestType, zones=None):
+        self.frameSeq += 1
+        body, headers = common_image.encodeFrame(frame, self.ENVIRON["clientName"], self.frameSeq)
+        if zones is not None:
+            headers.update(common_image.zoneHeaders(zones))
         try:
-            connection = pika.BlockingConnection(self.parameters)
-            channel = connection.channel()
-            channel.basic_publish(exchange='', routing_key='Central', body=jpgb64, properties=properties)
-            connection.close()
+            common_queue.publish(self.ENVIRON, 'Central', body, requestType, 'image/jpg', self.ENVIRON["clientName"], headers)
         except:
             self.logger.error('Unable to send image to Message Queue ' + self.ENVIRON["queueSrvr"])
         
@@ -8,14 +8,15 @@ Author: Lee Matthews 2018 - updated 2020
 
 import logging
 import time
+import collections
+import itertools
 
-import tempfile
 import wave
 import audioop
 import pyaudio
+import io
 import os
 
-import base64
 import json
 try:
     from google.cloud import speech_v1 as speech
@@ -28,11 +29,186 @@ except:
 respeaker = True
 #==============================================
 
+# Audio format and endpointing settings
+RATE = 16000
+CHUNK = 1024                    # frames per read, about 64ms at 16kHz
+LISTEN_TIME = 10                # most seconds to record
+WAIT_TIME = 5                   # seconds to wait for speech to start before giving up
+START_CHUNKS = 3                # loud chunks in a row needed to count as the start of speech
+HANGOVER = .8                   # seconds of quiet after speech that count as the end of speech
+PREROLL = .3                    # seconds of audio kept from before speech started
+MIN_LEVEL = 300                 # lowest RMS level counted as speech, whatever the noise level
+MONO_MIX = (.5, .5)             # how the 2 respeaker channels are mixed to mono. (1, 0) keeps the left channel only
+START_RATIO = 2.0               # speech starts this many times above the background noise
+END_RATIO = 1.5                 # and has ended once it falls back below this many times
+
 # Insert the correct values from your Google project
 json_file = 'my-home-ai-project-c6ff7abb0b1a.json'
 proj_name = 'my-home-ai-project'
 
 
+#---------------------------------------------------------------------------------------------
+# Voice activity endpointing. Fed one chunk at a time, it keeps an exponential average of the
+# chunk energy and of the background noise, so each update is O(1) whatever the recording length
+#---------------------------------------------------------------------------------------------
+class endpointer(object):
+
+    def __init__(self, rate, chunk, noise=None):
+        chunkTime = chunk / float(rate)
+        self.startChunks = START_CHUNKS
+        self.hangoverChunks = max(int(HANGOVER / chunkTime), 1)
+        self.waitChunks = int(WAIT_TIME / chunkTime)
+        self.maxChunks = int(LISTEN_TIME / chunkTime)
+        self.prerollChunks = max(int(PREROLL / chunkTime), 1)
+        self.noise = noise              # background noise level, learnt from the first chunk if None
+        self.adaptive = noise is None   # only learn the noise level when it was not measured for us
+        self.energy = 0.0               # smoothed level of the current audio
+        self.state = 'waiting'
+        self.count = 0
+        self.loud = 0
+        self.quiet = 0
+
+
+    # Update with the RMS level of the next chunk. Returns one of:
+    # waiting (no speech yet), started (this chunk starts speech), speech, ended or timeout
+    # ----------------------------------------------------------------------------------
+    def update(self, level):
+        self.count += 1
+        if self.noise is None:
+            self.noise = float(level)
+        self.energy = self.energy * .5 + level * .5
+
+        if self.state == 'waiting':
+            if level > max(self.noise * START_RATIO, MIN_LEVEL):
+                self.loud += 1
+            else:
+                self.loud = 0
+                # only learn the noise level while nobody is speaking. Falls quickly, rises slowly
+                if self.adaptive:
+                    rate = .5 if level < self.noise else .05
+                    self.noise = self.noise * (1 - rate) + level * rate
+            if self.loud >= self.startChunks:
+                self.state = 'started'
+            elif self.count >= self.waitChunks:
+                self.state = 'timeout'
+        else:
+            self.state = 'speech'
+            if self.energy < max(self.noise * END_RATIO, MIN_LEVEL):
+                self.quiet += 1
+            else:
+                self.quiet = 0
+            if self.quiet >= self.hangoverChunks:
+                self.state = 'ended'
+
+        if self.count >= self.maxChunks and self.state not in ['ended', 'timeout']:
+            self.state = 'ended' if self.state != 'waiting' else 'timeout'
+        return self.state
+
+
+
+#---------------------------------------------------------------------------------------------
+# Audio sources for stt.capture. Each has rate, channels, chunk, read() and close()
+#---------------------------------------------------------------------------------------------
+class micSource(object):
+
+    def __init__(self, rate=RATE, chunk=CHUNK):
+        self.rate = rate
+        self.chunk = chunk
+        if respeaker:
+            self.channels = 2
+        else:
+            self.channels = 1
+        self.p = pyaudio.PyAudio()
+        self.stream = self.p.open(format=pyaudio.paInt16,
+                                  channels=self.channels,
+                                  rate=self.rate,
+                                  input=True,
+                                  frames_per_buffer=self.chunk)
+
+    def read(self):
+        return self.stream.read(self.chunk, exception_on_overflow=False)
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.p.terminate()
+
+
+# Replays a WAV file in place of the microphone, in real time unless realtime is False
+class wavSource(object):
+
+    def __init__(self, path, chunk=CHUNK, realtime=True):
+        self.wav = wave.open(path, 'rb')
+        self.rate = self.wav.getframerate()
+        self.channels = self.wav.getnchannels()
+        self.chunk = chunk
+        self.realtime = realtime
+        self.startTime = time.perf_counter()
+        self.frames = 0
+
+    def read(self):
+        data = self.wav.readframes(self.chunk)
+        self.frames += self.chunk
+        if self.realtime:
+            wait = self.startTime + self.frames / float(self.rate) - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        return data
+
+    def close(self):
+        self.wav.close()
+
+
+
+#---------------------------------------------------------------------------------------------
+# Recognizer backends. recognize() is given a generator of 16 bit PCM chunks, which keeps
+# yielding while recording is still going on, and returns the text
+#---------------------------------------------------------------------------------------------
+class googleBackend(object):
+
+    def __init__(self, stt):
+        self.stt = stt
+
+    # Each chunk is sent to Google's streaming recognize call as it is recorded, as raw 16 bit PCM,
+    # so Google is working on the speech while we are still listening
+    def recognize(self, chunks, rate, channels):
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
+            return ''
+        return self.stt.recognizeStream(itertools.chain([first], chunks), rate)
+
+
+# Build a WAV file in memory, for any backend that needs the audio with a WAV header
+def wavBytes(chunks, rate, channels=1):
+    fp = io.BytesIO()
+    wav_fp = wave.open(fp, 'wb')
+    wav_fp.setnchannels(channels)
+    wav_fp.setsampwidth(2)
+    wav_fp.setframerate(rate)
+    for data in chunks:
+        wav_fp.writeframes(data)
+    wav_fp.close()
+    return fp.getvalue()
+
+
+# Offline backend for testing with wavSource. Reads all the audio then returns the text it was
+# given, after an optional delay standing in for the recognizer
+class offlineBackend(object):
+
+    def __init__(self, text='', delay=0):
+        self.text = text
+        self.delay = delay
+        self.received = 0
+
+    def recognize(self, chunks, rate, channels):
+        for data in chunks:
+            self.received += len(data)
+        time.sleep(self.delay)
+        return self.text
+
+
+
 # Speech to text class. We will use an external engine (google?) for stt operations
 #---------------------------------------------------------------------------------------------
 class stt():
@@ -49,6 +225,10 @@ class stt():
         self.ENVIRON = ENVIRON
         path = ENVIRON["topdir"]
         self.json_path = os.path.join(path, 'static/google', json_file)
+        self.backend = googleBackend(self)
+        self.speechStart = None
+        self.speechEnd = None
+        self.latency = None
 
 
     # function to get sound level score
@@ -58,109 +238,128 @@ class stt():
         score = rms 
         return score
 
-        
-    # Placeholder for function to listen for speech. 
-    # TODO create proper function to record and send to stt
+
+    # Generator of mono audio chunks from source, from just before speech starts until it ends.
+    # The background noise level measured by the hotword detector (avg_noise) is used if there is one.
+    # Stereo chunks are mixed down as they are read, so a whole stereo recording is never held.
+    # The source is closed as soon as speech ends, so the microphone is free again, and then
+    # ended (if given) is called, eg. to play a beep while the backend finishes
+    #---------------------------------------------------------------
+    def capture(self, source, ended=None):
+        noise = self.ENVIRON.get("avg_noise")
+        ep = endpointer(source.rate, source.chunk, float(noise) if noise else None)
+        preroll = collections.deque(maxlen=ep.prerollChunks)
+        self.speechStart = None
+        self.speechEnd = None
+        startTime = time.perf_counter()
+        try:
+            while True:
+                data = source.read()
+                if not data:
+                    # end of a replayed file
+                    if self.speechStart is not None:
+                        self.speechEnd = time.perf_counter()
+                    break
+                if source.channels == 2:
+                    data = audioop.tomono(data, 2, MONO_MIX[0], MONO_MIX[1])
+                state = ep.update(self.getScore(data))
+                if state == 'waiting':
+                    preroll.append(data)
+                elif state == 'started':
+                    self.speechStart = time.perf_counter()
+                    self.logger.debug("Speech started after %.2f seconds" % (self.speechStart - startTime))
+                    while preroll:
+                        yield preroll.popleft()
+                    yield data
+                elif state == 'speech':
+                    yield data
+                elif state == 'ended':
+                    self.speechEnd = time.perf_counter()
+                    self.logger.debug("Speech ended after %.2f seconds" % (self.speechEnd - self.speechStart))
+                    yield data
+                    break
+                else:
+                    self.logger.debug("No speech heard, so stopped listening")
+                    break
+        finally:
+            source.close()
+            if ended:
+                ended()
+
+
+    # Listen for speech and return the text. Audio is passed to the backend while recording,
+    # and the time from the end of speech to having the text is kept in self.latency
+    #---------------------------------------------------------------
+    def listenText(self, backend=None, source=None, ended=None):
+        self.logger.debug("Running stt.listenText function ")
+        backend = backend or self.backend
+        source = source or micSource()
+        text = backend.recognize(self.capture(source, ended), source.rate, 1)
+        if self.speechEnd is not None:
+            self.latency = time.perf_counter() - self.speechEnd
+            self.logger.debug("Text available %.3f seconds after the end of speech" % self.latency)
+        return text
+
+
+    # Listen until speech ends, saving the (mono) recording as a WAV to the file handle only if we were given one
     #---------------------------------------------------------------
     def listen(self, myFile):
         self.logger.debug("Running stt.listen function ")
-        
-        RATE = 16000
-        CHUNK = 1024
-        LISTEN_TIME = 10
-        if respeaker:
-            CHANNELS = 2
+        source = micSource()
+        if myFile:
+            myFile.write(wavBytes(self.capture(source), source.rate))
         else:
-            CHANNELS = 1
-
-        # Set threshold to the current average background noise
-        # TODO if voiceSensor not running we need another way to calc THRESHOLD
-        try:
-            THRESHOLD = self.ENVIRON["avg_noise"] 
-        except:
-            THRESHOLD = 2000
-
-        # prepare recording stream
-        p = pyaudio.PyAudio()
-        self.logger.debug("Opening pyaudio recording stream")
-        stream = p.open(format=pyaudio.paInt16,
-                                  channels=CHANNELS,
-                                  rate=RATE,
-                                  input=True,
-                                  frames_per_buffer=CHUNK)
-        frames = []
-
-        # waitVal determines the pause before a command is expected. (A value of 10 is around 1 second)
-        waitVal = 30
-        lastN = [THRESHOLD * waitVal for i in range(waitVal)]
-
-        for i in range(0, int(RATE / CHUNK * LISTEN_TIME)):
-            data = stream.read(CHUNK)
-            frames.append(data)
-            score = self.getScore(data)
-            lastN.pop(0)
-            lastN.append(score)
-            average = sum(lastN) / float(len(lastN))
-
-            #If average sound level is below cutoff then we have silence, so stop listening
-            print('AVG RECORDING LEVEL IS ' + str(average))
-            if average < THRESHOLD:
-                break
-
-        # save the audio data
-        stream.stop_stream()
-        stream.close()
+            for data in self.capture(source):
+                pass
         self.logger.debug("Closed pyaudio recording stream")
-
-        # Save the recording to the file handle only if we were given one
-        if myFile:
-            wav_fp = wave.open(myFile, 'wb')
-            wav_fp.setnchannels(CHANNELS)
-            wav_fp.setsampwidth(pyaudio.get_sample_size(pyaudio.paInt16))
-            wav_fp.setframerate(RATE)
-            wav_fp.writeframes(b''.join(frames))
-            wav_fp.close()
-        self.logger.debug("Returning file to client_voice.listen function")
-
         return myFile      
         
 
-    def convertMono(self, stereo):
-        monofile = os.path.join(ENVIRON["topdir"], 'static/audio/monofile.wav')
-        mono = wave.open(monofile, 'wb')
-        mono.setparams(stereo.getparams())
-        mono.setnchannels(1)
-        mono.writeframes(audioop.tomono(stereo.readframes(float('inf')), stereo.getsampwidth(), 1, 1))
-        mono.close()
-        return monofile
+    # Submit a WAV recording (file name or file handle) to Google API to convert to text 
+    #---------------------------------------------------------------
+    def transcribe(self, fp):
+        wav_fp = wave.open(fp, 'rb')
+        rate = wav_fp.getframerate()
+        data = wav_fp.readframes(wav_fp.getnframes())
+        if wav_fp.getnchannels() > 1:
+            self.logger.debug("Recording is stereo, so converting to mono ")
+            data = audioop.tomono(data, wav_fp.getsampwidth(), MONO_MIX[0], MONO_MIX[1])
+        wav_fp.close()
+        return self.recognizePCM(data, rate)
 
 
-    # Submit recording to Google API to convert to text 
+    # Stream mono 16 bit PCM chunks to Google API to convert to text, as they are recorded
     #---------------------------------------------------------------
-    def transcribe(self, fp):
+    def recognizeStream(self, chunks, rate):
         transcribed = ''
 
-        #convert stereo recording to mono file if required
-        stereo = wave.open(fp, 'rb')
-        if stereo.getnchannels() > 1:
-            self.logger.debug("Recording is stereo, so converting to mono ")
-            monofile = self.convertMono(stereo)
-            self.logger.debug("Mono file is " + monofile)
-            f=open(monofile, 'rb')  
-            data = f.read()
-            f.close()
-        else:
-            data = fp.read()
-        stereo.close()
-        
-        self.logger.debug("Converting to base64 and utf-8 ")
-        speech_content_bytes = base64.b64encode(data)
-        speech_content = speech_content_bytes.decode('utf-8')
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = self.json_path
+        os.environ["GCLOUD_PROJECT"] = proj_name
+
+        config = {'language_code': 'en-US', 'encoding': 'LINEAR16', 'sample_rate_hertz': rate}
+        streaming_config = speech.types.StreamingRecognitionConfig(config=config)
+        requests = (speech.types.StreamingRecognizeRequest(audio_content=data) for data in chunks)
+
+        self.logger.debug("Streaming audio to Google STT API ")
+        client = speech.SpeechClient()
+        for response in client.streaming_recognize(streaming_config, requests):
+            for result in response.results:
+                if result.is_final and result.alternatives:
+                    transcribed += result.alternatives[0].transcript.upper() + ' '
+
+        self.logger.debug("Transcribed: " + transcribed)
+        return transcribed
+
+
+    # Submit mono 16 bit PCM to Google API to convert to text 
+    #---------------------------------------------------------------
+    def recognizePCM(self, data, rate):
+        transcribed = ''
 
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = self.json_path
         os.environ["GCLOUD_PROJECT"] = proj_name
 
-        config = {'language_code': 'en-US'}
+        config = {'language_code': 'en-US', 'encoding': 'LINEAR16', 'sample_rate_hertz': rate}
         audio = {'content': data}
 
         self.logger.debug("Sending details to Google STT API ")
@@ -183,20 +382,27 @@ class stt():
 
 
 # Testing script that is executed if code run directly
+# With WAV files as arguments each is replayed in real time in place of the microphone and
+# recognised by the offline backend (text from a .txt file with the same name), to measure
+# endpointing and the time from the end of speech to text without Google
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
-    import tempfile
+    import sys
     ENVIRON = {}
-    ENVIRON["avg_noise"] = 1
-    ENVIRON["topdir"] = '/home/pi/robotAI4'
+    ENVIRON["topdir"] = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
     mystt = stt(ENVIRON)
-    tmpFile = tempfile.SpooledTemporaryFile(mode='w+b')
-    rec = mystt.listen(tmpFile)
-    rec.seek(0)
-    response = mystt.transcribe(tmpFile)
-    print(response)
-
-
-
-
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            txtpath = os.path.splitext(path)[0] + '.txt'
+            text = open(txtpath).read().strip() if os.path.exists(txtpath) else ''
+            startTime = time.perf_counter()
+            response = mystt.listenText(offlineBackend(text), wavSource(path))
+            if mystt.speechStart is None:
+                print("%s: no speech found" % path)
+            else:
+                print("%s: speech %.2fs to %.2fs, text after %.1fms: %s" % (path, mystt.speechStart - startTime,
+                      mystt.speechEnd - startTime, mystt.latency * 1000, response))
+    else:
+        response = mystt.listenText()
+        print(response)
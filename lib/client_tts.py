@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Text to speech with a phrase cache, used by client_voice.say
+Each phrase is synthesized once with pico2wave and kept in static/audio/tts, named by the sha1
+of the engine version, language and text. The most recently used phrases are also held in
+memory. Both caches are bounded in size and drop the least recently used phrases first.
+The static chat text (ChatText.csv) and fixed phrases can be synthesized ahead of time, either
+in the background when the client starts or by running this module.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import collections
+import threading
+import subprocess
+import hashlib
+import tempfile
+import logging
+import time
+import csv
+import os
+
+engineVersion = 'pico2wave-1'   # change this if the voice changes, so old audio is not reused
+maxDiskBytes = 100 * 1024 * 1024
+maxMemoryBytes = 8 * 1024 * 1024
+dayParts = ['Morning', 'Afternoon', 'Evening']
+
+# phrases said by the client that are not in the chat text
+fixedPhrases = ["Hi, my name is Meebo. I will let my masters know you are here.",
+                "Sorry, I could not work out what to say."]
+
+
+# All the text in ChatText.csv that can be synthesized ahead of time. '#dayPart#' rows give one
+# phrase per part of the day. Rows with '#name#' depend on who is there, and wait() rows are not spoken
+#---------------------------------------------------------------------------
+def staticPhrases(topdir):
+    phrases = list(fixedPhrases)
+    with open(os.path.join(topdir, 'static/db/ChatText.csv'), newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            text = (row['text'] or '').strip()
+            if not text or '#name#' in text or text.lower().startswith('wait('):
+                continue
+            if '#dayPart#' in text:
+                phrases.extend([text.replace('#dayPart#', part) for part in dayParts])
+            else:
+                phrases.append(text)
+    return phrases
+
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Phrase cache
+#-------------------------------------------------------------------------------------------------------------------------
+class ttsCache(object):
+
+    def __init__(self, topdir, language="en-US", logger=None):
+        if logger is None:
+            logging.basicConfig()
+            logger = logging.getLogger("client_tts")
+        self.logger = logger
+        self.language = language
+        self.cachedir = os.path.join(topdir, 'static/audio/tts')
+        os.makedirs(self.cachedir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()         # key -> WAV bytes, most recently used last
+        self.memoryBytes = 0
+        self.stats = {"memory": 0, "disk": 0, "synth": 0}
+
+        # index of the files on disk, oldest first
+        files = []
+        for name in os.listdir(self.cachedir):
+            if name.startswith('.'):
+                # temporary file left behind by a synthesis that was interrupted (newer ones may still be in progress)
+                try:
+                    if os.stat(os.path.join(self.cachedir, name)).st_mtime < time.time() - 60:
+                        os.remove(os.path.join(self.cachedir, name))
+                except OSError:
+                    pass
+            elif name.endswith('.wav'):
+                st = os.stat(os.path.join(self.cachedir, name))
+                files.append((st.st_mtime, name[:-4], st.st_size))
+        self.disk = collections.OrderedDict((key, size) for mtime, key, size in sorted(files))
+        self.diskBytes = sum(self.disk.values())
+
+
+    # Content address of a phrase
+    # ----------------------------------------------------------------------------------
+    def key(self, text):
+        return hashlib.sha1('\0'.join([engineVersion, self.language, text]).encode('utf-8')).hexdigest()
+
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key + '.wav')
+
+
+    # WAV bytes for a phrase, from memory, disk or pico2wave in that order. None if it could not be synthesized
+    # ----------------------------------------------------------------------------------
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory"] += 1
+                return self.memory[key]
+        wav = None
+        if key in self.disk:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    wav = f.read()
+                os.utime(self.path(key))
+                self.stats["disk"] += 1
+            except OSError:
+                wav = None
+        if wav is None:
+            wav = self.synthesize(text, key)
+            if wav is None:
+                return None
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            self.remember(key, wav)
+        return wav
+
+
+    # Make sure a phrase is on disk, without keeping it in memory
+    # ----------------------------------------------------------------------------------
+    def ensure(self, text):
+        key = self.key(text)
+        if key not in self.disk or not os.path.exists(self.path(key)):
+            self.synthesize(text, key)
+
+
+    # Run pico2wave into a temporary file, then rename it into place so other processes
+    # never see a half written file. Each call has its own temporary file, as the preload thread
+    # and say() can synthesize the same phrase at once. Returns None if pico2wave fails
+    # ----------------------------------------------------------------------------------
+    def synthesize(self, text, key):
+        self.logger.debug("Synthesizing '" + text + "' with Pico2Wave")
+        fname = self.path(key)
+        # pico2wave will only write to a name ending in .wav
+        fd, tmpname = tempfile.mkstemp(prefix='.' + key + '-', suffix='.wav', dir=self.cachedir)
+        os.close(fd)
+        try:
+            cmd = ['pico2wave', '--wave', tmpname, '-l', self.language, text]
+            result = subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result != 0:
+                self.logger.error("pico2wave failed with exit status %d synthesizing '%s'" % (result, text))
+                return None
+            with open(tmpname, 'rb') as f:
+                wav = f.read()
+            os.replace(tmpname, fname)
+        except OSError as e:
+            self.logger.error("Could not synthesize '" + text + "'. " + str(e))
+            return None
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+        self.stats["synth"] += 1
+        with self.lock:
+            self.diskBytes += len(wav) - self.disk.get(key, 0)
+            self.disk[key] = len(wav)
+            self.disk.move_to_end(key)
+            while self.diskBytes > maxDiskBytes and len(self.disk) > 1:
+                oldKey, size = self.disk.popitem(last=False)
+                self.diskBytes -= size
+                try:
+                    os.remove(self.path(oldKey))
+                except OSError:
+                    pass
+        return wav
+
+
+    # Add to the memory cache, dropping the least recently used phrases when over the limit
+    # ----------------------------------------------------------------------------------
+    def remember(self, key, wav):
+        if key in self.memory:
+            return
+        self.memory[key] = wav
+        self.memoryBytes += len(wav)
+        while self.memoryBytes > maxMemoryBytes and len(self.memory) > 1:
+            oldKey, oldWav = self.memory.popitem(last=False)
+            self.memoryBytes -= len(oldWav)
+
+
+    # Synthesize any phrases that are not cached yet, optionally in a background thread
+    # ----------------------------------------------------------------------------------
+    def preload(self, phrases, background=True):
+        if background:
+            t = threading.Thread(target=self.preload, args=(phrases, False), name="ttsPreload", daemon=True)
+            t.start()
+            return t
+        before = self.stats["synth"]
+        for text in phrases:
+            try:
+                self.ensure(text)
+            except Exception as e:
+                self.logger.error("Could not synthesize '" + text + "'. " + str(e))
+        self.logger.info("TTS preload finished. %d new phrases synthesized, %d cached (%.1fMB)" %
+                         (self.stats["synth"] - before, len(self.disk), self.diskBytes / 1048576.0))
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own.
+# Synthesizes all the static phrases into the cache
+# **************************************************************************
+if __name__ == "__main__":
+    import sys
+    topdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    sys.path.insert(0, topdir)
+    from lib import client_voice
+    tts = ttsCache(topdir)
+    tts.logger.level = logging.INFO
+    startTime = time.perf_counter()
+    phrases = client_voice.preparePhrases(staticPhrases(topdir))
+    tts.preload(phrases, background=False)
+    print("%d phrases in %.1f seconds" % (len(phrases), time.perf_counter() - startTime))
@@ -7,24 +7,48 @@ Author: Lee Matthews 2018 - updated 2020
 """
 
 import os
-import tempfile
-import subprocess
+import threading
 import logging
+import queue
 import json
 import re
 import time
 import datetime
-import pika
-import tempfile 
 
 # import from different points to allow for direct test
 try:
     import lib.client_stt as client_stt
+    import lib.client_tts as client_tts
+    import lib.client_audio as client_audio
 except:
     import client_stt
+    import client_tts
+    import client_audio
 
 # import shared utility finctions
 import lib.common_utils as utils
+import lib.common_queue as common_queue
+
+chatLookahead = 2               # chat lines synthesized ahead of the line being said
+
+
+# fix mention of years, eg. 2020 is said as twenty twenty
+#---------------------------------------------------------------------------
+def fixYears(text):
+    year_regex = re.compile(r'(\b)(\d\d)([1-9]\d)(\b)')
+    return year_regex.sub('\g<1>\g<2> \g<3>\g<4>', text) 
+
+
+# Chat items that the next lines must not be prepared past: a wait, or a prompt for the speaker
+#---------------------------------------------------------------------------
+def isBarrier(item):
+    return item["wait"] is not None or bool(item["row"]['funct'])
+
+
+# The text passed to the tts engine for each phrase, as voice.say would prepare it
+#---------------------------------------------------------------------------
+def preparePhrases(phrases):
+    return [fixYears(phrase).capitalize() for phrase in phrases]
 
 
 #---------------------------------------------------------------------------------------------
@@ -45,97 +69,173 @@ class voice():
         self.stt = client_stt.stt(ENVIRON)
         self.beep_hi = os.path.join(topdir, "static/audio/beep_hi.wav")
         self.beep_lo = os.path.join(topdir, "static/audio/beep_lo.wav")
+        # convert the beeps now. Sensor processes started later share them
+        try:
+            client_audio.preload(self.beep_hi)
+            client_audio.preload(self.beep_lo)
+        except Exception as e:
+            self.logger.error("Could not load the beep sounds. " + str(e))
 
-        # Setup details to access the message queue
-        credentials = pika.PlainCredentials(ENVIRON["queueUser"], ENVIRON["queuePass"])
-        self.parameters = pika.ConnectionParameters(ENVIRON["queueSrvr"], ENVIRON["queuePort"], '/',  credentials)
+        # synthesized phrases are cached. Synthesize the static chat text in the background
+        self.tts = client_tts.ttsCache(topdir, language, self.logger)
+        if ENVIRON.get("ttsPreload", "True") == "True":
+            self.tts.preload(preparePhrases(client_tts.staticPhrases(topdir)))
+        # when the last chat line finished playing, and the gaps between lines of the current chat
+        self.lineEnd = None
+        self.gaps = []
         
 
     # Text to speech using Pico2Wave - the most human sounding voice
+    # Phrases said before come straight from the tts cache. wav is the audio if already synthesized.
+    # Returns the sound played, or None if the phrase could not be synthesized
     #---------------------------------------------------------------
-    def say(self, phrase):
+    def say(self, phrase, wav=None):
         #Pico speaks sentence case better than capitals
         phrase = phrase.capitalize()
         self.logger.debug("Saying " + phrase + " with Pico2Wave")
+        if wav is None:
+            wav = self.tts.get(phrase)
+        if wav is None:
+            self.logger.error("Could not synthesize '" + phrase + "', so it was not said")
+            return None
+        return self.playWav(wav)
 
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
-            fname = f.name
-        cmd = ['pico2wave', '--wave', fname]
-        cmd.extend(['-l', self.language])
-        cmd.append(phrase)
 
-        with tempfile.TemporaryFile() as f:
-            subprocess.call(cmd, stdout=f, stderr=f)
-            f.seek(0)
-            output = f.read()
-            #if output:
-            #    self.logger.debug("Result of cmd was: " + str(output))
-        self.play(fname)
-        os.remove(fname)
+    # Play WAV data held in memory and wait for it to finish. Cut off if the chat is stopped
+    #---------------------------------------------------------------
+    def playWav(self, wav):
+        player = client_audio.getPlayer()
+        sound = player.play(wav)
+        player.wait(sound, interrupt=lambda: self.ENVIRON["stopChat"])
+        return sound
 
 
-    # Play a WAV file using aplay
+    # Play a WAV file and wait for it to finish
     #---------------------------------------------------------------
     def play(self, filename):
-        cmd = ['aplay', str(filename)]
-        with tempfile.TemporaryFile() as f:
-            subprocess.call(cmd, stdout=f, stderr=f)
-            f.seek(0)
-            output = f.read()
-            if output:
-                self.logger.debug("Result of cmd was: " + str(output))
+        return self.playWav(str(filename))
+
+
+    # Stop whatever is being said or played straight away
+    #---------------------------------------------------------------
+    def stop(self):
+        client_audio.getPlayer().stop()
 
 
 
     # loop through the chat sequence and say the text
+    # The next lines are prepared (enriched and synthesized) in a separate thread while the current
+    # line is said, unless chatPipeline is False. See prepareChat
     # ------------------------------------------------------
     def doChat(self, chatList):
         if not chatList or len(chatList) == 0:
             self.say('Sorry, I could not work out what to say.')
         else:
-            # loop through each item in the chat text returned
-            for row in chatList:
-                # break loop if we recognised someone, as new chat should be started
-                if self.ENVIRON["stopChat"]:
-                    self.logger.debug("Interrupting chat for text: " + row['text'])
-                    self.ENVIRON["stopChat"] = False
+            self.lineEnd = None
+            self.gaps = []
+            pipeline = self.ENVIRON.get("chatPipeline", "True") == "True"
+            if pipeline:
+                items = queue.Queue(maxsize=chatLookahead)
+                passed = threading.Event()
+                cancel = threading.Event()
+                producer = threading.Thread(target=self.prepareChat, args=(chatList, items, passed, cancel),
+                                            name="chatProducer", daemon=True)
+                producer.start()
+            try:
+                # loop through each item in the chat text returned
+                for row in chatList:
+                    # break loop if we recognised someone, as new chat should be started
+                    if self.ENVIRON["stopChat"]:
+                        self.logger.debug("Interrupting chat for text: " + row['text'])
+                        self.stop()
+                        self.ENVIRON["stopChat"] = False
+                        break
+                    item = items.get() if pipeline else self.prepareChatItem(row)
+                    resp = self.doChatItem(item)
+                    if pipeline and isBarrier(item):
+                        passed.set()
+                    # if we need to select a path then loop through all options and search for response
+                    nText = row['next']
+                    if '|' in nText:
+                        options = nText.split("|")
+                        for item in options:
+                            row = item.split("-")
+                            rtxt = row[0]
+                            if rtxt.upper() in resp:
+                                # Request chat data from brain
+                                body = '{"action": "getChat", "chatItem": "' + item + '"}'
+                                self.logger.debug("About to send this data: " +body)
+                                common_queue.publish(self.ENVIRON, 'Central', body, 'voice', 'application/json', self.ENVIRON["clientName"])
+            finally:
+                # stop the producer if the chat was cut short
+                if pipeline:
+                    cancel.set()
+            if self.gaps:
+                self.logger.info("Gaps between chat lines: average %.0fms, longest %.0fms (%d gaps)" %
+                                 (sum(self.gaps) / len(self.gaps) * 1000, max(self.gaps) * 1000, len(self.gaps)))
+
+
+    # Producer thread for doChat. Prepares each row in turn, staying at most chatLookahead rows
+    # ahead. It does not go past a barrier (a wait or a prompt for the speaker) until doChat has
+    # handled it, so text after a barrier is only enriched once the barrier is done
+    # ------------------------------------------------------
+    def prepareChat(self, chatList, items, passed, cancel):
+        for row in chatList:
+            try:
+                item = self.prepareChatItem(row)
+            except Exception as e:
+                # leave it to doChatItem to try again and report the error
+                self.logger.error("Could not prepare chat text '%s'. %s" % (row['text'], str(e)))
+                item = {"row": row, "text": row['text'], "wait": None, "wav": None}
+            while not cancel.is_set():
+                try:
+                    items.put(item, timeout=.1)
                     break
-                resp = self.doChatItem(row['text'], row['funct'])
-                # if we need to select a path then loop through all options and search for response
-                nText = row['next']
-                if '|' in nText:
-                    options = nText.split("|")
-                    for item in options:
-                        row = item.split("-")
-                        rtxt = row[0]
-                        if rtxt.upper() in resp:
-                            # Request chat data from brain
-                            body = '{"action": "getChat", "chatItem": "' + item + '"}'
-                            self.logger.debug("About to send this data: " +body)
-                            connection = pika.BlockingConnection(self.parameters)
-                            channel1 = connection.channel()
-                            channel1.queue_declare("Central")
-                            props = pika.BasicProperties(app_id='voice', content_type='application/json', reply_to=self.ENVIRON["clientName"])
-                            channel1.basic_publish(exchange='', routing_key='Central', body=body, properties=props)
-                            connection.close()
-       
-
-    # handle (eg. say) a single chat item
+                except queue.Full:
+                    pass
+            if isBarrier(item):
+                while not passed.wait(.1):
+                    if cancel.is_set():
+                        break
+                passed.clear()
+            if cancel.is_set():
+                return
+
+
+    # Work out what a chat row needs before it is said: the enriched text and its audio, or the
+    # number of seconds to wait if the text is "wait(xx)" where xx is an integer
+    # ------------------------------------------------------
+    def prepareChatItem(self, row):
+        item = {"row": row, "text": row['text'], "wait": None, "wav": None}
+        if re.search(r'^wait\([0-9]+\)$', row['text']) is not None:
+            item["wait"] = int(row['text'].upper().replace('WAIT(', '').replace(')', ''))
+        else:
+            item["text"] = self.enrichText(row['text'])
+            item["wav"] = self.tts.get(item["text"].capitalize())
+        return item
+
+
+    # handle (eg. say) a single chat item prepared by prepareChatItem
     # ------------------------------------------------------
-    def doChatItem(self, text, funct):
+    def doChatItem(self, item):
+        text = item["text"]
+        funct = item["row"]['funct']
         self.logger.debug("running doChatItem for function %s and text '%s'" % (funct, text))
         resp = ''
-        # if the text is "wait(xx)" where xx is an integer then wait for that time (in seconds)
-        if re.search(r'^wait\([0-9]+\)$', text) is not None:
-            text = text.upper()
-            text = text.replace('WAIT(', '').replace(')', '')
-            num = int(text)
-            time.sleep(num)
+        if item["wait"] is not None:
+            time.sleep(item["wait"])
+            self.lineEnd = None
         else:
-            text = self.enrichText(text)
-            self.say(text)
+            sound = self.say(text, item["wav"])
+            # time from the end of the last line to the start of this one
+            if self.lineEnd is not None and sound is not None and sound.started is not None:
+                gap = sound.started - self.lineEnd
+                self.gaps.append(gap)
+                self.logger.debug("Gap before this line was %.0fms" % (gap * 1000))
+            self.lineEnd = time.perf_counter()
         # if there is a function mentioned run it and get the results
         if funct:
+            self.lineEnd = None
             funct = funct.strip()
             if funct == "yesNo":
                 resp = self.getYesNo(text)
@@ -153,19 +253,18 @@ class voice():
     def listen(self, stt):
         self.ENVIRON["listen"] = False
         self.play(self.beep_hi)    
-        tmpFile = tempfile.SpooledTemporaryFile(mode='w+b')
-        rec = self.stt.listen(tmpFile)
-        self.logger.debug("received result back from listen function")
-        rec.seek(0)
-        self.play(self.beep_lo)    
-        self.ENVIRON["listen"] = True
-        self.logger.debug("About to transcribe the recorded data")
         
-        # only transcribe if we need to        
+        # only transcribe if we need to. The audio is streamed to the recognizer while we record
         if stt:
-            response = self.stt.transcribe(tmpFile)
+            response = self.stt.listenText(ended=lambda: self.play(self.beep_lo))
+            self.ENVIRON["listen"] = True
             return response
         else:
+            # just wait for the speaker to finish. The audio is not needed
+            self.stt.listen(None)
+            self.logger.debug("received result back from listen function")
+            self.play(self.beep_lo)    
+            self.ENVIRON["listen"] = True
             return stt
 
 
@@ -194,8 +293,7 @@ class voice():
             text = text.replace('#name#', names)
  
         # fix mention of years
-        year_regex = re.compile(r'(\b)(\d\d)([1-9]\d)(\b)')
-        text = year_regex.sub('\g<1>\g<2> \g<3>\g<4>', text) 
+        text = fixYears(text)
         
         return text
 
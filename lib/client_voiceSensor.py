@@ -13,13 +13,18 @@ import logging
 import signal
 import os
 import time
-import pika
 #allow for running listenloop either in isolation or via robotAI.py
 try:
     from lib.snowboy import robotAI_snowboy
 except:
     from snowboy import robotAI_snowboy
 
+# import the shared message queue publisher
+try:
+    import lib.common_queue as common_queue
+except:
+    import common_queue
+
 
 
 #======================================================
@@ -48,10 +53,6 @@ class listenLoop(object):
         #set variable for snowboy
         self.interrupted = False
 
-        # Setup details to access the message queue
-        credentials = pika.PlainCredentials(ENVIRON["queueUser"], ENVIRON["queuePass"])
-        self.parameters = pika.ConnectionParameters(ENVIRON["queueSrvr"], ENVIRON["queuePort"], '/',  credentials)
-
 
     #Snowboy signal_handler
     def signal_handler(self, signal, frame):
@@ -82,12 +83,7 @@ class listenLoop(object):
             # Submit returned text to our intent engine. Then brain will respond over the msgqueue
             body = '{"action": "getResponse", "text": "' + response + '"}'
             self.logger.debug("About to send this data: " +body)
-            connection = pika.BlockingConnection(self.parameters)
-            channel1 = connection.channel()
-            channel1.queue_declare("Central")
-            props = pika.BasicProperties(app_id='voice', content_type='application/json', reply_to=self.ENVIRON["clientName"])
-            channel1.basic_publish(exchange='', routing_key='Central', body=body, properties=props)
-            connection.close()
+            common_queue.publish(self.ENVIRON, 'Central', body, 'voice', 'application/json', self.ENVIRON["clientName"])
             
             # set listen back to true - rely on client_voice to set to false when busy
             self.ENVIRON["listen"] = True
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Post-processing for the output of the OpenCV SSD models (MobileNetSSD and the res10 face
+detector). Works on the whole detections array at once with NumPy rather than looping over
+each detection in Python. Used by brain_motion and the faceid recognize scripts.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import numpy as np
+
+# one row per detection
+detectionType = np.dtype([("image", np.int32), ("classId", np.int32), ("confidence", np.float32), ("box", np.int32, (4,))])
+
+
+# Filter raw SSD output, shape (1, 1, N, 7), into a structured array of detections sorted by
+# confidence. Boxes are scaled to w x h pixels. Optionally keep only one image of a batch,
+# only the class ids in allowed, and apply class-wise non-maximum suppression
+#---------------------------------------------------------------------------
+def parseDetections(detections, cutoff, w, h, imageId=None, allowed=None, nmsThresh=None):
+    rows = detections.reshape(-1, 7)
+    mask = rows[:, 2] > cutoff
+    if imageId is not None:
+        mask &= rows[:, 0].astype(np.int32) == imageId
+    if allowed is not None:
+        mask &= np.isin(rows[:, 1].astype(np.int32), allowed)
+    rows = rows[mask]
+    rows = rows[np.argsort(-rows[:, 2], kind="stable")]
+
+    result = np.empty(len(rows), dtype=detectionType)
+    result["image"] = rows[:, 0]
+    result["classId"] = rows[:, 1]
+    result["confidence"] = rows[:, 2]
+    result["box"] = rows[:, 3:7] * np.array([w, h, w, h], dtype=np.float32)
+    if nmsThresh:
+        result = classNMS(result, nmsThresh)
+    return result
+
+
+# Greedy non-maximum suppression. boxes are (N, 4) sorted by descending score.
+# Returns the indexes of the boxes to keep
+#---------------------------------------------------------------------------
+def nms(boxes, thresh):
+    boxes = boxes.astype(np.float64)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    order = np.arange(len(boxes))
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        iw = np.maximum(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0)
+        ih = np.maximum(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0)
+        inter = iw * ih
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        order = rest[iou <= thresh]
+    return np.array(keep, dtype=np.int64)
+
+
+# Non-maximum suppression within each class (and each image of a batch). Boxes of different
+# classes are shifted apart so one pass of nms never compares them
+#---------------------------------------------------------------------------
+def classNMS(dets, thresh):
+    if len(dets) < 2:
+        return dets
+    boxes = dets["box"].astype(np.float64)
+    offset = float(boxes.max()) + 1
+    group = (dets["image"].astype(np.float64) * 1000 + dets["classId"]) * offset
+    keep = nms(boxes + group[:, None], thresh)
+    return dets[np.sort(keep)]
+
+
+# Number of detections of each class id, as an array of length numClasses
+#---------------------------------------------------------------------------
+def classCounts(dets, numClasses):
+    return np.bincount(dets["classId"], minlength=numClasses)
+
+
+# Dictionary of class name to count, for the classes that were detected
+#---------------------------------------------------------------------------
+def countsDict(dets, classes):
+    counts = classCounts(dets, len(classes))
+    return {classes[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+
+# Detections as a list of plain dictionaries, suitable for json
+#---------------------------------------------------------------------------
+def toList(dets, classes):
+    return [{"label": classes[d["classId"]], "confidence": round(float(d["confidence"]), 3), "box": [int(v) for v in d["box"]]}
+            for d in dets]
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Wire format for images sent between robotai_client and robotai_brain
+Version 2 sends the raw JPEG bytes as the message body, with details about the frame in the
+message headers. Version 1 (no headers) sent the JPEG base64 encoded, and is still decoded so
+older clients keep working during an upgrade.
+Motion frames can also say which motion zones were active on the client (see client_motionAnalysis),
+so the brain can skip frames where only zones it does not care about had motion.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import base64
+import time
+
+frameVersion = 2
+
+
+# Encode a frame as JPEG. Returns the message body and the headers to send with it
+#---------------------------------------------------------------------------
+def encodeFrame(frame, clientName, seq, captured=None):
+    import cv2
+    retval, buffer = cv2.imencode('.jpg', frame)
+    if captured is None:
+        captured = time.time()
+    # AMQP headers can not hold a float, so the capture time is sent as milliseconds since the epoch
+    headers = {"frameVersion": frameVersion,
+               "captured": int(captured * 1000),
+               "width": int(frame.shape[1]),
+               "height": int(frame.shape[0]),
+               "client": clientName,
+               "seq": seq}
+    return buffer.tobytes(), headers
+
+
+# Return the JPEG bytes and the frame details from a received message. The capture time and zone
+# scores in the details are converted back to seconds since the epoch and fractions
+#---------------------------------------------------------------------------
+def decodeFrame(headers, body):
+    if headers and int(headers.get("frameVersion", 1)) >= 2:
+        meta = dict(headers)
+        if "captured" in meta:
+            meta["captured"] = int(meta["captured"]) / 1000.0
+        if "zoneScores" in meta:
+            meta["zoneScores"] = {name: int(score) / 1000.0 for name, score in meta["zoneScores"].items()}
+        return body, meta
+    # legacy client sending base64 text with no headers
+    return base64.b64decode(body), {"frameVersion": 1}
+
+
+# Headers describing the active motion zones, from a dict of zone name and score. Scores are
+# sent as whole numbers per thousand, as AMQP headers can not hold a float
+#---------------------------------------------------------------------------
+def zoneHeaders(zones):
+    return {"zones": ",".join(sorted(zones)),
+            "zoneScores": {name: int(round(score * 1000)) for name, score in zones.items()}}
+
+
+# False if the frame came with zone details and every active zone is in ignoreZones (a comma
+# separated list of zone names). Frames without zone details are always relevant
+#---------------------------------------------------------------------------
+def zonesRelevant(headers, ignoreZones):
+    if not headers or "zones" not in headers:
+        return True
+    zones = headers["zones"]
+    if isinstance(zones, bytes):
+        zones = zones.decode("utf-8")
+    ignore = [name.strip() for name in (ignoreZones or "").split(",") if name.strip()]
+    active = [name.strip() for name in zones.split(",") if name.strip()]
+    return any(name not in ignore for name in active)
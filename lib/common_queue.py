@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""
+===============================================================================================
+Shared message queue publisher used by robotai_brain and robotai_client
+Keeps one long lived connection per process instead of connecting for every message.
+Messages are placed in a bounded local outbox and sent by a background thread, so callers
+never wait on the network. The connection is rebuilt with a backoff if the queue goes away.
+A message that fails for any other reason, or fails publishAttempts times, is logged and dropped
+so it can not hold up the messages behind it. While idle the thread services the connection so
+heartbeats keep it open.
+Author: Lee Matthews 2020
+===============================================================================================
+"""
+import logging
+import threading
+import queue
+import time
+import os
+import pika
+import pika.exceptions
+
+
+#settings for the publisher
+outboxSize = 200                # max messages held locally while the queue is unreachable
+backoffStart = 0.5              # first wait (seconds) before trying to reconnect
+backoffMax = 30                 # longest wait (seconds) between reconnect attempts
+statsEvery = 300                # how often (messages) to log the publish latency figures
+publishAttempts = 10            # attempts to publish a message before it is dropped
+serviceEvery = 1                # how often (seconds) to service the connection while idle
+
+# errors that mean the connection or channel has gone and should be rebuilt
+connectionErrors = (pika.exceptions.AMQPConnectionError, pika.exceptions.StreamLostError,
+                    pika.exceptions.ChannelClosed, pika.exceptions.ConnectionWrongStateError,
+                    pika.exceptions.ChannelWrongStateError)
+
+_publishers = {}                # one publisher per process, keyed by pid
+_lock = threading.Lock()
+
+
+#-------------------------------------------------------------------------------------------------------------------------
+# Publisher class. Owns the connection and does all sending from its own thread
+#-------------------------------------------------------------------------------------------------------------------------
+class publisher(object):
+
+    def __init__(self, ENVIRON, maxOutbox=outboxSize):
+        debugOn = True
+
+        # setup logging based on level
+        logging.basicConfig()
+        logger = logging.getLogger("common_queue")
+        if debugOn:
+            logger.level = logging.DEBUG
+        else:
+            logger.level = logging.INFO
+        self.logger = logger
+
+        # Setup details to access the message queue
+        credentials = pika.PlainCredentials(ENVIRON["queueUser"], ENVIRON["queuePass"])
+        self.parameters = pika.ConnectionParameters(ENVIRON["queueSrvr"], ENVIRON["queuePort"], '/',  credentials)
+
+        self.outbox = queue.Queue(maxsize=maxOutbox)
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+        self.backoff = backoffStart
+        self.thread = None
+        self.threadLock = threading.Lock()
+
+        # counters so we can see what publishing actually costs
+        self.stats = {"sent": 0, "dropped": 0, "errors": 0, "connects": 0,
+                      "queueWait": 0.0, "publishTime": 0.0, "maxPublishTime": 0.0}
+
+
+    # Queue a message for sending. Never blocks; drops the oldest message if the outbox is full
+    # ----------------------------------------------------------------------------------
+    def publish(self, routing_key, body, app_id, content_type, reply_to, headers=None):
+        self.start()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        item = (time.perf_counter(), routing_key, body, app_id, content_type, reply_to, headers)
+        while True:
+            try:
+                self.outbox.put_nowait(item)
+                return True
+            except queue.Full:
+                try:
+                    self.outbox.get_nowait()
+                    self.stats["dropped"] += 1
+                    self.logger.warning('Publisher outbox full. Dropped oldest message')
+                except queue.Empty:
+                    pass
+
+
+    # Start the sending thread if it is not already running
+    # ----------------------------------------------------------------------------------
+    def start(self):
+        with self.threadLock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.sendLoop, name="publisher", daemon=True)
+                self.thread.start()
+
+
+    # Wait until everything in the outbox has been sent, or until timeout (seconds)
+    # ----------------------------------------------------------------------------------
+    def flush(self, timeout=5):
+        endTime = time.time() + timeout
+        while self.outbox.unfinished_tasks > 0 and time.time() < endTime:
+            time.sleep(.01)
+        return self.outbox.unfinished_tasks == 0
+
+
+    # Open the connection and channel if we do not already have them
+    # ----------------------------------------------------------------------------------
+    def connect(self):
+        if self.connection is not None and self.connection.is_open and self.channel is not None and self.channel.is_open:
+            return
+        self.disconnect()
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        self.declared = set()
+        self.backoff = backoffStart
+        self.stats["connects"] += 1
+        self.logger.debug('Publisher connected to Message Queue ' + str(self.parameters.host))
+
+
+    # Close down the connection quietly so it can be rebuilt
+    # ----------------------------------------------------------------------------------
+    def disconnect(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except:
+            pass
+        self.connection = None
+        self.channel = None
+
+
+    # Declare a queue only the first time we send to it on this connection
+    # ----------------------------------------------------------------------------------
+    def declare(self, routing_key):
+        if routing_key not in self.declared:
+            self.channel.queue_declare(routing_key)
+            self.declared.add(routing_key)
+
+
+    # Send heartbeats and handle anything else the broker has sent while we are idle
+    # ----------------------------------------------------------------------------------
+    def service(self):
+        if self.connection is None or not self.connection.is_open:
+            return
+        try:
+            self.connection.process_data_events(time_limit=0)
+        except Exception as e:
+            self.logger.warning('Lost connection to Message Queue ' + str(self.parameters.host) + ' while idle. ' + str(e))
+            self.disconnect()
+
+
+    # Background loop that sends messages from the outbox
+    # ----------------------------------------------------------------------------------
+    def sendLoop(self):
+        while True:
+            try:
+                item = self.outbox.get(timeout=serviceEvery)
+            except queue.Empty:
+                self.service()
+                continue
+            queued, routing_key, body, app_id, content_type, reply_to, headers = item
+            try:
+                for attempt in range(1, publishAttempts + 1):
+                    try:
+                        self.connect()
+                        startTime = time.perf_counter()
+                        self.declare(routing_key)
+                        properties = pika.BasicProperties(app_id=app_id, content_type=content_type, reply_to=reply_to, headers=headers)
+                        self.channel.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+                        endTime = time.perf_counter()
+                        self.recordStats(queued, startTime, endTime)
+                        break
+                    except connectionErrors as e:
+                        self.stats["errors"] += 1
+                        if attempt == publishAttempts:
+                            self.drop(routing_key, 'Gave up after ' + str(attempt) + ' attempts. ' + str(e))
+                            break
+                        self.logger.error('Unable to publish to Message Queue ' + str(self.parameters.host) +
+                                          '. Retrying in ' + str(self.backoff) + ' seconds. ' + str(e))
+                        self.disconnect()
+                        time.sleep(self.backoff)
+                        self.backoff = min(self.backoff * 2, backoffMax)
+                    except Exception as e:
+                        # the message itself can not be sent (eg. a header pika can not encode), so retrying will not help
+                        self.stats["errors"] += 1
+                        self.drop(routing_key, str(e))
+                        break
+            finally:
+                self.outbox.task_done()
+
+
+    # Log a message that could not be published, which is then dropped
+    # ----------------------------------------------------------------------------------
+    def drop(self, routing_key, reason):
+        self.stats["dropped"] += 1
+        self.logger.error('Dropped message for ' + routing_key + '. ' + reason)
+
+
+    # Keep running totals of time spent waiting in the outbox and publishing
+    # ----------------------------------------------------------------------------------
+    def recordStats(self, queued, startTime, endTime):
+        elapsed = endTime - startTime
+        self.stats["sent"] += 1
+        self.stats["queueWait"] += startTime - queued
+        self.stats["publishTime"] += elapsed
+        if elapsed > self.stats["maxPublishTime"]:
+            self.stats["maxPublishTime"] = elapsed
+        if self.stats["sent"] % statsEvery == 0:
+            self.logger.debug(self.statsText())
+
+
+    # Summary of the publish latency counters
+    # ----------------------------------------------------------------------------------
+    def statsText(self):
+        sent = max(self.stats["sent"], 1)
+        return ("Publisher sent %d msgs over %d connection(s). avg publish %.2fms, max %.2fms, avg outbox wait %.2fms, dropped %d, errors %d" %
+                (self.stats["sent"], self.stats["connects"], self.stats["publishTime"] / sent * 1000, self.stats["maxPublishTime"] * 1000,
+                 self.stats["queueWait"] / sent * 1000, self.stats["dropped"], self.stats["errors"]))
+
+
+
+#---------------------------------------------------------------------------
+# Return the publisher for this process, creating it on first use.
+# Processes started with multiprocessing each get their own connection.
+#---------------------------------------------------------------------------
+def getPublisher(ENVIRON):
+    pid = os.getpid()
+    with _lock:
+        if pid not in _publishers:
+            _publishers[pid] = publisher(ENVIRON)
+        return _publishers[pid]
+
+
+# Convenience function to queue a message using this process' publisher
+#---------------------------------------------------------------------------
+def publish(ENVIRON, routing_key, body, app_id, content_type, reply_to, headers=None):
+    return getPublisher(ENVIRON).publish(routing_key, body, app_id, content_type, reply_to, headers)
+
+
+
+# **************************************************************************
+# This will only be executed when we run the module on its own for debugging
+# Sends a burst of messages so the latency counters can be compared against
+# opening a BlockingConnection per message
+# **************************************************************************
+if __name__ == "__main__":
+    ENVIRON = {}
+    ENVIRON["queueSrvr"] = '192.168.1.50'
+    ENVIRON["queuePort"] = 5672
+    ENVIRON["queueUser"] = 'guest'
+    ENVIRON["queuePass"] = 'guest'
+    count = 200
+
+    credentials = pika.PlainCredentials(ENVIRON["queueUser"], ENVIRON["queuePass"])
+    parameters = pika.ConnectionParameters(ENVIRON["queueSrvr"], ENVIRON["queuePort"], '/',  credentials)
+    startTime = time.perf_counter()
+    for i in range(count):
+        connection = pika.BlockingConnection(parameters)
+        channel = connection.channel()
+        channel.queue_declare('PublishTest')
+        channel.basic_publish(exchange='', routing_key='PublishTest', body=b'x' * 20000)
+        connection.close()
+    oldTime = time.perf_counter() - startTime
+    print("Connection per message: %.2fms per message" % (oldTime / count * 1000))
+
+    pub = getPublisher(ENVIRON)
+    startTime = time.perf_counter()
+    for i in range(count):
+        pub.publish('PublishTest', b'x' * 20000, 'test', 'text', 'PublishTest')
+    pub.flush(60)
+    newTime = time.perf_counter() - startTime
+    print("Shared publisher: %.2fms per message" % (newTime / count * 1000))
+    print(pub.statsText())
@@ -72,8 +72,19 @@ def testInternet(logger, tries, server="www.google.com"):
 import tempfile
 import subprocess 
 
-# Function to play a WAV file using aplay 
+# Function to play a WAV file, through the audio output service if PyAudio is available
+# on this device, otherwise using aplay
 def play(filename):
+    try:
+        from lib import client_audio
+        player = client_audio.getPlayer()
+        item = player.play(str(filename))
+    except Exception:
+        # no PyAudio, or the output stream could not be opened, so nothing has been queued
+        item = None
+    if item is not None:
+        player.wait(item)
+        return
     cmd = ['aplay', str(filename)]
     with tempfile.TemporaryFile() as f:
         subprocess.call(cmd, stdout=f, stderr=f)
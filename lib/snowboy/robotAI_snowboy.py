@@ -6,6 +6,7 @@ import time
 import wave
 import os
 import logging
+import subprocess
 from ctypes import *
 from contextlib import contextmanager
 
@@ -64,11 +65,21 @@ class RingBuffer(object):
 
 
 def play_audio_file(fname=DETECT_DING):
-    cmd = ['aplay', str(filename)]
-    with tempfile.TemporaryFile() as f:
-        subprocess.call(cmd, stdout=f, stderr=f)
-        f.seek(0)
-        output = f.read()
+    # robotAI - play through the shared audio output service rather than forking aplay,
+    # falling back to aplay only if the sound could not be queued (no PyAudio or no output device)
+    try:
+        try:
+            from lib import client_audio
+        except ImportError:
+            import client_audio
+        player = client_audio.getPlayer()
+        item = player.play(fname)
+    except Exception:
+        item = None
+    if item is not None:
+        player.wait(item)
+        return
+    subprocess.call(['aplay', str(fname)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
 class HotwordDetector(object):
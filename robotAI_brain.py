@@ -12,12 +12,13 @@ import socket
 import logging
 import os
 import configparser
-import base64
 from multiprocessing import Process
 
 
 # import shared utility functions (this also sets some common variables)
 from lib import common_utils as utils
+from lib import common_image
+from lib import brain_imagestore
 
 
 #---------------------------------------------------------
@@ -33,6 +34,33 @@ config.read(myfile)
 # Various functions
 #---------------------------------------------------------
 
+# Functions that load the ML models. Called in the background by brain_models
+# -------------------------------------------------------
+def loadMotion():
+    global batcher
+    import lib.brain_motion as motion
+    detectorAPI = motion.detectorAPI(ENVIRON)
+    # collect motion frames from all clients into batches for the object detector
+    if int(ENVIRON["batchWindow"]) > 0:
+        from lib.brain_batch import batchScheduler
+        batcher = batchScheduler(detectorAPI, int(ENVIRON["batchWindow"]), int(ENVIRON["batchSize"]))
+    return detectorAPI
+
+
+def loadVoice():
+    import lib.brain_voice as voice
+    return voice.voiceAPI(ENVIRON)
+
+
+# Handle a motion message once the detector is ready
+# -------------------------------------------------------
+def motionLogic(detectorAPI, content, reply_to, body, headers):
+    if batcher is not None:
+        batcher.submit(content, reply_to, body, headers)
+    else:
+        detectorAPI.doLogic(None, content, reply_to, body, headers)
+
+
 # Function executed when queue message received
 # -------------------------------------------------------
 def callback(ch, method, properties, body):
@@ -48,6 +76,9 @@ def callback(ch, method, properties, body):
     if app_id == 'connect':
         # For connection events send the current environment data to client
         import json
+        logger.debug(models.statusText())
+        if models.get('motion') is not None:
+            logger.debug(models.get('motion').admission.statsText())
         body = json.dumps(ENVIRON)        
         channel1 = connection.channel()
         channel1.queue_declare(reply_to)
@@ -55,17 +86,19 @@ def callback(ch, method, properties, body):
         channel1.basic_publish(exchange='', routing_key=reply_to, body=body, properties=properties)
     elif app_id == 'camera':
         # For camera events just overwrite the latest image
-        imgbin = base64.b64decode(body)
-        filePath = os.path.join(topdir, 'static/motionImages', reply_to + '.jpg') 
-        with open(filePath, 'wb') as f_output:
-            f_output.write(imgbin)
+        imgbin, meta = common_image.decodeFrame(properties.headers, body)
+        brain_imagestore.getStore(ENVIRON).latest(reply_to, imgbin)
         #logger.debug("Saved image to " + filePath )
     elif app_id == 'motion':
-        # For motion detection events check the image for any humans
-        detectorAPI.doLogic(connection, content, reply_to, body)
+        # For motion detection events check the image for any humans (held until the model is loaded)
+        headers = properties.headers
+        if not common_image.zonesRelevant(headers, ENVIRON["ignoreZones"]):
+            logger.debug("Skipping motion from " + reply_to + " as it was only in zones " + str(headers.get("zones")))
+        else:
+            models.submit('motion', lambda detectorAPI: motionLogic(detectorAPI, content, reply_to, body, headers))
     elif app_id == 'voice':
         # For voice events we need to determine intent of the speech and reply accordingly
-        voiceAPI.doLogic(content, reply_to, body)
+        models.submit('voice', lambda voiceAPI: voiceAPI.doLogic(content, reply_to, body))
     elif app_id == 'button':
         button.doLogic(content, body, logger, ENVIRON)
     else:
@@ -97,23 +130,59 @@ if __name__ == '__main__':
     ENVIRON["queueUser"] = config['QUEUE']['queueUser']
     ENVIRON["queuePass"] = config['QUEUE']['queuePass']
     ENVIRON["brainQueue"] = config['QUEUE']['brainQueue']
-    ENVIRON["keepImages"] = config['BRAIN']['keepMotionImages']
+    ENVIRON["keepImages"] = config['BRAIN'].get('keepMotionImages', 'False')
+    ENVIRON["imageMaxDays"] = config['BRAIN'].get('imageMaxDays', '7')
+    ENVIRON["imageMaxMB"] = config['BRAIN'].get('imageMaxMB', '500')
+    ENVIRON["recordEvents"] = config['BRAIN'].get('recordEvents', 'True')
+    ENVIRON["faceCascade"] = config['BRAIN'].get('faceCascade', 'True')
+    ENVIRON["faceFallback"] = config['BRAIN'].get('faceFallback', 'True')
+    ENVIRON["faceMatchCutoff"] = config['BRAIN'].get('faceMatchCutoff', '0.5')
+    ENVIRON["faceBackend"] = config['BRAIN'].get('faceBackend', 'svc')
+    ENVIRON["faceIndexCutoff"] = config['BRAIN'].get('faceIndexCutoff', '0.7')
+    ENVIRON["objectClasses"] = config['BRAIN'].get('objectClasses', '')
+    ENVIRON["objectNMS"] = config['BRAIN'].get('objectNMS', '0')
+    ENVIRON["batchWindow"] = config['BRAIN'].get('batchWindow', '0')
+    ENVIRON["batchSize"] = config['BRAIN'].get('batchSize', '8')
+    ENVIRON["lazyModels"] = config['BRAIN'].get('lazyModels', '')
+    ENVIRON["chatEngine"] = config['BRAIN'].get('chatEngine', 'keras')
+    ENVIRON["ignoreZones"] = config['BRAIN'].get('ignoreZones', '')
+    ENVIRON["dedupDistance"] = config['BRAIN'].get('dedupDistance', '5')
+    ENVIRON["maxInferenceRate"] = config['BRAIN'].get('maxInferenceRate', '2')
+
+    # worker pool settings. With 0 workers the models run in this process
+    brainWorkers = int(config['BRAIN'].get('brainWorkers', '0'))
+    fastWorkers = int(config['BRAIN'].get('fastWorkers', '1'))
+    voiceWorkers = int(config['BRAIN'].get('voiceWorkers', '1'))
+    workerPrefetch = int(config['BRAIN'].get('workerPrefetch', '1'))
 
     #instatiate code libraries to save time 
     #-----------------------------------------------------
-    logger.debug("Loading the code libraries for faster responses ")
-    import lib.brain_motion as motion
-    detectorAPI = motion.detectorAPI(ENVIRON)
-    import lib.brain_voice as voice
-    voiceAPI = voice.voiceAPI(ENVIRON)
-    import lib.brain_button as button
+    if brainWorkers > 0:
+        # each worker loads its own copy of the models
+        from lib import brain_workers
+        logger.info("Starting %d model worker(s), %d voice worker(s) and %d fast lane worker(s)" % (brainWorkers, voiceWorkers, fastWorkers))
+        for lane, count in [('slow', brainWorkers), ('voice', max(voiceWorkers, 1)), ('fast', max(fastWorkers, 1))]:
+            for i in range(count):
+                w = Process(target=brain_workers.runWorker, args=(ENVIRON, lane, workerPrefetch))
+                w.start()
+    else:
+        # the models load in the background while we start listening to the queue
+        logger.debug("Loading the code libraries in the background ")
+        from lib.brain_models import modelRegistry
+        batcher = None
+        models = modelRegistry(ENVIRON["lazyModels"].split(','))
+        models.register('motion', loadMotion)
+        models.register('voice', loadVoice)
+        models.start()
+        import lib.brain_button as button
 
     # define some variables
     isWWWeb = False		
     isQueue = False
 
-    # test internet connection
-    isWWWeb = utils.testInternet(logger, 5, "www.google.com")
+    # test internet connection (in the background as this can take several seconds)
+    import threading
+    threading.Thread(target=utils.testInternet, args=(logger, 5, "www.google.com"), daemon=True).start()
 
 
     # Try and connect to the message queue
@@ -146,7 +215,12 @@ if __name__ == '__main__':
    
     # If successful start listening on Central channel 
     #------------------------------------------------------
-    if isQueue:
+    if isQueue and brainWorkers > 0:
+        try:
+            brain_workers.router(ENVIRON, logger).run(connection, channel)
+        except:
+            logger.error('Failed to start routing messages from channel ' + config['QUEUE']['brainQueue'])
+    elif isQueue:
         try:
             logger.debug('Starting to listen on channel ' + config['QUEUE']['brainQueue'])
             channel.basic_consume(queue=config['QUEUE']['brainQueue'], on_message_callback=callback, auto_ack=True)
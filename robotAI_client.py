@@ -87,6 +87,9 @@ if __name__ == '__main__':
     ENVIRON["topdir"] = topdir
     ENVIRON["buttonAudio"] = config['CLIENT']['buttonAudio']              # the audio file triggered on brain when button pressed
     ENVIRON["buttonVoice"] = config['CLIENT']['buttonVoice']              # the words spoken on brain when button is pressed
+    ENVIRON["ttsPreload"] = config['CLIENT'].get('ttsPreload', 'True')    # synthesize the static chat text at startup
+    ENVIRON["chatPipeline"] = config['CLIENT'].get('chatPipeline', 'True')    # synthesize the next chat line while one is said
+    ENVIRON["motionZones"] = config['CLIENT'].get('motionZones', '')          # areas of the image checked for motion
     # these defaults will be updated from central on connect
     ENVIRON["secureMode"] = config['CLIENT']['secureMode']
     ENVIRON["friendMode"] = config['CLIENT']['friendMode']
@@ -0,0 +1,171 @@
+# USAGE
+# python3 enrol_faces.py [--workers 4] [--full]
+
+#=========================================================================
+# Incremental version of extract_embeddings.py. Each image is cached by path, modified time,
+# size and content hash, so a rerun only embeds images that are new or have changed. The work
+# is spread over a pool of processes, each loading its own copy of the models.
+# Writes output/embeddings.npy (float32, one row per face, can be memory mapped), output/names.json
+# (name and image path for each row) and output/embeddings.pickle for train_model.py
+# Faces the brain added at runtime (path null in names.json) have no image, so they are kept as they are.
+#=========================================================================
+
+# import the necessary packages
+from multiprocessing import Pool
+from imutils import paths
+import numpy as np
+import argparse
+import hashlib
+import imutils
+import pickle
+import json
+import cv2
+import os
+
+# setup paths to the various files and parameters required
+thisdir = os.path.dirname(os.path.realpath(__file__))
+dataset = os.path.join(thisdir, 'dataset')
+embeddings_npy = os.path.join(thisdir, 'output/embeddings.npy')
+names_json = os.path.join(thisdir, 'output/names.json')
+cache_json = os.path.join(thisdir, 'output/embedcache.json')
+embeddings = os.path.join(thisdir, 'output/embeddings.pickle')
+embedding_model = os.path.join(thisdir, 'openface_nn4.small2.v1.t7')
+conf_cutoff = .5
+
+# models loaded once in each worker process
+detector = None
+embedder = None
+
+
+# load our serialized face detector and embedding model from disk (once per worker)
+def loadModels():
+	global detector, embedder
+	protoPath = os.path.join(thisdir, "deploy.prototxt")
+	modelPath = os.path.join(thisdir, "res10_300x300_ssd_iter_140000.caffemodel")
+	detector = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
+	embedder = cv2.dnn.readNetFromTorch(embedding_model)
+
+
+# hash of the image contents, so a touched but unchanged file is not embedded again
+def fileHash(imagePath):
+	h = hashlib.sha1()
+	with open(imagePath, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+# find the single most confident face in an image and return its 128-d embedding (or None)
+def embedImage(imagePath):
+	# load the image, resize to 600 pixels wide (maintain aspect ratio), and then get dimensions
+	image = cv2.imread(imagePath)
+	if image is None:
+		return imagePath, None
+	image = imutils.resize(image, width=600)
+	(h, w) = image.shape[:2]
+
+	# construct a blob from the image and localize faces in it
+	imageBlob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0), swapRB=False, crop=False)
+	detector.setInput(imageBlob)
+	detections = detector.forward()
+
+	# assume each image has only ONE face, so find the bounding box with the largest probability
+	if detections.shape[2] == 0:
+		return imagePath, None
+	i = np.argmax(detections[0, 0, :, 2])
+	if detections[0, 0, i, 2] <= conf_cutoff:
+		return imagePath, None
+
+	# extract the face ROI, and ensure it is sufficiently large
+	box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
+	(startX, startY, endX, endY) = box.astype("int")
+	face = image[max(startY, 0):endY, max(startX, 0):endX]
+	(fH, fW) = face.shape[:2]
+	if fW < 20 or fH < 20:
+		return imagePath, None
+
+	# pass the face through our embedding model to obtain the 128-d quantification of the face
+	faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255, (96, 96), (0, 0, 0), swapRB=True, crop=False)
+	embedder.setInput(faceBlob)
+	return imagePath, embedder.forward().flatten().astype(np.float32)
+
+
+# load what was produced by the previous run, keyed by image path, and the faces added at runtime
+def loadPrevious():
+	previous = {}
+	runtime = []
+	if os.path.exists(embeddings_npy) and os.path.exists(names_json):
+		vecs = np.load(embeddings_npy, mmap_mode='r')
+		rows = json.load(open(names_json))
+		cache = json.load(open(cache_json)) if os.path.exists(cache_json) else {}
+		for row, vec in zip(rows, vecs):
+			if row.get("path") is None:
+				runtime.append((None, row["name"], np.array(vec)))
+			elif row["path"] in cache:
+				previous[row["path"]] = (cache[row["path"]], row["name"], np.array(vec))
+		# images that had no usable face are cached too, so they are not retried every run. An image
+		# with no row that is not known to be faceless (eg. an older cache) is embedded again
+		for path in cache:
+			if path not in previous and cache[path].get("face") is False:
+				previous[path] = (cache[path], None, None)
+	return previous, runtime
+
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser()
+	ap.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+	ap.add_argument("-f", "--full", action="store_true", help="ignore the cache and embed every image")
+	args = vars(ap.parse_args())
+
+	previous, runtime = loadPrevious()
+	if args["full"]:
+		previous = {}
+
+	# work out which images are unchanged, and which need embedding
+	print("[INFO] checking images...")
+	cache = {}
+	keep = []
+	todo = []
+	for imagePath in sorted(paths.list_images(dataset)):
+		relPath = os.path.relpath(imagePath, thisdir)
+		stat = os.stat(imagePath)
+		entry = {"mtime": stat.st_mtime, "size": stat.st_size}
+		old = previous.get(relPath)
+		if old is not None and old[0]["mtime"] == entry["mtime"] and old[0]["size"] == entry["size"]:
+			entry["sha1"] = old[0]["sha1"]
+		else:
+			entry["sha1"] = fileHash(imagePath)
+		cache[relPath] = entry
+		if old is not None and old[0]["sha1"] == entry["sha1"]:
+			entry["face"] = old[1] is not None
+			if old[1] is not None:
+				keep.append((relPath, old[1], old[2]))
+		else:
+			todo.append(imagePath)
+	print("[INFO] {} unchanged, {} to embed, {} removed".format(len(cache) - len(todo), len(todo), len(set(previous) - set(cache))))
+
+	# embed the new and changed images across a pool of workers
+	added = []
+	if todo:
+		with Pool(processes=max(min(args["workers"], len(todo)), 1), initializer=loadModels) as pool:
+			for (i, (imagePath, vec)) in enumerate(pool.imap_unordered(embedImage, todo)):
+				print("[INFO] processed image {}/{}".format(i + 1, len(todo)))
+				cache[os.path.relpath(imagePath, thisdir)]["face"] = vec is not None
+				if vec is not None:
+					# the person name is taken from the image path
+					added.append((os.path.relpath(imagePath, thisdir), imagePath.split(os.path.sep)[-2], vec))
+
+	# write out the embeddings, names and cache
+	rows = sorted(keep + added, key=lambda row: row[0]) + runtime
+	vecs = np.array([row[2] for row in rows], dtype=np.float32).reshape(-1, 128)
+	knownNames = [row[1] for row in rows]
+	print("[INFO] serializing {} encodings...".format(len(rows)))
+	np.save(embeddings_npy, vecs)
+	json.dump([{"name": row[1], "path": row[0]} for row in rows], open(names_json, "w"))
+	json.dump(cache, open(cache_json, "w"))
+
+	# pickle in the format train_model.py expects
+	data = {"embeddings": list(vecs), "names": knownNames}
+	f = open(embeddings, "wb")
+	f.write(pickle.dumps(data))
+	f.close()
@@ -8,6 +8,7 @@ import imutils
 import pickle
 import cv2
 import os
+import sys
 
 
 # setup paths to the various files and parameters required
@@ -17,6 +18,10 @@ recognizer_path = os.path.join(thisdir, 'output/recognizer.pickle')
 embedding_model = os.path.join(thisdir, 'openface_nn4.small2.v1.t7')
 conf_cutoff = .5
 
+# shared SSD post-processing from the robotAI lib folder
+sys.path.insert(0, os.path.join(thisdir, '../../..'))
+from lib import common_detect
+
 # extract image path from arguments
 ap = argparse.ArgumentParser()
 ap.add_argument("-i", "--image", required=True, help="path to input image")
@@ -50,47 +55,38 @@ imageBlob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)), 1.0, (300, 300)
 detector.setInput(imageBlob)
 detections = detector.forward()
 
-# loop over the detections
-for i in range(0, detections.shape[2]):
-	# extract the confidence (i.e., probability) associated with the prediction
-	confidence = detections[0, 0, i, 2]
-
-	# filter out weak detections
-	if confidence > conf_cutoff:
-		# compute the (x, y)-coordinates of the bounding box for the face
-		box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-		(startX, startY, endX, endY) = box.astype("int")
-
-		# extract the face ROI
-		face = image[startY:endY, startX:endX]
-		(fH, fW) = face.shape[:2]
-
-		# ensure the face width and height are sufficiently large
-		if fW < 20 or fH < 20:
-			continue
-
-		# construct a blob for the face ROI, then pass the blob
-		# through our face embedding model to obtain the 128-d
-		# quantification of the face
-		faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255, (96, 96),
-			(0, 0, 0), swapRB=True, crop=False)
-		embedder.setInput(faceBlob)
-		vec = embedder.forward()
-
-		# perform classification to recognize the face
-		preds = recognizer.predict_proba(vec)[0]
-		j = np.argmax(preds)
-		proba = preds[j]
-		name = le.classes_[j]
-
-		# draw the bounding box of the face along with the associated
-		# probability
-		text = "{}: {:.2f}%".format(name, proba * 100)
-		y = startY - 10 if startY - 10 > 10 else startY + 10
-		cv2.rectangle(image, (startX, startY), (endX, endY),
-			(0, 0, 255), 2)
-		cv2.putText(image, text, (startX, y),
-			cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
+# filter out weak detections and loop over the rest
+for (startX, startY, endX, endY) in common_detect.parseDetections(detections, conf_cutoff, w, h)["box"]:
+	# extract the face ROI
+	face = image[max(startY, 0):endY, max(startX, 0):endX]
+	(fH, fW) = face.shape[:2]
+
+	# ensure the face width and height are sufficiently large
+	if fW < 20 or fH < 20:
+		continue
+
+	# construct a blob for the face ROI, then pass the blob
+	# through our face embedding model to obtain the 128-d
+	# quantification of the face
+	faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255, (96, 96),
+		(0, 0, 0), swapRB=True, crop=False)
+	embedder.setInput(faceBlob)
+	vec = embedder.forward()
+
+	# perform classification to recognize the face
+	preds = recognizer.predict_proba(vec)[0]
+	j = np.argmax(preds)
+	proba = preds[j]
+	name = le.classes_[j]
+
+	# draw the bounding box of the face along with the associated
+	# probability
+	text = "{}: {:.2f}%".format(name, proba * 100)
+	y = startY - 10 if startY - 10 > 10 else startY + 10
+	cv2.rectangle(image, (startX, startY), (endX, endY),
+		(0, 0, 255), 2)
+	cv2.putText(image, text, (startX, y),
+		cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
 
 # show the output image
 cv2.imshow("Image", image)
@@ -14,6 +14,12 @@ import pickle
 import time
 import cv2
 import os
+import sys
+
+# shared SSD post-processing from the robotAI lib folder
+thisdir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(thisdir, '../../..'))
+from lib import common_detect
 
 # construct the argument parser and parse the arguments
 ap = argparse.ArgumentParser()
@@ -72,49 +78,38 @@ while True:
 	detector.setInput(imageBlob)
 	detections = detector.forward()
 
-	# loop over the detections
-	for i in range(0, detections.shape[2]):
-		# extract the confidence (i.e., probability) associated with
-		# the prediction
-		confidence = detections[0, 0, i, 2]
-
-		# filter out weak detections
-		if confidence > args["confidence"]:
-			# compute the (x, y)-coordinates of the bounding box for
-			# the face
-			box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-			(startX, startY, endX, endY) = box.astype("int")
-
-			# extract the face ROI
-			face = frame[startY:endY, startX:endX]
-			(fH, fW) = face.shape[:2]
-
-			# ensure the face width and height are sufficiently large
-			if fW < 20 or fH < 20:
-				continue
-
-			# construct a blob for the face ROI, then pass the blob
-			# through our face embedding model to obtain the 128-d
-			# quantification of the face
-			faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255,
-				(96, 96), (0, 0, 0), swapRB=True, crop=False)
-			embedder.setInput(faceBlob)
-			vec = embedder.forward()
-
-			# perform classification to recognize the face
-			preds = recognizer.predict_proba(vec)[0]
-			j = np.argmax(preds)
-			proba = preds[j]
-			name = le.classes_[j]
-
-			# draw the bounding box of the face along with the
-			# associated probability
-			text = "{}: {:.2f}%".format(name, proba * 100)
-			y = startY - 10 if startY - 10 > 10 else startY + 10
-			cv2.rectangle(frame, (startX, startY), (endX, endY),
-				(0, 0, 255), 2)
-			cv2.putText(frame, text, (startX, y),
-				cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
+	# filter out weak detections and loop over the rest
+	for (startX, startY, endX, endY) in common_detect.parseDetections(detections, args["confidence"], w, h)["box"]:
+		# extract the face ROI
+		face = frame[max(startY, 0):endY, max(startX, 0):endX]
+		(fH, fW) = face.shape[:2]
+
+		# ensure the face width and height are sufficiently large
+		if fW < 20 or fH < 20:
+			continue
+
+		# construct a blob for the face ROI, then pass the blob
+		# through our face embedding model to obtain the 128-d
+		# quantification of the face
+		faceBlob = cv2.dnn.blobFromImage(face, 1.0 / 255,
+			(96, 96), (0, 0, 0), swapRB=True, crop=False)
+		embedder.setInput(faceBlob)
+		vec = embedder.forward()
+
+		# perform classification to recognize the face
+		preds = recognizer.predict_proba(vec)[0]
+		j = np.argmax(preds)
+		proba = preds[j]
+		name = le.classes_[j]
+
+		# draw the bounding box of the face along with the
+		# associated probability
+		text = "{}: {:.2f}%".format(name, proba * 100)
+		y = startY - 10 if startY - 10 > 10 else startY + 10
+		cv2.rectangle(frame, (startX, startY), (endX, endY),
+			(0, 0, 255), 2)
+		cv2.putText(frame, text, (startX, y),
+			cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 2)
 
 	# update the FPS counter
 	fps.update()
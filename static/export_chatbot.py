@@ -0,0 +1,75 @@
+# USAGE
+# python3 export_chatbot.py
+#
+# Exports the chat bot trained by build_chatbot.py to MLModels/chatbot/chatbot.npz so the brain can
+# run it with NumPy only (set chatEngine = numpy in settings.ini). Afterwards it checks that the NumPy
+# engine gives the same results as the Keras model, and compares their speed and memory use.
+
+import subprocess
+import json
+import time
+import sys
+import os
+import numpy as np
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+topdir = os.path.dirname(thisdir)
+sys.path.insert(0, topdir)
+from lib import brain_chatbot
+
+chatdir = os.path.join(thisdir, 'MLModels/chatbot')
+chatpath = os.path.join(chatdir, 'chatschema.json')
+npzpath = os.path.join(chatdir, 'chatbot.npz')
+
+
+# load the Keras model and write its weights, word index and classes to the .npz file
+print("[INFO] loading Keras model...")
+keras = brain_chatbot.kerasEngine(chatdir, chatpath)
+(embedding, w1, b1, w2, b2, w3, b3) = keras.model.get_weights()
+words = list(keras.tokenizer.word_index.keys())
+ids = [keras.tokenizer.word_index[w] for w in words]
+np.savez_compressed(npzpath, embedding=embedding, w1=w1, b1=b1, w2=w2, b2=b2, w3=w3, b3=b3,
+                    classes=np.array(keras.classes), words=np.array(words), ids=np.array(ids, dtype=np.int32),
+                    numWords=brain_chatbot.vocabSize, maxLen=brain_chatbot.maxLen)
+print("[INFO] wrote {} ({} bytes)".format(npzpath, os.path.getsize(npzpath)))
+
+
+# parity check on every training pattern plus some sentences the model has not seen
+engine = brain_chatbot.numpyEngine(npzpath)
+texts = [p for intent in json.load(open(chatpath))['intents'] for p in intent['patterns']]
+texts += ["", "hello hello hello", "What's the TIME, please?", "tell me a joke about a robot called Meebo",
+          " ".join(["word"] * 30), "completely unknown words here"]
+expected = keras.predict(texts)
+actual = engine.predict(texts)
+diff = np.abs(expected - actual).max()
+same = np.array_equal(np.argmax(expected, axis=1), np.argmax(actual, axis=1))
+print("[INFO] parity on {} sentences: max difference {:.2e}, same intent for all: {}".format(len(texts), diff, same))
+if diff > 1e-5 or not same or engine.classes != keras.classes:
+	print("[ERROR] the NumPy engine does not match the Keras model")
+	sys.exit(1)
+
+
+# latency of a single sentence, as used by the brain
+def timeIt(fn, repeats=200):
+	fn()
+	startTime = time.perf_counter()
+	for i in range(repeats):
+		fn()
+	return (time.perf_counter() - startTime) / repeats * 1000
+
+print("[INFO] Keras predict  {:.3f}ms per sentence".format(timeIt(lambda: keras.predict(["what time is it"]))))
+print("[INFO] NumPy predict  {:.3f}ms per sentence".format(timeIt(lambda: engine.predict(["what time is it"]))))
+
+
+# resident memory of a fresh process with each engine loaded
+rssCode = """
+import sys, os
+sys.path.insert(0, {topdir!r})
+from lib import brain_chatbot
+engine = brain_chatbot.loadEngine({{"topdir": {topdir!r}, "chatEngine": sys.argv[1]}})
+engine.predict(["hello"])
+print(int(open("/proc/self/statm").read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024))
+""".format(topdir=topdir)
+for name in ["keras", "numpy"]:
+	out = subprocess.run([sys.executable, "-c", rssCode, name], capture_output=True, text=True)
+	print("[INFO] {:6} engine process RSS {}MB".format(name, out.stdout.strip().splitlines()[-1] if out.stdout.strip() else "?"))